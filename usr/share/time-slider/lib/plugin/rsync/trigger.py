@@ -26,7 +26,7 @@ import subprocess
 import syslog
 
 from . import rsyncsmf
-from time_slider import util, smf, zfs
+from time_slider import util, smf, zfs, catalog
 
 # Set to True if SMF property value of "plugin/command" is "true"
 verboseprop = "plugin/verbose"
@@ -96,6 +96,8 @@ def main(argv):
     # zfs holds on the imported snapshots.
 
 
+    # Start from time-sliderd's snapshot catalog if it's up to date.
+    zfs.Datasets.snapshots.attach_catalog(catalog.open_catalog())
     datasets = zfs.Datasets()
     candidates = datasets.list_snapshots(snaplabel)
     autosnapsets = datasets.list_auto_snapshot_sets(schedule)
@@ -0,0 +1,387 @@
+#!/usr/bin/python3
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+
+"""
+A large buffer between zfs send and zfs receive, in the manner of
+mbuffer(1), so that a burst or stall on one side doesn't hold up the
+other. The stream passes through a ring of pipes enlarged with
+F_SETPIPE_SZ and is moved with splice(2), so it never gets copied to
+user space. Where splice(2) isn't available the data is copied
+through the same ring instead.
+
+Running the module benchmarks the buffer on a synthetic stream with
+bursty ends, eg. from the plugin directory:
+
+    python3 -m zfssend.buffer --bytes 4G --buffer-size 256M
+"""
+
+import os
+import sys
+import time
+import fcntl
+import random
+import select
+import argparse
+import threading
+
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+F_GETPIPE_SZ = getattr(fcntl, "F_GETPIPE_SZ", 1032)
+PIPE_MAX_SIZE = "/proc/sys/fs/pipe-max-size"
+# Size of an unenlarged pipe
+DEFAULT_PIPE_SIZE = 65536
+# Size of each pipe of the ring, unless the system allows less
+RING_PIPE_SIZE = 1024 * 1024
+
+_MEGABYTE = 1024 * 1024
+
+
+def get_pipe_max_size():
+    """
+    Returns the largest size an unprivileged process can make a pipe
+    """
+    try:
+        f = open(PIPE_MAX_SIZE)
+        try:
+            return int(f.read())
+        finally:
+            f.close()
+    except (OSError, ValueError):
+        return DEFAULT_PIPE_SIZE
+
+def set_pipe_size(fd, size):
+    """
+    Makes the pipe fd size bytes large, or as close to it as allowed.
+    Returns the resulting size.
+    """
+    for attempt in (size, min(size, get_pipe_max_size())):
+        try:
+            return fcntl.fcntl(fd, F_SETPIPE_SZ, attempt)
+        except OSError:
+            pass
+    try:
+        return fcntl.fcntl(fd, F_GETPIPE_SZ)
+    except OSError:
+        return DEFAULT_PIPE_SIZE
+
+if hasattr(os, "splice"):
+    def _move(src, dst, count):
+        return os.splice(src, dst, count)
+
+    def _fill(src, dst, count):
+        # Each buffer spliced into a pipe takes up a slot of it, however
+        # little of its page it fills, so a pipe can run out of slots
+        # before it runs out of bytes. Don't block on the pipe then, but
+        # let the caller move on to the next one.
+        select.select([src], [], [])
+        try:
+            return os.splice(src, dst, count,
+                             flags=os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            return None
+else:
+    def _move(src, dst, count):
+        data = os.read(src, count)
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(dst, view):]
+        return len(data)
+
+    _fill = _move
+
+
+def parse_size(value):
+    """
+    Returns the number of bytes in a size such as "256M"
+    """
+    value = value.strip().upper()
+    for idx,suffix in enumerate("KMGT"):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * (1024 ** (idx + 1)))
+    return int(value)
+
+
+class StreamBuffer:
+    """
+    Moves a stream from one file descriptor to another through a ring
+    of size bytes of pipes. One thread fills the pipes of the ring in
+    turn from the source while another drains them in the same order
+    to the destination. Either end must be a pipe for splice(2).
+    """
+    def __init__(self, size, pipesize = RING_PIPE_SIZE):
+        self._cv = threading.Condition()
+        self._readers = []
+        self._writers = []
+        self._capacity = []
+        try:
+            total = 0
+            while total < size or len(self._readers) == 0:
+                r,w = os.pipe()
+                self._readers.append(r)
+                self._writers.append(w)
+                self._capacity.append(set_pipe_size(w, pipesize))
+                total += self._capacity[-1]
+        except OSError:
+            self.close()
+            raise
+        self.size = total
+        count = len(self._readers)
+        # Bytes in each pipe not yet drained, and whether the filler
+        # has moved on from it
+        self._avail = [0] * count
+        self._sealed = [False] * count
+        self._eof = False
+        self._error = None
+        self._filled = 0
+        self.nbytes = 0
+
+    def run(self, src, dst):
+        """
+        Moves everything from src to dst, returning at the end of
+        the stream. Returns the number of bytes moved. Raises OSError
+        if reading or writing fails.
+        """
+        thread = threading.Thread(target=self.__fill, args=(src,),
+                                  name="buffer-fill")
+        thread.start()
+        try:
+            self.__drain(dst)
+        except OSError as message:
+            self.__fail(message)
+            # The filler may be stuck writing to a full pipe.
+            self.__close_readers()
+        thread.join()
+        if self._error != None:
+            raise self._error
+        return self.nbytes
+
+    def __fail(self, error):
+        self._cv.acquire()
+        if self._error == None:
+            self._error = error
+        self._cv.notify_all()
+        self._cv.release()
+
+    def __fill(self, src):
+        slot = 0
+        count = len(self._writers)
+        try:
+            while True:
+                self._cv.acquire()
+                while (self._sealed[slot] == True or \
+                       self._avail[slot] > 0) and self._error == None:
+                    self._cv.wait()
+                failed = self._error != None
+                self._cv.release()
+                if failed == True:
+                    return
+                # Never put more in a pipe than it holds, so that only
+                # reading the source can block.
+                written = 0
+                eof = False
+                while written < self._capacity[slot]:
+                    moved = _fill(src, self._writers[slot],
+                                  self._capacity[slot] - written)
+                    if moved == None:
+                        if written > 0:
+                            break
+                        # Can't be out of slots when empty, but never
+                        # spin.
+                        moved = _move(src, self._writers[slot],
+                                      self._capacity[slot])
+                    if moved == 0:
+                        eof = True
+                        break
+                    written += moved
+                    self._cv.acquire()
+                    self._avail[slot] += moved
+                    self._filled += moved
+                    self._cv.notify_all()
+                    self._cv.release()
+                self._cv.acquire()
+                self._sealed[slot] = True
+                self._eof = eof
+                self._cv.notify_all()
+                self._cv.release()
+                if eof == True:
+                    return
+                slot = (slot + 1) % count
+        except OSError as message:
+            self.__fail(message)
+
+    def __drain(self, dst):
+        slot = 0
+        count = len(self._readers)
+        while True:
+            self._cv.acquire()
+            try:
+                while self._avail[slot] == 0 and \
+                      self._sealed[slot] == False and self._error == None:
+                    self._cv.wait()
+                if self._error != None:
+                    return
+                available = self._avail[slot]
+                if available == 0:
+                    # Sealed and drained
+                    self._sealed[slot] = False
+                    self._cv.notify_all()
+                    if self._eof == True and self.nbytes == self._filled:
+                        return
+                    slot = (slot + 1) % count
+                    continue
+            finally:
+                self._cv.release()
+            moved = _move(self._readers[slot], dst, available)
+            self._cv.acquire()
+            self._avail[slot] -= moved
+            self.nbytes += moved
+            self._cv.notify_all()
+            self._cv.release()
+
+    def __close_readers(self):
+        for idx,fd in enumerate(self._readers):
+            if fd != None:
+                os.close(fd)
+                self._readers[idx] = None
+
+    def close(self):
+        self.__close_readers()
+        for idx,fd in enumerate(self._writers):
+            if fd != None:
+                os.close(fd)
+                self._writers[idx] = None
+
+
+def _produce(fd, total, burst, pause, seed):
+    """
+    Writes total bytes to fd in bursts of up to twice burst bytes,
+    pausing for up to twice pause seconds after each burst, then
+    closes fd.
+    """
+    rand = random.Random(seed)
+    block = memoryview(bytes(_MEGABYTE))
+    remaining = total
+    try:
+        while remaining > 0:
+            inburst = min(rand.randint(1, 2 * burst), remaining)
+            remaining -= inburst
+            while inburst > 0:
+                inburst -= os.write(fd, block[:min(inburst, len(block))])
+            if pause > 0 and remaining > 0:
+                time.sleep(rand.uniform(0, 2 * pause))
+    finally:
+        os.close(fd)
+
+def _consume(fd, burst, pause, seed):
+    """
+    Reads fd to the end in bursts of up to twice burst bytes, pausing
+    for up to twice pause seconds after each burst. Returns the number
+    of bytes read.
+    """
+    rand = random.Random(seed)
+    block = bytearray(_MEGABYTE)
+    total = 0
+    inburst = rand.randint(1, 2 * burst)
+    while True:
+        count = os.readv(fd, [block])
+        if count == 0:
+            break
+        total += count
+        inburst -= count
+        if inburst <= 0:
+            inburst = rand.randint(1, 2 * burst)
+            if pause > 0:
+                time.sleep(rand.uniform(0, 2 * pause))
+    return total
+
+def benchmark(total, buffersize, burst, pause, seed = 0):
+    """
+    Pipes a synthetic stream of total bytes from a producer to a
+    consumer, directly if buffersize is 0 or through a StreamBuffer
+    of buffersize bytes otherwise. Both ends work in bursts of burst
+    bytes with random pauses around pause seconds in between. Returns
+    the throughput in bytes per second.
+    """
+    producer = os.pipe()
+    consumer = producer
+    streambuffer = None
+    if buffersize > 0:
+        consumer = os.pipe()
+        set_pipe_size(producer[1], RING_PIPE_SIZE)
+        set_pipe_size(consumer[1], RING_PIPE_SIZE)
+        streambuffer = StreamBuffer(buffersize)
+    start = time.monotonic()
+    thread = threading.Thread(target=_produce,
+                              args=(producer[1], total, burst, pause, seed))
+    thread.start()
+    relay = None
+    if streambuffer != None:
+        def run_buffer():
+            try:
+                streambuffer.run(producer[0], consumer[1])
+            finally:
+                os.close(producer[0])
+                os.close(consumer[1])
+        relay = threading.Thread(target=run_buffer)
+        relay.start()
+    received = _consume(consumer[0], burst, pause, seed + 1)
+    elapsed = time.monotonic() - start
+    thread.join()
+    os.close(consumer[0])
+    if relay != None:
+        relay.join()
+        streambuffer.close()
+    if received != total:
+        raise RuntimeError("Received %d of %d bytes" % (received, total))
+    return total / elapsed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="zfssend.buffer",
+                                     description="Benchmark the zfssend " \
+                                     "stream buffer on a synthetic stream")
+    parser.add_argument("--bytes", type=parse_size, default="2G",
+                        help="Size of the stream (default 2G)")
+    parser.add_argument("--buffer-size", type=parse_size, default="256M",
+                        help="Size of the buffer (default 256M)")
+    parser.add_argument("--burst", type=parse_size, default="64M",
+                        help="Bytes each end moves between pauses " \
+                        "(default 64M)")
+    parser.add_argument("--pause", type=float, default=0.05,
+                        help="Average pause of each end between bursts, " \
+                        "in seconds (default 0.05)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed (default 0)")
+    args = parser.parse_args(argv)
+
+    sys.stdout.write("splice(2): %s, pipe-max-size: %d\n" \
+                     % (hasattr(os, "splice"), get_pipe_max_size()))
+    for name,size in (("direct", 0), ("buffered", args.buffer_size)):
+        throughput = benchmark(args.bytes, size, args.burst, args.pause,
+                               args.seed)
+        sys.stdout.write("%-10s %10.1f MB/s\n" \
+                         % (name, throughput / _MEGABYTE))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,355 @@
+#!/usr/bin/python3
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+
+"""
+Runs the zfs send | receive pipelines of a snapshot set several at a
+time. A dataset's stream is only received once its parent's has been,
+as zfs receive falls over if it receives a child before the parent
+without the "-F" option.
+"""
+
+import os
+import re
+import time
+import threading
+import subprocess
+
+from time_slider import util
+from . import buffer
+
+# With the -P option, zfs send reports the size of the stream on
+# standard error
+SIZELINE = re.compile(r"^size\s+(\d+)\s*$", re.MULTILINE)
+
+
+class PipeReader(threading.Thread):
+    """
+    Reads a pipe to the end on a thread of its own, so that a command
+    writing more to it than the pipe holds doesn't stall while the
+    rest of its pipeline is still running.
+    """
+    def __init__(self, pipe):
+        threading.Thread.__init__(self, daemon=True)
+        self.pipe = pipe
+        self.data = b""
+
+    def run(self):
+        try:
+            self.data = self.pipe.read()
+        finally:
+            self.pipe.close()
+
+    def get_output(self):
+        """
+        Waits for the end of the pipe and returns what was read from
+        it, decoded.
+        """
+        self.join()
+        return self.data.decode("utf-8", "replace")
+
+
+class SendJob:
+    """
+    The send and receive of one dataset's snapshot streams. Usually
+    there is just the one, but a stream interrupted by an earlier run
+    may have to be resumed first.
+    """
+    def __init__(self, dataset, recvcmd, buffersize = 0):
+        self.dataset = dataset
+        self.pool = dataset.split('/', 1)[0]
+        self.recvcmd = recvcmd
+        # Bytes of buffer between send and receive, 0 for none
+        self.buffersize = buffersize
+        # (send command, label) tuples of the streams to send in turn.
+        # The label is that of the snapshot the stream brings the
+        # receiving side up to.
+        self.streams = []
+        # The datasets the streams bring up to date. More than just
+        # the one for a replication stream.
+        self.datasets = [dataset]
+        # The job of the nearest ancestor dataset, if any. Set by
+        # SendExecutor.add()
+        self.parent = None
+        # Size of the streams, as far as reported by zfs send
+        self.nbytes = 0
+        self.elapsed = None
+        # Why the job failed or wasn't run, None if it succeeded
+        self.error = None
+
+    def add_stream(self, sendcmd, label):
+        self.streams.append((sendcmd, label))
+
+    def run(self, callback = None):
+        """
+        Sends the streams in turn. callback(job, label) is called
+        after each of them has been received. Raises RuntimeError if
+        either side of a pipeline fails.
+        """
+        start = time.monotonic()
+        try:
+            for sendcmd,label in self.streams:
+                self.__send(sendcmd)
+                if callback != None:
+                    callback(self, label)
+        finally:
+            self.elapsed = time.monotonic() - start
+
+    def __send(self, sendcmd):
+        if self.buffersize > 0:
+            bufin,sendout = os.pipe()
+        else:
+            sendout = subprocess.PIPE
+        try:
+            sendP = subprocess.Popen(sendcmd,
+                                     stdout=sendout,
+                                     stderr=subprocess.PIPE,
+                                     close_fds=True)
+        except OSError as message:
+            if self.buffersize > 0:
+                os.close(bufin)
+                os.close(sendout)
+            raise RuntimeError("Can't run send command %s: %s" \
+                               % (str(sendcmd), str(message)))
+        if self.buffersize > 0:
+            # The write end now belongs to the sender alone, so that
+            # the buffer sees the end of the stream when it exits.
+            os.close(sendout)
+            recvin,bufout = os.pipe()
+        else:
+            recvin = sendP.stdout
+        try:
+            recvP = subprocess.Popen(self.recvcmd,
+                                     stdin=recvin,
+                                     stderr=subprocess.PIPE,
+                                     close_fds=True)
+        except OSError as message:
+            sendP.kill()
+            sendP.communicate()
+            if self.buffersize > 0:
+                os.close(bufin)
+                os.close(recvin)
+                os.close(bufout)
+            raise RuntimeError("Can't run receive command %s: %s" \
+                               % (str(self.recvcmd), str(message)))
+        # Only the receiver reads the stream from here on, so that the
+        # sender gets EPIPE rather than blocking if the receiver dies.
+        if self.buffersize > 0:
+            os.close(recvin)
+        else:
+            sendP.stdout.close()
+
+        # zfs send -P reports every snapshot of a replication stream,
+        # easily more than a pipe holds before the stream is through.
+        sendreader = PipeReader(sendP.stderr)
+        sendreader.start()
+        recvreader = PipeReader(recvP.stderr)
+        recvreader.start()
+
+        buferror = None
+        if self.buffersize > 0:
+            buferror = self.__buffer(bufin, bufout)
+
+        recverrno = recvP.wait()
+        senderrno = sendP.wait()
+        senderr = sendreader.get_output()
+        recverr = recvreader.get_output()
+
+        if senderrno != 0:
+            raise RuntimeError("Send command: %s failed with exit code " \
+                               "%d. Error message: \n%s" \
+                               % (str(sendcmd), senderrno, senderr))
+        if recverrno != 0:
+            raise RuntimeError("Receive command %s failed with exit " \
+                               "code %d. Error message: \n%s" \
+                               % (str(self.recvcmd), recverrno, recverr))
+        if buferror != None:
+            raise RuntimeError("Buffering the stream of %s failed: %s" \
+                               % (self.dataset, str(buferror)))
+        match = SIZELINE.search(senderr)
+        if match != None:
+            self.nbytes += int(match.group(1))
+
+    def __buffer(self, src, dst):
+        """
+        Moves the stream from src to dst through a StreamBuffer and
+        closes both. Returns the OSError that stopped it, if any.
+        """
+        result = None
+        ring = None
+        try:
+            # Larger pipes at either end mean fewer, larger splices.
+            buffer.set_pipe_size(src, buffer.RING_PIPE_SIZE)
+            buffer.set_pipe_size(dst, buffer.RING_PIPE_SIZE)
+            ring = buffer.StreamBuffer(self.buffersize)
+            ring.run(src, dst)
+        except OSError as message:
+            result = message
+        finally:
+            if ring != None:
+                ring.close()
+            os.close(src)
+            os.close(dst)
+        return result
+
+class SendExecutor:
+    """
+    Runs SendJobs in parallel, with at most concurrency of them at a
+    time overall and at most poolconcurrency at a time per zpool. A
+    job doesn't start before the job of its nearest ancestor dataset
+    has succeeded, and is skipped if that one fails.
+    """
+    def __init__(self, concurrency = 1, poolconcurrency = 0,
+                 verbose = False):
+        """
+        Keyword arguments:
+        concurrency -- Maximum number of jobs run at the same time
+                       (default 1)
+        poolconcurrency -- Maximum number of jobs run at the same time
+                           for the datasets of a zpool, 0 for no limit
+                           other than concurrency (default 0)
+        verbose -- Log the progress of the jobs (default False)
+        """
+        self.concurrency = max(1, concurrency)
+        self.poolconcurrency = max(0, poolconcurrency)
+        self.verbose = verbose
+        self._cv = threading.Condition()
+        self._jobs = {}
+        self._pending = []
+        self._active = 0
+        self._running = {}
+        self._finished = set()
+        self.completed = []
+        self.failed = []
+        self.skipped = []
+        self.elapsed = 0.0
+
+    def add(self, job):
+        """
+        Queues job. Jobs start in the order they were added, as far as
+        the dataset ordering and concurrency limits allow.
+        """
+        self._jobs[job.dataset] = job
+        self._pending.append(job)
+        # Ancestors may be added after their descendants, so link
+        # every pending job to its nearest queued ancestor afresh.
+        for pending in self._pending:
+            pending.parent = None
+            name = pending.dataset
+            while name.find('/') != -1:
+                name = name.rsplit('/', 1)[0]
+                if name in self._jobs:
+                    pending.parent = self._jobs[name]
+                    break
+
+    def run(self, callback = None):
+        """
+        Runs all the queued jobs, returning once they have all
+        finished or been skipped. callback(job, label) is called from
+        the job's thread after each of the job's streams has been
+        received. An exception raised by the callback fails the job.
+        Returns the list of failed jobs.
+        """
+        start = time.monotonic()
+        threads = []
+        self._cv.acquire()
+        try:
+            while len(self._pending) > 0 or self._active > 0:
+                job = self.__next_job()
+                if job == None:
+                    self._cv.wait()
+                    continue
+                self._pending.remove(job)
+                self._active += 1
+                self._running[job.pool] = self._running.get(job.pool, 0) + 1
+                thread = threading.Thread(target=self.__run_job,
+                                          args=(job, callback),
+                                          name="send-%s" % (job.dataset))
+                thread.start()
+                threads.append(thread)
+        finally:
+            self._cv.release()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.monotonic() - start
+        return self.failed
+
+    def __next_job(self):
+        """
+        Returns the next job that can be started now, or None. Skips
+        the jobs whose ancestor failed or was skipped. Must be called
+        with the condition held.
+        """
+        for job in self._pending[:]:
+            if job.parent != None and job.parent in self._finished and \
+               job.parent.error != None:
+                job.error = "Not sent because %s wasn't" % \
+                            (job.parent.dataset)
+                self._pending.remove(job)
+                self._finished.add(job)
+                self.skipped.append(job)
+        if self._active >= self.concurrency:
+            return None
+        for job in self._pending:
+            if job.parent != None and job.parent not in self._finished:
+                continue
+            if self.poolconcurrency > 0 and \
+               self._running.get(job.pool, 0) >= self.poolconcurrency:
+                continue
+            return job
+        return None
+
+    def __run_job(self, job, callback):
+        util.debug("Sending %s" % (job.dataset), self.verbose)
+        try:
+            job.run(callback)
+        except Exception as message:
+            # Whatever went wrong, the other jobs must go on.
+            job.error = str(message)
+        self._cv.acquire()
+        self._active -= 1
+        self._running[job.pool] -= 1
+        self._finished.add(job)
+        if job.error == None:
+            self.completed.append(job)
+            util.debug("Sent %s: %d bytes in %.1f seconds" \
+                       % (job.dataset, job.nbytes, job.elapsed),
+                       self.verbose)
+        else:
+            self.failed.append(job)
+        self._cv.notify_all()
+        self._cv.release()
+
+    def get_sent_size(self):
+        """
+        Returns the total size of the streams sent successfully
+        """
+        return sum([job.nbytes for job in self.completed])
+
+    def get_throughput(self):
+        """
+        Returns the aggregate throughput of the last run() in bytes per
+        second, counting the streams sent successfully
+        """
+        if self.elapsed <= 0:
+            return 0.0
+        return self.get_sent_size() / self.elapsed
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+
+"""
+Works out from the configured receive command where the streams of
+the datasets end up, so that the receiving side can be asked for
+receive_resume_token and streams interrupted part way through can be
+picked up where they left off with "zfs send -t".
+
+The receive command has to be a zfs receive, possibly behind a
+prefix such as "ssh host" or "pfexec". The same prefix is used to run
+zfs on the receiving side.
+"""
+
+import os
+
+from time_slider import util, zfs
+
+RECEIVEVERBS = ("receive", "recv")
+# Options of zfs receive that take an argument
+ARGOPTIONS = "ox"
+
+
+class Receiver:
+
+    def __init__(self, recvcmd):
+        self.recvcmd = recvcmd
+        # Index of the receive verb in recvcmd, None if recvcmd isn't
+        # a zfs receive
+        self._verb = None
+        self._flags = set()
+        self._target = None
+        for idx in range(1, len(recvcmd)):
+            if recvcmd[idx] in RECEIVEVERBS and \
+               os.path.basename(recvcmd[idx - 1]) == "zfs":
+                self._verb = idx
+                break
+        if self._verb == None:
+            return
+        args = recvcmd[self._verb + 1:]
+        idx = 0
+        while idx < len(args):
+            arg = args[idx]
+            idx += 1
+            if not arg.startswith('-') or len(arg) < 2:
+                self._target = arg.split('@', 1)[0]
+                continue
+            for pos,flag in enumerate(arg[1:]):
+                self._flags.add(flag)
+                if flag in ARGOPTIONS:
+                    # The argument is either the rest of this one or
+                    # the next one.
+                    if pos == len(arg) - 2:
+                        idx += 1
+                    break
+
+    def is_zfs_receive(self):
+        return self._verb != None and self._target != None
+
+    def get_command(self, resumable = False):
+        """
+        Returns the receive command, saving the state of interrupted
+        streams if resumable is True
+        """
+        if resumable == False or self.is_zfs_receive() == False or \
+           "s" in self._flags:
+            return self.recvcmd
+        return self.recvcmd[:self._verb + 1] + ["-s"] + \
+               self.recvcmd[self._verb + 1:]
+
+    def get_target(self, dataset):
+        """
+        Returns the name dataset is received as
+        """
+        if self.is_zfs_receive() == False:
+            return None
+        if "d" in self._flags:
+            if dataset.find('/') == -1:
+                return self._target
+            return "%s/%s" % (self._target, dataset.split('/', 1)[1])
+        if "e" in self._flags:
+            return "%s/%s" % (self._target, dataset.rsplit('/', 1)[-1])
+        return self._target
+
+    def __run(self, args):
+        # zfs on the receiving side, behind the same prefix as the
+        # receive command
+        return util.run_command(self.recvcmd[:self._verb] + args)
+
+    def get_resume_token(self, dataset):
+        """
+        Returns the resume token of an interrupted stream of dataset,
+        or None if there is none
+        """
+        target = self.get_target(dataset)
+        if target == None:
+            return None
+        try:
+            outdata,errdata = self.__run(["get", "-H", "-o", "value",
+                                          "receive_resume_token", target])
+        except RuntimeError:
+            # Nothing was ever received as target
+            return None
+        token = outdata.strip()
+        if len(token) == 0 or token == "-":
+            return None
+        return token
+
+    def abort_resume(self, dataset):
+        """
+        Discards the partially received state of dataset's
+        interrupted stream
+        """
+        self.__run(["receive", "-A", self.get_target(dataset)])
+
+
+def get_token_snapshot(token):
+    """
+    Returns the name of the snapshot the stream described by the
+    resume token brings the receiving side up to, or None if it can't
+    be told.
+    """
+    cmd = [zfs.ZFSCMD, "send", "-n", "-v", "-t", token]
+    try:
+        outdata,errdata = util.run_command(cmd)
+    except RuntimeError:
+        return None
+    # zfs send prints the contents of the token as an nvlist, on
+    # standard output or error depending on the release.
+    for line in (outdata + errdata).split('\n'):
+        fields = line.split('=', 1)
+        if len(fields) == 2 and fields[0].strip() == "toname":
+            return fields[1].strip()
+    return None
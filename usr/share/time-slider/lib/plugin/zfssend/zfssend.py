@@ -26,14 +26,14 @@ import subprocess
 import syslog
 from bisect import insort
 
-import time_slider.util
-import time_slider.smf
-import time_slider.zfs
+from . import zfssendsmf
+from . import pipeline
+from . import receiver as zfsreceiver
+from time_slider import util, smf, zfs
 
 # Set to True if SMF property value of "plugin/command" is "true"
 verboseprop = "plugin/verbose"
 propbasename = "org.opensolaris:time-slider-plugin"
-print(_("Do I work?"))
 
 def main(argv):
 
@@ -97,7 +97,8 @@ def main(argv):
 
     datasets = zfs.Datasets()
     candidates = datasets.list_snapshots(snaplabel)
-    originsets = datasets.list_auto_snapshot_sets(schedule)
+    inventory = zfs.AutoSnapshotInventory(schedule)
+    originsets = inventory.list_included()
     snappeddatasets = []
     snapnames = [name for [name,ctime] in candidates \
                  if name.split('@',1)[0] in originsets]
@@ -106,25 +107,23 @@ def main(argv):
     # Place a hold on the the newly created snapshots so
     # they can be backed up without fear of being destroyed
     # before the backup gets a chance to complete.
+    alreadyheld = list_held(snapnames, propname)
+    tohold = []
     for snap in snapnames:
-        snapshot = zfs.Snapshot(snap)
-        holds = snapshot.holds()
-        try:
-            holds.index(propname)
-        except ValueError:
+        if snap not in alreadyheld:
             util.debug("Placing hold on %s" % (snap), verbose)
-            snapshot.hold(propname)
-        datasetname = snapshot.fsname
+            tohold.append(snap)
+        datasetname = snap.split('@', 1)[0]
         # Insert datasetnames in alphabetically sorted order because
         # zfs receive falls over if it receives a child before the
         # parent if the "-F" option is not used.
         insort(snappeddatasets, datasetname)
+    zfs.get_backend().hold(propname, tohold)
 
     # Find out the receive command property value
-    cmd = [smf.SVCPROPCMD, "-c", "-p", "receive/command", pluginfmri]
-    outdata,errdata = util.run_command(cmd)
-    # Strip out '\' characters inserted by svcprop
-    recvcmd = outdata.strip().replace('\\', '').split()
+    smfinst = zfssendsmf.ZfsSendSMF(pluginfmri)
+    recvcmd = smfinst.get_receive_command()
+    outdata = " ".join(recvcmd)
 
     # Check to see if the receive command is accessible and executable
     try:
@@ -145,28 +144,130 @@ def main(argv):
         maintenance(pluginfmri)   
         sys.exit(-1)
 
+    # With resumable receives, the receiving side keeps the state of
+    # an interrupted stream so that the next run can pick it up where
+    # it left off.
+    receiver = zfsreceiver.Receiver(recvcmd)
+    resumable = smfinst.get_resumable()
+    if resumable == True and receiver.is_zfs_receive() == False:
+        log_error(syslog.LOG_WARNING,
+                  "Plugin: %s: Can't resume streams received by: %s" \
+                  % (pluginfmri, outdata))
+        resumable = False
+    recvcmd = receiver.get_command(resumable)
+
+    # Options such as -c or -w change the form of the stream, but
+    # not what goes into it. A resumed stream keeps the form it was
+    # started with, so they aren't given with -t.
+    try:
+        sendoptions = smfinst.get_send_options()
+    except ValueError as message:
+        log_error(syslog.LOG_ERR,
+                  "Plugin: %s: %s" % (pluginfmri, str(message)))
+        maintenance(pluginfmri)
+        sys.exit(-1)
+    buffersize = smfinst.get_buffer_size()
+    # With bookmarks, incremental streams are sent from a bookmark of
+    # the previously sent snapshot, so the snapshot's hold can go as
+    # soon as it has been sent, and it can expire like any other.
+    bookmarks = smfinst.get_bookmarks()
+
+    previous = {}
     for dataset in snappeddatasets:
-        sendcmd = None
         prevsnapname = None
+        prevlabel = zfs.ReadableDataset(dataset).get_user_property(propname)
+        if prevlabel != None and len(prevlabel) > 0:
+            prevsnapname = "%s@%s" % (dataset, prevlabel)
+        previous[dataset] = prevsnapname
+
+    # The datasets whose previously sent snapshot has no bookmark.
+    # It was sent before bookmarks were turned on and still has its
+    # hold.
+    held = set()
+    if bookmarks == True:
+        sentbefore = [dataset for dataset in snappeddatasets \
+                      if previous[dataset] != None]
+        existing = list_bookmarks(sentbefore)
+        for dataset in sentbefore:
+            if get_bookmark(previous[dataset]).name not in existing:
+                held.add(dataset)
+
+    # Whole trees of recursively snapshotted datasets can go in one
+    # replication stream, as atomically as they were snapshotted.
+    replicated = {}
+    if smfinst.get_recursive() == True:
+        if resumable == True:
+            log_error(syslog.LOG_WARNING,
+                      "Plugin: %s: Replication streams can't be resumed. " \
+                      "Sending datasets one by one" % (pluginfmri))
+        else:
+            replicated = get_replication_sets(inventory, snappeddatasets,
+                                              previous)
+    covered = set()
+    for root,members in replicated.items():
+        covered.update([name for name in members if name != root])
+
+    # Independent datasets are sent in parallel, children only after
+    # their parents.
+    executor = pipeline.SendExecutor(smfinst.get_concurrency(),
+                                     smfinst.get_pool_concurrency(),
+                                     verbose)
+    for dataset in snappeddatasets:
+        if dataset in covered:
+            continue
         ds = zfs.ReadableDataset(dataset)
-        prevlabel = ds.get_user_property(propname)
+        prevsnapname = previous[dataset]
+        job = pipeline.SendJob(dataset, recvcmd, buffersize)
+
+        if dataset in replicated:
+            job.datasets = replicated[dataset]
+            snapname = "%s@%s" % (ds.name, snaplabel)
+            if prevsnapname == None:
+                util.debug("Sending a full replication stream of %s" \
+                           % (snapname), verbose)
+                job.add_stream([zfs.ZFSCMD, "send", "-P"] + sendoptions + \
+                               ["-R", snapname], snaplabel)
+            else:
+                util.debug("Sending a replication stream of %s from %s" \
+                           % (snapname, prevsnapname), verbose)
+                job.add_stream([zfs.ZFSCMD, "send", "-P"] + sendoptions + \
+                               ["-R", "-I", prevsnapname, snapname],
+                               snaplabel)
+            executor.add(job)
+            continue
+
+        if resumable == True:
+            resumed = resume_stream(job, receiver, verbose)
+            if resumed != None:
+                prevsnapname = resumed
 
         snapname = "%s@%s" % (ds.name, snaplabel)
-        if (prevlabel == None or len(prevlabel) == 0):
+        if prevsnapname == snapname:
+            # The resumed stream is all there is to send
+            pass
+        elif prevsnapname == None:
             # No previous backup - send a full replication stream
-            sendcmd = [zfs.ZFSCMD, "send", snapname]
+            job.add_stream([zfs.ZFSCMD, "send", "-P"] + sendoptions + \
+                           [snapname], snaplabel)
             util.debug("No previous backup registered for %s" % ds.name, verbose)
         else:
             # A record of a previous backup exists.
             # Check that it exists to enable send of an incremental stream.
-            prevsnapname = "%s@%s" % (ds.name, prevlabel)
             util.debug("Previously sent snapshot: %s" % prevsnapname, verbose)
             prevsnap = zfs.Snapshot(prevsnapname)
-            if prevsnap.exists():
-                sendcmd = [zfs.ZFSCMD, "send", "-i", prevsnapname, snapname]
+            # A resumed stream's snapshot doesn't have its bookmark yet.
+            if bookmarks == True and dataset not in held and \
+               prevsnapname == previous[dataset]:
+                job.add_stream([zfs.ZFSCMD, "send", "-P"] + sendoptions + \
+                               ["-i", get_bookmark(prevsnapname).name,
+                                snapname], snaplabel)
+            elif prevsnap.exists():
+                job.add_stream([zfs.ZFSCMD, "send", "-P"] + sendoptions + \
+                               ["-i", prevsnapname, snapname], snaplabel)
             else:
                 # This should not happen under normal operation since we
-                # place a hold on the snapshot until it gets sent. So
+                # place a hold on the snapshot, or keep a bookmark of
+                # it, until it gets sent. So
                 # getting here suggests that something else released the
                 # hold on the snapshot, allowing it to get destroyed
                 # prematurely.
@@ -175,53 +276,214 @@ def main(argv):
                           % prevsnapname)
                 maintenance(pluginfmri)
                 sys.exit(-1)
-        
-        
-        try:
-            sendP = subprocess.Popen(sendcmd,
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE,
-                                     close_fds=True)
-            recvP = subprocess.Popen(recvcmd,
-                                     stdin=sendP.stdout,
-                                     stderr=subprocess.PIPE,
-                                     close_fds=True)
-
-            recvout,recverr = recvP.communicate()
-            recverrno = recvP.wait()
-            sendout,senderr = sendP.communicate()
-            senderrno = sendP.wait()
-
-            if senderrno != 0:
-                raise RuntimeError("Send command: %s failed with exit code" \
-                                    "%d. Error message: \n%s" \
-                                    % (str(sendcmd), senderrno, senderr))
-            if recverrno != 0:
-                raise RuntimeError("Receive command %s failed with exit " \
-                                    "code %d. Error message: \n%s" \
-                                    % (str(recvcmd), recverrno, recverr))
+        executor.add(job)
 
-            if prevsnapname != None:
-                util.debug("Releasing hold on %s" % (prevsnapname), verbose)
-                snapshot = zfs.Snapshot(prevsnapname)
+    def record_sent(job, label):
+        # Make a record of the latest backup and release the old
+        # snapshot as soon as each stream is through, so that an
+        # interruption later on doesn't lose track of it. The zfs(1)
+        # commands are shared by all the datasets of the stream.
+        newbookmarks = {}
+        releases = []
+        oldbookmarks = []
+        for dataset in job.datasets:
+            snapname = "%s@%s" % (dataset, label)
+            prevsnapname = previous[dataset]
+            if bookmarks == True:
+                newbookmarks[get_bookmark(snapname).name] = snapname
+                util.debug("Releasing hold on sent snapshot: %s" \
+                           % (snapname),
+                           verbose)
+                releases.append(snapname)
+            if prevsnapname == None:
+                pass
+            elif bookmarks == False or dataset in held:
                 util.debug("Releasing hold on previous snapshot: %s" \
-                      % (prevsnapname),
-                      verbose)
-                snapshot.release(propname)
-        except Exception as message:
+                           % (prevsnapname),
+                           verbose)
+                releases.append(prevsnapname)
+                held.discard(dataset)
+            else:
+                util.debug("Destroying bookmark of previous snapshot: %s" \
+                           % (prevsnapname),
+                           verbose)
+                oldbookmarks.append(get_bookmark(prevsnapname).name)
+
+        # The sent snapshots keep their holds until they have their
+        # bookmarks, and the previous ones until the new ones have
+        # been recorded, so that there is always something to send
+        # the next stream from.
+        zfs.get_backend().bookmark(newbookmarks)
+        for dataset in job.datasets:
+            zfs.ReadableDataset(dataset).set_user_property(propname, label)
+            previous[dataset] = "%s@%s" % (dataset, label)
+        if bookmarks == True:
+            # Snapshots sent before bookmarks were turned on may not
+            # have been held after all.
+            release_holds(releases, propname)
+            try:
+                zfs.get_backend().destroy_bookmarks(oldbookmarks)
+            except RuntimeError:
+                # Bookmarks take no space. A stray one is harmless.
+                pass
+        else:
+            release_holds(releases, propname, strict = True)
+
+    failed = executor.run(record_sent)
+    size = executor.get_sent_size()
+    syslog.syslog(syslog.LOG_INFO,
+                  "Sent %d of %d \"%s\" snapshot streams, %.1f MB in " \
+                  "%.1f seconds (%.1f MB/s)" \
+                  % (sum([len(job.datasets) for job in executor.completed]),
+                     len(snappeddatasets),
+                     snaplabel, float(size) / zfs.BYTESPERMB,
+                     executor.elapsed,
+                     executor.get_throughput() / zfs.BYTESPERMB))
+    if len(failed) > 0:
+        for job in failed:
             log_error(syslog.LOG_ERR,
                       "Error during snapshot send/receive operation: %s" \
-                      % (message))
+                      % (job.error))
+        for job in executor.skipped:
+            log_error(syslog.LOG_ERR, job.error)
+        maintenance(pluginfmri)
+        sys.exit(-1)
+    util.debug("Sending of \"%s\"snapshot streams completed" \
+          % (snaplabel),
+          verbose)
 
-            maintenance(pluginfmri)
-            sys.exit(-1)            
-
-        # Finally, after success, make a record of the latest backup
-        # and release the old snapshot.
-        ds.set_user_property(propname, snaplabel)
-        util.debug("Sending of \"%s\"snapshot streams completed" \
-              % (snaplabel),
-              verbose)
+def snapshot_exists(snapname):
+    """
+    Returns True if the snapshot snapname exists. With bookmarks, a
+    previously sent snapshot may well have expired.
+    """
+    try:
+        return zfs.Snapshot(snapname).exists()
+    except RuntimeError:
+        return False
+
+def list_held(snapnames, tag):
+    """
+    Returns the set of the snapshots snapnames that have a user hold
+    called tag, as listed by a single zfs(1) invocation
+    """
+    result = set()
+    if len(snapnames) == 0:
+        return result
+    cmd = [zfs.ZFSCMD, "holds"] + snapnames
+    outdata,errdata = util.run_command(cmd)
+    for line in outdata.rstrip().split('\n'):
+        # The first line heading columns are  NAME TAG TIMESTAMP
+        line = line.split()
+        if len(line) >= 2 and line[0] != "NAME" and line[1] == tag:
+            result.add(line[0])
+    return result
+
+def list_bookmarks(datasets):
+    """
+    Returns the set of the names of the bookmarks of datasets, as
+    listed by a single zfs(1) invocation
+    """
+    if len(datasets) == 0:
+        return set()
+    # A dataset that has gone away has no bookmarks, so don't let
+    # zfs list fail over it.
+    cmd = [zfs.ZFSCMD, "list", "-H", "-o", "name", "-t", "bookmark",
+           "-d", "1"] + datasets
+    outdata,errdata = util.run_command(cmd, False)
+    return set(outdata.split())
+
+def release_holds(snapnames, tag, strict = False):
+    """
+    Releases the user hold called tag on each of the snapshots
+    snapnames, all at once where possible. Snapshots that no longer
+    exist are skipped. So are those that exist without the hold,
+    unless strict is True, in which case RuntimeError is raised.
+    """
+    if len(snapnames) == 0:
+        return
+    try:
+        zfs.get_backend().release(tag, snapnames)
+    except RuntimeError:
+        # Some of them weren't held after all. See to the others
+        # one at a time.
+        for snapname in snapnames:
+            try:
+                zfs.get_backend().release(tag, [snapname])
+            except RuntimeError:
+                if strict == True and snapshot_exists(snapname) == True:
+                    raise
+    finally:
+        # Releasing the last hold on a snapshot marked for deferred
+        # destruction destroys it, so the cached snapshots can't be
+        # trusted any more.
+        zfs.Datasets.snapshots.invalidate()
+
+def get_bookmark(snapname):
+    """
+    Returns the Bookmark named after the snapshot snapname
+    """
+    return zfs.Bookmark(snapname.replace('@', '#', 1))
+
+def get_replication_sets(inventory, snappeddatasets, previous):
+    """
+    Returns a dictionary mapping the recursive snapshot roots of the
+    inventory that can be sent as a single replication stream to the
+    datasets the stream brings up to date, the root first. That takes
+    every dataset below the root to have been snapshotted and to have
+    the same previously sent snapshot, if any, still around. The rest
+    of the datasets get sent one by one.
+    """
+    snapped = set(snappeddatasets)
+    recursive,single = inventory.classify()
+    result = {}
+    for root in recursive:
+        members = [name for name in inventory.names \
+                   if name == root or name.startswith(root + "/")]
+        if len([name for name in members if name not in snapped]) > 0:
+            continue
+        prevlabels = set()
+        for name in members:
+            prevsnapname = previous[name]
+            if prevsnapname != None:
+                prevsnapname = prevsnapname.split('@', 1)[1]
+            prevlabels.add(prevsnapname)
+        if len(prevlabels) != 1:
+            continue
+        if prevlabels != set([None]) and \
+           len([name for name in members \
+                if snapshot_exists(previous[name]) == False]) > 0:
+            continue
+        result[root] = members
+    return result
+
+def resume_stream(job, receiver, verbose):
+    """
+    Adds the stream to resume to job if the receiving side holds the
+    state of an interrupted stream of the dataset. Returns the name of
+    the snapshot the resumed stream brings the receiving side up to,
+    or None if there is nothing to resume.
+    """
+    token = receiver.get_resume_token(job.dataset)
+    if token == None:
+        return None
+    snapname = zfsreceiver.get_token_snapshot(token)
+    if snapname != None and snapname.split('@', 1)[0] == job.dataset and \
+       zfs.Snapshot(snapname).exists():
+        util.debug("Resuming the interrupted stream of %s" % (snapname),
+                   verbose)
+        job.add_stream([zfs.ZFSCMD, "send", "-P", "-t", token],
+                       snapname.split('@', 1)[1])
+        return snapname
+    # The stream can't be resumed, so start over.
+    log_error(syslog.LOG_WARNING,
+              "Discarding the interrupted stream of %s: the snapshot " \
+              "it was for is gone" % (job.dataset))
+    try:
+        receiver.abort_resume(job.dataset)
+    except RuntimeError as message:
+        log_error(syslog.LOG_ERR, str(message))
+    return None
 
 def maintenance(svcfmri):
     log_error(syslog.LOG_ERR,
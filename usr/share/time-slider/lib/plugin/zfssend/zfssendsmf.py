@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+
+from plugin import pluginsmf
+
+SENDPROPGROUP = "send"
+RECEIVEPROPGROUP = "receive"
+
+# Used when the instance doesn't define the send properties. One
+# stream at a time, since the receive command may not cope with more.
+DEFAULT_CONCURRENCY = 1
+DEFAULT_POOL_CONCURRENCY = 1
+
+# zfs send options that only change the form of the stream, and so
+# can be passed through to every send
+SENDOPTIONS = "cwLe"
+LONGSENDOPTIONS = {"--compressed" : "c", "--raw" : "w",
+                   "--large-block" : "L", "--embed" : "e"}
+
+class ZfsSendSMF(pluginsmf.PluginSMF):
+
+    def __init__(self, instanceName):
+        pluginsmf.PluginSMF.__init__(self, instanceName)
+
+    def get_receive_command(self):
+        value = self.get_prop(RECEIVEPROPGROUP, "command")
+        # Strip out '\' characters inserted by svcprop
+        return value.strip().replace('\\', '').split()
+
+    def get_resumable(self):
+        try:
+            value = self.get_prop(RECEIVEPROPGROUP, "resumable")
+        except RuntimeError:
+            return False
+        if value == "true":
+            return True
+        else:
+            return False
+
+    def get_recursive(self):
+        """
+        Whether to send recursively snapshotted trees of datasets as
+        single replication streams
+        """
+        try:
+            value = self.get_prop(SENDPROPGROUP, "recursive")
+        except RuntimeError:
+            return False
+        if value == "true":
+            return True
+        else:
+            return False
+
+    def get_bookmarks(self):
+        """
+        Whether to send incremental streams from bookmarks of the
+        previously sent snapshots rather than keep holds on them
+        """
+        try:
+            value = self.get_prop(SENDPROPGROUP, "bookmarks")
+        except RuntimeError:
+            return False
+        if value == "true":
+            return True
+        else:
+            return False
+
+    def get_concurrency(self):
+        """
+        Maximum number of send/receive pipelines run at the same time
+        """
+        try:
+            return int(self.get_prop(SENDPROPGROUP, "concurrency"))
+        except (RuntimeError, ValueError):
+            return DEFAULT_CONCURRENCY
+
+    def get_pool_concurrency(self):
+        """
+        Maximum number of send/receive pipelines run at the same time
+        for the datasets of any one zpool. 0 means no limit beyond
+        the overall one.
+        """
+        try:
+            return int(self.get_prop(SENDPROPGROUP, "pool_concurrency"))
+        except (RuntimeError, ValueError):
+            return DEFAULT_POOL_CONCURRENCY
+
+    def get_buffer_size(self):
+        """
+        Size in bytes of the buffer between each zfs send and zfs
+        receive. 0 means the two are connected by a plain pipe.
+        """
+        try:
+            megabytes = int(self.get_prop(SENDPROPGROUP, "buffer_size"))
+        except (RuntimeError, ValueError):
+            return 0
+        return max(megabytes, 0) * 1024 * 1024
+
+    def get_send_options(self):
+        """
+        Returns the list of extra zfs send options. Raises ValueError
+        for anything but the -c, -w, -L and -e options.
+        """
+        try:
+            value = self.get_prop(SENDPROPGROUP, "options")
+        except RuntimeError:
+            return []
+        result = []
+        for arg in value.strip().replace('\\', '').split():
+            if arg in LONGSENDOPTIONS:
+                flags = LONGSENDOPTIONS[arg]
+            elif arg.startswith("-") and not arg.startswith("--"):
+                flags = arg[1:]
+            else:
+                flags = ""
+            if len(flags) == 0 or \
+               len([f for f in flags if f not in SENDOPTIONS]) > 0:
+                raise ValueError("Unsupported zfs send option: %s" % arg)
+            for flag in flags:
+                if "-" + flag not in result:
+                    result.append("-" + flag)
+        return result
+
+    def __str__(self):
+        ret = "SMF Instance:\n" +\
+              "\tName:\t\t\t%s\n" % (self.instanceName) +\
+              "\tState:\t\t\t%s\n" % (self.svcstate) + \
+              "\tReceive command:\t%s\n" \
+              % " ".join(self.get_receive_command()) + \
+              "\tResumable:\t\t%s\n" % str(self.get_resumable()) + \
+              "\tConcurrency:\t\t%d\n" % self.get_concurrency() + \
+              "\tPool concurrency:\t%d\n" % self.get_pool_concurrency() + \
+              "\tBuffer size:\t\t%d\n" % self.get_buffer_size() + \
+              "\tRecursive:\t\t%s\n" % str(self.get_recursive()) + \
+              "\tBookmarks:\t\t%s" % str(self.get_bookmarks())
+        return ret
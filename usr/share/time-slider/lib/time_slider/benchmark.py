@@ -0,0 +1,306 @@
+#!/usr/bin/python3
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+"""
+Synthetic benchmarks for time-slider internals. None of these need
+access to real zpools: any zfs(1) output is generated in memory and
+fed straight into the parsing and classification code, or comes from
+the zfsemu emulator.
+
+Usage: python3 -m time_slider.benchmark [benchmark] [options]
+"""
+
+import sys
+import time
+import random
+import argparse
+
+from . import zfs
+from . import zfsemu
+from . import scheduler
+
+
+def synthetic_dataset_listing(count, tag = None, pools = 4, fanout = 8,
+                              excluded = 0.01, seed = 0):
+    """
+    Generates the output of the "zfs list" command issued by
+    zfs.AutoSnapshotInventory for a system with count datasets.
+
+    Keyword arguments:
+    count -- Total number of filesystems and volumes to generate
+    tag -- Schedule tag to emit override values for (default None)
+    pools -- Number of zpools the datasets are spread across (default 4)
+    fanout -- Maximum number of children per dataset (default 8)
+    excluded -- Fraction of datasets explicitly excluded (default 0.01)
+    seed -- Random seed, for reproducible listings (default 0)
+    """
+    rand = random.Random(seed)
+    names = ["pool%d" % i for i in range(pools)]
+    queue = names[:]
+    while len(names) < count:
+        parent = queue.pop(0)
+        for i in range(rand.randint(1, fanout)):
+            if len(names) >= count:
+                break
+            name = "%s/ds%d" % (parent, i)
+            names.append(name)
+            queue.append(name)
+    names.sort()
+
+    lines = []
+    for name in names:
+        # Pool roots are always tagged. Everything else mostly inherits.
+        general = "true"
+        if name.find('/') != -1 and rand.random() < excluded:
+            general = "false"
+        if tag == None:
+            lines.append("%s\t%s" % (name, general))
+        else:
+            override = "-"
+            if rand.random() < excluded:
+                override = "false"
+            lines.append("%s\t%s\t%s" % (name, general, override))
+    return "\n".join(lines) + "\n"
+
+
+def bench_inventory(args):
+    """
+    Times building an AutoSnapshotInventory from a synthetic
+    listing and classifying it into recursive and single sets.
+    """
+    outdata = synthetic_dataset_listing(args.datasets or 50000,
+                                        tag = "frequent",
+                                        seed = args.seed)
+    best = None
+    for i in range(args.repeat):
+        start = time.perf_counter()
+        inventory = zfs.AutoSnapshotInventory("frequent", outdata)
+        recursive,single = inventory.classify()
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    print("inventory: %d datasets, %d recursive roots, %d single, " \
+          "best of %d: %.3f s" \
+          % (len(inventory.names), len(recursive), len(single),
+             args.repeat, best))
+
+
+def synthetic_schedules(count, seed = 0):
+    """
+    Returns the default schedules plus count - 5 custom schedules with
+    a mix of minute, hour, day, week, month and cron intervals, as
+    [schedule, interval, period, keep] lists.
+    """
+    rand = random.Random(seed)
+    defaults = [["monthly", "months", 1, 12],
+                ["weekly", "days", 7, 4],
+                ["daily", "days", 1, 31],
+                ["hourly", "hours", 1, 24],
+                ["frequent", "minutes", 15, 4]]
+    customs = []
+    for i in range(max(count - len(defaults), 0)):
+        kind = rand.random()
+        if kind < 0.2:
+            details = ["hours", rand.randint(6, 24)]
+        elif kind < 0.7:
+            details = ["days", rand.randint(1, 7)]
+        elif kind < 0.9:
+            details = ["weeks", rand.randint(1, 4)]
+        elif kind < 0.95:
+            details = ["months", rand.randint(1, 3)]
+        else:
+            details = ["%d %d * * %d" % (rand.randint(0, 59),
+                                         rand.randint(0, 23),
+                                         rand.randint(0, 6)), 1]
+        customs.append(["tenant%d" % i] + details + [4])
+    return defaults,customs
+
+
+def bench_scheduler(args):
+    """
+    Times a simulated run of the snapshot scheduler: every schedule
+    fires whenever it is due, for the given number of days.
+    """
+    defaults,customs = synthetic_schedules(args.schedules, args.seed)
+    rand = random.Random(args.seed)
+    start = int(time.time())
+    sched = scheduler.Scheduler(defaults, customs)
+    for schedule,interval,period,keep in defaults + customs:
+        sched.last[schedule] = start - rand.randint(0, 7 * 24 * 3600)
+
+    begin = time.perf_counter()
+    sched.update()
+    now = start
+    end = start + args.days * 24 * 3600
+    firings = 0
+    while True:
+        due,schedule = sched.next_due(now)
+        if due == None or due > end:
+            break
+        now = max(now, due)
+        sched.fired(schedule, now)
+        firings += 1
+    elapsed = time.perf_counter() - begin
+    print("scheduler: %d schedules, %d days, %d firings, %.3f s, " \
+          "%.1f us per firing" \
+          % (len(defaults) + len(customs), args.days, firings, elapsed,
+             1000000.0 * elapsed / max(firings, 1)))
+
+
+def populate_emulator(emulator, clock, datasets, snapshots, seed = 0):
+    """
+    Fills emulator with datasets filesystems, laid out as by
+    synthetic_dataset_listing(), and takes recursive frequent
+    snapshots of every zpool every 15 minutes of emulated time until
+    there are about snapshots of them. Between snapshots, a tenth of
+    the filesystems get written to. Returns the dataset names.
+    """
+    rand = random.Random(seed)
+    names = []
+    for line in synthetic_dataset_listing(datasets, seed = seed).split('\n'):
+        line = line.split('\t')
+        if len(line) != 2:
+            continue
+        name,value = line
+        if name.find('/') == -1:
+            emulator.create_pool(name, 1 << 50)
+            emulator.create_dataset(name,
+                                    props = {"com.sun:auto-snapshot" : value})
+        elif value == "false":
+            emulator.create_dataset(name,
+                                    props = {"com.sun:auto-snapshot" : value})
+        else:
+            emulator.create_dataset(name)
+        names.append(name)
+    poolnames = list(emulator.pools.keys())
+    for idx in range(max(snapshots // len(names), 1)):
+        for name in rand.sample(names, len(names) // 10):
+            emulator.write(name, rand.randint(0, 64 << 20),
+                           rand.randint(0, 32 << 20))
+        clock.advance(15 * 60)
+        label = "zfs-auto-snap_frequent-%s" % \
+                time.strftime("%Y-%m-%d-%Hh%M", time.localtime(clock.time()))
+        for poolname in poolnames:
+            emulator.create_snapshots(["%s@%s" % (poolname, label)], True)
+    return names
+
+
+def bench_emulator(args):
+    """
+    Times the zfs module's listing, snapshotting, usage and destroy
+    operations against an emulated system with a large number of
+    datasets and snapshots.
+    """
+    clock = zfsemu.VirtualClock()
+    emulator = zfsemu.ZFSEmulator(clock.time, passthrough = False,
+                                  seed = args.seed)
+    rand = random.Random(args.seed)
+    start = time.perf_counter()
+    names = populate_emulator(emulator, clock, args.datasets or 100000,
+                              args.snapshots, args.seed)
+    print("emulator: %d datasets, %d snapshots, populated in %.3f s" \
+          % (len(names), emulator.get_snapshot_count(),
+             time.perf_counter() - start))
+
+    sample = rand.sample(names, min(len(names), 1000))
+    def rescan():
+        zfs.Datasets.snapshots.invalidate()
+        return len(zfs.Datasets().list_snapshots())
+    def inventory():
+        inventories = zfs.list_auto_snapshot_inventories(["frequent",
+                                                          "hourly"])
+        return len(inventories["frequent"].list_snapshotted())
+    def snapshot():
+        clock.advance(15 * 60)
+        label = "zfs-auto-snap_frequent-%s" % \
+                time.strftime("%Y-%m-%d-%Hh%M", time.localtime(clock.time()))
+        zfs.Datasets().create_auto_snapshot_set(label, tag = "frequent")
+        return emulator.get_snapshot_count()
+    def usage():
+        return sum([len(zfs.ReadWritableDataset(name).list_snapshot_usage()) \
+                    for name in sample])
+    def destroy():
+        doomed = []
+        for name in sample:
+            snaps = zfs.ReadWritableDataset(name).list_snapshots()
+            doomed.extend([snapname for snapname,ctime in snaps[:1]])
+        zfs.Datasets().destroy_snapshots(doomed)
+        return len(doomed)
+    def capacity():
+        return len(zfs.get_zpool_space(list(emulator.pools.keys())))
+
+    previous = zfsemu.install(emulator)
+    try:
+        for label,function in [("snapshot cache rescan", rescan),
+                               ("auto snapshot inventory", inventory),
+                               ("auto snapshot set", snapshot),
+                               ("usage of %d datasets" % len(sample), usage),
+                               ("destroy on %d datasets" % len(sample),
+                                destroy),
+                               ("zpool capacity", capacity)]:
+            emulator.reset_stats()
+            start = time.perf_counter()
+            count = function()
+            elapsed = time.perf_counter() - start
+            print("emulator: %s: %d items, %d commands, %.3f s" \
+                  % (label, count, sum(emulator.get_stats().values()),
+                     elapsed))
+    finally:
+        zfsemu.install(previous)
+
+
+benchmarks = {
+    "emulator" : bench_emulator,
+    "inventory" : bench_inventory,
+    "scheduler" : bench_scheduler,
+}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="time_slider.benchmark")
+    parser.add_argument("benchmark", nargs="*",
+                        help="Benchmarks to run, out of: %s (default all)" \
+                        % ", ".join(sorted(benchmarks.keys())))
+    parser.add_argument("--datasets", type=int, default=None,
+                        help="Number of synthetic datasets (default " \
+                        "50000, 100000 for the emulator)")
+    parser.add_argument("--snapshots", type=int, default=1000000,
+                        help="Number of emulated snapshots")
+    parser.add_argument("--schedules", type=int, default=5000,
+                        help="Number of snapshot schedules")
+    parser.add_argument("--days", type=int, default=365,
+                        help="Number of days to simulate")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of timed repetitions")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed for synthetic data")
+    args = parser.parse_args(argv)
+    for name in args.benchmark:
+        if name not in benchmarks:
+            parser.error("unknown benchmark: %s" % name)
+
+    for name in (args.benchmark or sorted(benchmarks.keys())):
+        benchmarks[name](args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
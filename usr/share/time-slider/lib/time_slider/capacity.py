@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+import threading
+import time
+import logging
+
+from . import zfs
+from . import util
+from . import tracing
+
+# Shortest and longest time between two samples, in seconds
+MIN_INTERVAL = 10
+MAX_INTERVAL = 15 * 60
+# Time to wait before sampling again after a failed sample
+RETRY_INTERVAL = 60
+# Keep alerting at this interval while a zpool stays above a threshold
+REALERT_INTERVAL = 15 * 60
+# Weight of the latest measurement in the moving average of fill rates
+RATE_WEIGHT = 0.5
+
+
+class PoolState:
+    """
+    What the CapacityMonitor knows about a zpool
+    """
+    def __init__(self, name):
+        self.name = name
+        self.sampled = None
+        self.used = 0
+        self.available = 0
+        # Moving average of the growth of "used", in bytes per second
+        self.rate = None
+        # Number of thresholds the zpool was above at the last alert
+        self.alerted = 0
+        self.alerttime = 0
+
+    def update(self, now, used, available):
+        if self.sampled != None and now > self.sampled:
+            rate = float(used - self.used) / (now - self.sampled)
+            if self.rate == None:
+                self.rate = rate
+            else:
+                self.rate = RATE_WEIGHT * rate + (1 - RATE_WEIGHT) * self.rate
+        self.sampled = now
+        self.used = used
+        self.available = available
+
+    def get_capacity(self):
+        return 100.0 * self.used / (self.used + self.available)
+
+    def get_eta(self, threshold):
+        """
+        Returns the predicted number of seconds until the zpool's
+        capacity exceeds threshold, or None if it isn't filling up.
+        """
+        if self.rate == None or self.rate <= 0:
+            return None
+        limit = (self.used + self.available) * threshold / 100.0
+        return max(limit - self.used, 0) / self.rate
+
+
+class CapacityMonitor(threading.Thread):
+    """
+    Samples the capacity of zpools in the background and calls back
+    as soon as one of them exceeds one of the cleanup thresholds.
+    Samples are taken more often the sooner the next threshold is
+    predicted to be crossed, based on the rate the zpool fills up,
+    so that a zpool filling up fast gets noticed in seconds while
+    idle zpools are only sampled every MAX_INTERVAL seconds.
+    """
+    def __init__(self, callback, verbose = False):
+        """
+        Keyword arguments:
+        callback -- Called with the name of the zpool that needs a
+                    cleanup, from the monitor's thread
+        verbose -- Log debugging information (default False)
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.callback = callback
+        self.verbose = verbose
+        self.logger = logging.getLogger('time-slider')
+        self._conditionLock = threading.Condition(threading.RLock())
+        self._pools = {}
+        self._thresholds = []
+        self._stale = False
+
+    def configure(self, poolnames, thresholds, verbose = False):
+        """
+        Sets the zpools to monitor and the capacity percentages to
+        alert on, and takes a fresh sample straight away.
+        """
+        self._conditionLock.acquire()
+        pools = {}
+        for name in poolnames:
+            if name in self._pools:
+                pools[name] = self._pools[name]
+            else:
+                pools[name] = PoolState(name)
+        self._pools = pools
+        self._thresholds = sorted(thresholds)
+        self.verbose = verbose
+        self._stale = True
+        self._conditionLock.notify()
+        self._conditionLock.release()
+
+    def get_samples(self):
+        """
+        Returns a dictionary of the latest (used, available) byte
+        counts of the monitored zpools that have been sampled.
+        """
+        self._conditionLock.acquire()
+        result = {}
+        for pool in self._pools.values():
+            if pool.sampled != None:
+                result[pool.name] = (pool.used, pool.available)
+        self._conditionLock.release()
+        return result
+
+    def run(self):
+        while True:
+            self._conditionLock.acquire()
+            self._stale = False
+            pools = list(self._pools.values())
+            thresholds = self._thresholds
+            self._conditionLock.release()
+
+            waittime = None
+            if len(pools) > 0 and len(thresholds) > 0:
+                waittime = self._sample(pools, thresholds)
+
+            self._conditionLock.acquire()
+            if self._stale == False:
+                self._conditionLock.wait(waittime)
+            self._conditionLock.release()
+
+    def _sample(self, pools, thresholds):
+        """
+        Samples all the zpools in one go, alerts on those that need
+        it and returns the number of seconds until the next sample.
+        """
+        try:
+            with tracing.caller("capacity"):
+                space = zfs.get_zpool_space([pool.name for pool in pools])
+        except RuntimeError as message:
+            self.logger.error("Failed to sample zpool capacity: %s" \
+                              % str(message))
+            return RETRY_INTERVAL
+        now = time.monotonic()
+        waittime = MAX_INTERVAL
+        for pool in pools:
+            if pool.name not in space:
+                continue
+            used,available = space[pool.name]
+            if used + available == 0:
+                continue
+            pool.update(now, used, available)
+            capacity = pool.get_capacity()
+            exceeded = len([t for t in thresholds if capacity > t])
+            if exceeded == 0:
+                pool.alerted = 0
+            elif exceeded > pool.alerted or \
+                 now - pool.alerttime >= REALERT_INTERVAL:
+                util.debug("%s is at %.1f%% capacity" \
+                           % (pool.name, capacity), \
+                           self.verbose)
+                pool.alerted = exceeded
+                pool.alerttime = now
+                self.callback(pool.name)
+
+            # Sample again well before the next threshold is reached.
+            # Once it's closer than MIN_INTERVAL, sample again right
+            # when it's predicted to be crossed. If that moment has
+            # already passed, the prediction was off, so don't keep
+            # sampling faster than MIN_INTERVAL.
+            interval = MAX_INTERVAL
+            if exceeded < len(thresholds):
+                eta = pool.get_eta(thresholds[exceeded])
+                if eta != None:
+                    if eta < 1:
+                        interval = MIN_INTERVAL
+                    elif eta < MIN_INTERVAL:
+                        interval = eta
+                    else:
+                        interval = min(max(eta / 4, MIN_INTERVAL),
+                                       MAX_INTERVAL)
+            if exceeded > 0:
+                interval = min(interval,
+                               REALERT_INTERVAL - (now - pool.alerttime))
+            waittime = min(waittime, interval)
+        return waittime
@@ -0,0 +1,311 @@
+#!/usr/bin/python3
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+"""
+On-disk catalog of all snapshots on the system, so that a process
+starting up can fill zfs.SnapshotCache from it rather than enumerating
+every snapshot of every zpool with zfs(1).
+
+time-sliderd keeps the catalog up to date as it creates and destroys
+snapshots, and rewrites it whenever the snapshot cache does a full
+rescan. Other processes only read it.
+
+Before the catalog is trusted it is checked against the zpools: the
+same zpools must be imported, their top-level datasets must have the
+same guids, and, where zfs(1) reports a snapshot_count (which it only
+does once a snapshot_limit is set), the number of snapshots of each
+zpool must match. A catalog that can't be checked by snapshot count is
+only trusted for as long as the snapshot cache would trust its own
+contents, counting from the catalog's last full rescan.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+from . import zfs
+from . import util
+
+CATALOG_PATH = "/var/cache/time-slider/snapshots.db"
+SCHEMA_VERSION = "2"
+
+# Queued updates are written out once there are this many of them,
+# or on flush()
+FLUSH_SIZE = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS pools (
+    name TEXT PRIMARY KEY,
+    guid TEXT
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    name TEXT PRIMARY KEY,
+    pool TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    schedule TEXT,
+    creation INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS snapshots_pool ON snapshots (pool);
+"""
+
+
+def get_pool_tokens():
+    """
+    Returns a dictionary mapping the names of the imported zpools to
+    tuples of the guid of their top-level dataset and their snapshot
+    count, or None where zfs(1) doesn't keep count. Takes two
+    commands whatever the number of zpools and snapshots.
+    """
+    poolnames = zfs.list_zpools()
+    result = {}
+    if len(poolnames) == 0:
+        return result
+    cmd = [zfs.ZFSCMD, "get", "-H", "-p", "-o", "name,property,value",
+           "guid,snapshot_count"] + poolnames
+    outdata,errdata = util.run_command(cmd)
+    values = {}
+    for line in outdata.rstrip().split('\n'):
+        try:
+            name,prop,value = line.split('\t')
+        except ValueError:
+            continue
+        values[(name, prop)] = value
+    for name in poolnames:
+        count = None
+        try:
+            count = int(values.get((name, "snapshot_count")))
+        except (TypeError, ValueError):
+            pass
+        result[name] = (values.get((name, "guid")), count)
+    return result
+
+
+class SnapshotCatalog:
+    """
+    SQLite database of snapshot names, datasets, schedules, creation
+    times. Updates are queued and written out in batches.
+    """
+    def __init__(self, path = CATALOG_PATH, readonly = False):
+        """
+        Raises sqlite3.Error or OSError if the catalog can't be opened,
+        or doesn't exist when opened read only.
+        """
+        self.path = path
+        self.readonly = readonly
+        self.logger = logging.getLogger('time-slider')
+        self._lock = threading.Lock()
+        self._pending = []
+        if readonly == True:
+            uri = "file:%s?mode=ro" % path
+            self._db = sqlite3.connect(uri, uri=True,
+                                       check_same_thread=False)
+        else:
+            dirname = os.path.dirname(path)
+            if len(dirname) > 0 and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(_SCHEMA)
+            if self.__get_meta("version") != SCHEMA_VERSION:
+                self._db.executescript("DROP TABLE snapshots; "
+                                       "DROP TABLE pools; "
+                                       "DELETE FROM meta;")
+                self._db.executescript(_SCHEMA)
+                self.__set_meta("version", SCHEMA_VERSION)
+            self._db.commit()
+
+    def __get_meta(self, key):
+        try:
+            row = self._db.execute("SELECT value FROM meta WHERE key = ?",
+                                   (key,)).fetchone()
+        except sqlite3.OperationalError:
+            # No schema yet
+            return None
+        if row == None:
+            return None
+        return row[0]
+
+    def __set_meta(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                         (key, str(value)))
+
+    def load(self, ttl = zfs.SNAPSHOT_CACHE_TTL):
+        """
+        Returns the sorted list of (creation, name) tuples of all the
+        snapshots in the catalog, and the time they can be considered
+        to have been checked against the zpools, if the catalog is
+        still valid. Returns None otherwise.
+        """
+        tokens = get_pool_tokens()
+        self._lock.acquire()
+        try:
+            self.__flush()
+            if self.__get_meta("version") != SCHEMA_VERSION:
+                return None
+            scanned = self.__get_meta("scanned")
+            if scanned == None:
+                return None
+            guids = dict(self._db.execute("SELECT name, guid FROM pools"))
+            if guids != dict([(name, guid) for name,(guid,count) \
+                              in tokens.items()]):
+                util.debug("Snapshot catalog is for different zpools",
+                           True)
+                return None
+            counts = dict(self._db.execute("SELECT pool, count(*) " \
+                                           "FROM snapshots GROUP BY pool"))
+            verified = True
+            for name,(guid,count) in tokens.items():
+                if count == None:
+                    verified = False
+                elif count != counts.get(name, 0):
+                    util.debug("Snapshot catalog is out of date for %s" \
+                               % name, True)
+                    return None
+            checked = time.time()
+            if verified == False:
+                checked = float(scanned)
+                if time.time() - checked > ttl:
+                    util.debug("Snapshot catalog is too old to trust", True)
+                    return None
+            snaps = self._db.execute("SELECT creation, name FROM snapshots " \
+                                     "ORDER BY creation, name").fetchall()
+            return snaps,checked
+        except sqlite3.Error as message:
+            self.logger.error("Failed to read the snapshot catalog %s: %s" \
+                              % (self.path, str(message)))
+            return None
+        finally:
+            self._lock.release()
+
+    def replace(self, snaps):
+        """
+        Replaces the contents of the catalog with snaps, the result of a
+        full scan as a sorted list of (creation, name) tuples.
+        """
+        if self.readonly == True:
+            return
+        tokens = get_pool_tokens()
+        rows = []
+        for creation,name in snaps:
+            pool,dataset,schedule = zfs.split_snapshot_name(name)
+            rows.append((name, pool, dataset, schedule, creation))
+        self._lock.acquire()
+        try:
+            self._pending = []
+            self._db.execute("CREATE TEMP TABLE IF NOT EXISTS scan " \
+                             "(name TEXT PRIMARY KEY, pool TEXT, " \
+                             "dataset TEXT, schedule TEXT, creation INTEGER)")
+            self._db.execute("DELETE FROM scan")
+            self._db.executemany("INSERT OR IGNORE INTO scan " \
+                                 "VALUES (?, ?, ?, ?, ?)", rows)
+            self._db.execute("DELETE FROM snapshots WHERE name NOT IN " \
+                             "(SELECT name FROM scan)")
+            self._db.execute("INSERT OR IGNORE INTO snapshots " \
+                             "(name, pool, dataset, schedule, creation) " \
+                             "SELECT * FROM scan")
+            self._db.execute("DELETE FROM scan")
+            self._db.execute("DELETE FROM pools")
+            self._db.executemany("INSERT INTO pools VALUES (?, ?)",
+                                 [(name, guid) for name,(guid,count) \
+                                  in tokens.items()])
+            self.__set_meta("scanned", time.time())
+            self._db.commit()
+        except sqlite3.Error as message:
+            self._db.rollback()
+            self.logger.error("Failed to update the snapshot catalog " \
+                              "%s: %s" % (self.path, str(message)))
+        finally:
+            self._lock.release()
+
+    def add(self, name, creation):
+        pool,dataset,schedule = zfs.split_snapshot_name(name)
+        self.__queue("INSERT OR REPLACE INTO snapshots " \
+                     "(name, pool, dataset, schedule, creation) " \
+                     "VALUES (?, ?, ?, ?, ?)",
+                     (name, pool, dataset, schedule, creation))
+
+    def remove(self, name):
+        self.__queue("DELETE FROM snapshots WHERE name = ?", (name,))
+
+    def __queue(self, statement, params):
+        if self.readonly == True:
+            return
+        self._lock.acquire()
+        self._pending.append((statement, params))
+        if len(self._pending) >= FLUSH_SIZE:
+            self.__flush()
+        self._lock.release()
+
+    def flush(self):
+        """
+        Writes out the queued updates
+        """
+        self._lock.acquire()
+        self.__flush()
+        self._lock.release()
+
+    def __flush(self):
+        if len(self._pending) == 0:
+            return
+        pending = self._pending
+        self._pending = []
+        try:
+            for statement,params in pending:
+                self._db.execute(statement, params)
+            self._db.commit()
+        except sqlite3.Error as message:
+            self._db.rollback()
+            self.logger.error("Failed to update the snapshot catalog " \
+                              "%s: %s" % (self.path, str(message)))
+            # Make sure the catalog doesn't get trusted as it is.
+            try:
+                self._db.execute("DELETE FROM meta WHERE key = 'scanned'")
+                self._db.commit()
+            except sqlite3.Error as message:
+                self.logger.error("Failed to invalidate the snapshot " \
+                                  "catalog %s: %s" % \
+                                  (self.path, str(message)))
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+def open_catalog(path = CATALOG_PATH, readonly = True):
+    """
+    Returns the SnapshotCatalog at path, or None if it can't be opened
+    """
+    if readonly == True and not os.path.exists(path):
+        return None
+    try:
+        return SnapshotCatalog(path, readonly)
+    except (sqlite3.Error, OSError) as message:
+        logging.getLogger('time-slider').error( \
+            "Can't open the snapshot catalog %s: %s" % (path, str(message)))
+        return None
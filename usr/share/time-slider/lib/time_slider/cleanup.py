@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+from . import zfs
+
+
+class CleanupPlan:
+    """
+    The snapshots to destroy in order to bring the capacity of a
+    zpool back under a threshold, as worked out by CleanupPlanner.
+    """
+    def __init__(self, zpool, threshold, used, available):
+        self.zpool = zpool
+        self.threshold = threshold
+        self.used = used
+        self.available = available
+        # Number of bytes that need to be freed
+        self.needed = used - int((used + available) * threshold / 100.0)
+        # Snapshots to destroy, oldest first
+        self.snapshots = []
+        # Estimated number of bytes destroying the snapshots frees
+        self.estimate = 0
+        # True if destroying all candidate snapshots is still not
+        # expected to be enough.
+        self.exhausted = False
+
+    def __str__(self):
+        capacity = 100.0 * self.used / (self.used + self.available)
+        return_string = "Cleanup plan for %s: %.1f%% used, threshold %d%%" \
+                        % (self.zpool.name, capacity, self.threshold)
+        return_string = return_string + \
+                        "\n\tBytes to free: %d" % max(self.needed, 0)
+        return_string = return_string + \
+                        "\n\tEstimated bytes freed: %d" % self.estimate
+        if self.exhausted == True:
+            return_string = return_string + \
+                            "\n\tNot enough snapshots to reach threshold"
+        for name in self.snapshots:
+            return_string = return_string + "\n\tDestroy: " + name
+        return return_string
+
+
+class CleanupPlanner:
+    """
+    Works out the smallest number of snapshots, taken oldest first,
+    that need to be destroyed to bring a zpool's capacity below a
+    threshold. Uses the "used" property of the snapshots as a lower
+    bound of the space reclaimed and "zfs destroy -n" dry runs for the
+    exact figure, instead of destroying one snapshot at a time and
+    checking the capacity in between.
+    """
+    def __init__(self, zpool, datasets = None):
+        self.zpool = zpool
+        if datasets == None:
+            datasets = zfs.Datasets()
+        self.datasets = datasets
+        self.__reclaimcache = {}
+
+    def plan(self, snapshots, threshold):
+        """
+        Returns a CleanupPlan for the zpool.
+
+        Keyword arguments:
+        snapshots -- Candidate snapshot names, oldest first
+        threshold -- Capacity percentage to get the zpool below
+        """
+        used,available = self.zpool.get_space()
+        plan = CleanupPlan(self.zpool, threshold, used, available)
+        if plan.needed <= 0:
+            return plan
+
+        # Snapshots with user holds only get marked for deferred
+        # destruction, so destroying them doesn't free anything.
+        usage = self.zpool.list_snapshot_usage()
+        candidates = [name for name in snapshots \
+                      if name in usage and usage[name][1] == 0]
+        if len(candidates) == 0:
+            plan.exhausted = True
+            return plan
+
+        # A snapshot's used size only counts space unique to it, so the
+        # sum for a set of snapshots is a lower bound of what destroying
+        # the set frees. That gives an upper bound for the search.
+        self.__reclaimcache = {}
+        upper = len(candidates)
+        total = 0
+        for idx in range(len(candidates)):
+            total += usage[candidates[idx]][0]
+            if total >= plan.needed:
+                upper = idx + 1
+                break
+        estimates = {upper : total}
+        if total < plan.needed:
+            estimates[upper] = self.__reclaim(candidates[:upper])
+            if estimates[upper] < plan.needed:
+                plan.snapshots = candidates
+                plan.estimate = estimates[upper]
+                plan.exhausted = True
+                return plan
+
+        # Space reclaimed only grows as more snapshots are added to the
+        # set, so binary search for the shortest sufficient prefix.
+        lower = 1
+        while lower < upper:
+            middle = (lower + upper) // 2
+            estimates[middle] = self.__reclaim(candidates[:middle])
+            if estimates[middle] >= plan.needed:
+                upper = middle
+            else:
+                lower = middle + 1
+        plan.snapshots = candidates[:upper]
+        plan.estimate = estimates[upper]
+        return plan
+
+    def __reclaim(self, names):
+        """
+        Dry run estimate of the space freed by destroying names, a
+        prefix of the candidate list. Results are cached per dataset
+        since successive prefixes often only differ in a few datasets.
+        """
+        groups = {}
+        for name in names:
+            fsname = name.split('@', 1)[0]
+            groups.setdefault(fsname, []).append(name)
+        result = 0
+        for fsname,group in groups.items():
+            key = (fsname, len(group))
+            if key not in self.__reclaimcache:
+                self.__reclaimcache[key] = \
+                    self.datasets.get_reclaim_size(group)
+            result += self.__reclaimcache[key]
+        return result
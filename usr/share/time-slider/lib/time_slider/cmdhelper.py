@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+"""
+Long lived helper processes that run commands on behalf of
+util.run_command(). Forking a large, threaded daemon for every zfs(1)
+invocation is expensive, so instead a few small helpers are started
+once and each one forks the commands it is asked to run.
+
+Requests and replies are exchanged as one line of JSON each over the
+helper's stdin and stdout. This file is executed directly as the
+helper, so it must only depend on the standard library.
+"""
+
+import os
+import sys
+import json
+import subprocess
+import threading
+
+
+class CommandHelper:
+    """
+    A single helper process. Runs one command at a time.
+    """
+    def __init__(self):
+        self.process = subprocess.Popen([sys.executable,
+                                         os.path.abspath(__file__)],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        close_fds=True)
+
+    def run(self, command):
+        """
+        Runs command in the helper. Returns a tuple of standard out,
+        standard error and exit status. Raises OSError if the command
+        could not be executed or the helper died.
+        """
+        request = json.dumps({"argv" : list(command)}) + "\n"
+        try:
+            self.process.stdin.write(request.encode('utf-8'))
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        except (IOError, ValueError) as message:
+            raise OSError("Command helper %d failed: %s" \
+                          % (self.process.pid, str(message)))
+        if len(line) == 0:
+            raise OSError("Command helper %d exited unexpectedly" \
+                          % (self.process.pid))
+        reply = json.loads(line.decode('utf-8'))
+        if "error" in reply:
+            raise OSError(reply["error"])
+        return reply["out"],reply["err"],reply["status"]
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.process.wait()
+
+
+class CommandHelperPool:
+    """
+    A fixed size pool of CommandHelper processes, shared by all
+    threads. Callers block until a helper becomes idle.
+    """
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError("Command helper pool size must be at least 1")
+        self.size = size
+        self._conditionLock = threading.Condition(threading.Lock())
+        self._idle = []
+        self._count = 0
+        self._closed = False
+        # Start all helpers up front, while the caller is still small.
+        try:
+            for i in range(size):
+                self._idle.append(CommandHelper())
+                self._count += 1
+        except OSError:
+            self.close()
+            raise
+
+    def run(self, command):
+        """
+        Runs command in an idle helper. Returns a tuple of standard
+        out, standard error and exit status.
+        """
+        helper = self.__get()
+        try:
+            result = helper.run(command)
+        except OSError:
+            if helper.process.poll() == None:
+                # The helper is fine, the command just couldn't be run.
+                self.__put(helper)
+            else:
+                self.__discard(helper)
+            raise
+        self.__put(helper)
+        return result
+
+    def close(self):
+        """
+        Stops the idle helpers. Busy ones are stopped when they
+        become idle.
+        """
+        self._conditionLock.acquire()
+        self._closed = True
+        idle = self._idle
+        self._idle = []
+        self._count -= len(idle)
+        self._conditionLock.release()
+        for helper in idle:
+            helper.close()
+
+    def __get(self):
+        self._conditionLock.acquire()
+        try:
+            while len(self._idle) == 0:
+                if self._closed == True:
+                    raise OSError("Command helper pool is closed")
+                if self._count < self.size:
+                    # Replace a helper that died.
+                    self._count += 1
+                    try:
+                        return CommandHelper()
+                    except OSError:
+                        self._count -= 1
+                        raise
+                self._conditionLock.wait()
+            return self._idle.pop()
+        finally:
+            self._conditionLock.release()
+
+    def __put(self, helper):
+        self._conditionLock.acquire()
+        if self._closed == True:
+            self._count -= 1
+            self._conditionLock.release()
+            helper.close()
+            return
+        self._idle.append(helper)
+        self._conditionLock.notify()
+        self._conditionLock.release()
+
+    def __discard(self, helper):
+        self._conditionLock.acquire()
+        self._count -= 1
+        self._conditionLock.notify()
+        self._conditionLock.release()
+        helper.close()
+
+
+def serve(infile, outfile):
+    """
+    The helper's main loop. Runs the commands read from infile
+    until it is closed.
+    """
+    for line in infile:
+        request = json.loads(line.decode('utf-8'))
+        try:
+            p = subprocess.Popen(request["argv"],
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 close_fds=True)
+            outdata,errdata = p.communicate()
+            reply = {"out" : outdata.decode('utf-8', 'surrogateescape'),
+                     "err" : errdata.decode('utf-8', 'surrogateescape'),
+                     "status" : p.wait()}
+        except OSError as message:
+            reply = {"error" : str(message)}
+        outfile.write((json.dumps(reply) + "\n").encode('utf-8'))
+        outfile.flush()
+
+
+if __name__ == "__main__":
+    serve(sys.stdin.buffer, sys.stdout.buffer)
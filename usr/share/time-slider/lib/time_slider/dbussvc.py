@@ -26,6 +26,15 @@ import dbus.service
 import dbus.mainloop
 import dbus.mainloop.glib
 
+BUSNAME = "org.opensolaris.TimeSlider"
+AUTOSNAPPATH = "/org/opensolaris/TimeSlider/autosnap"
+AUTOSNAPIFACE = "org.opensolaris.TimeSlider.autosnap"
+
+# Most snapshots returned by one list_snapshots() call
+MAX_PAGE = 10000
+# Times fetch_snapshots() starts over when snapshots change under it
+FETCH_RETRIES = 3
+
 
 class AutoSnap(dbus.service.Object):
     """
@@ -44,6 +53,94 @@ class AutoSnap(dbus.service.Object):
     def capacity_exceeded(self, pool, severity, threshhold):
         pass
 
+    # Snapshot queries, answered from the daemon's snapshot cache.
+    # Empty filter strings match everything. Returns up to limit
+    # (name, creation) pairs from offset on, oldest first, followed by
+    # the total number of matches and the serial number of the cache
+    # contents, which changes whenever snapshots come or go.
+    @dbus.service.method(dbus_interface="org.opensolaris.TimeSlider.autosnap",
+                         in_signature='sssuu', out_signature='a(st)ut')
+    def list_snapshots(self, pool, dataset, schedule, offset, limit):
+        if limit == 0 or limit > MAX_PAGE:
+            limit = MAX_PAGE
+        page,total,serial = \
+            self.snapshotmanager.query_snapshots(str(pool) or None,
+                                                 str(dataset) or None,
+                                                 str(schedule) or None,
+                                                 int(offset), int(limit))
+        return [(name, creation) for name,creation in page],total,serial
+
+    # Filesystems and volumes the schedule takes snapshots of
+    @dbus.service.method(dbus_interface="org.opensolaris.TimeSlider.autosnap",
+                         in_signature='s', out_signature='as')
+    def list_auto_snapshot_sets(self, schedule):
+        return self.snapshotmanager.query_auto_snapshot_sets(str(schedule))
+
+    # (name, used bytes, available bytes, capacity percentage) of
+    # each zpool
+    @dbus.service.method(dbus_interface="org.opensolaris.TimeSlider.autosnap",
+                         in_signature='', out_signature='a(sttd)')
+    def get_pool_capacity(self):
+        result = []
+        space = self.snapshotmanager.query_pool_capacity()
+        for name in sorted(space.keys()):
+            used,available = space[name]
+            capacity = 0.0
+            if used + available > 0:
+                capacity = 100.0 * used / (used + available)
+            result.append((name, used, available, capacity))
+        return result
+
+    # Tells the daemon that snapshots were created or destroyed behind
+    # its back, so that its snapshot cache gets rescanned. The rescan
+    # happens in the background, at most once a minute.
+    @dbus.service.method(dbus_interface="org.opensolaris.TimeSlider.autosnap",
+                         in_signature='', out_signature='')
+    def refresh_snapshots(self):
+        self.snapshotmanager.refresh_snapshots()
+
+
+def refresh_snapshots(bus):
+    """
+    Calls the running daemon's refresh_snapshots() method. Raises
+    dbus.DBusException if the daemon can't be reached.
+    """
+    remote = bus.get_object(BUSNAME, AUTOSNAPPATH)
+    dbus.Interface(remote, AUTOSNAPIFACE).refresh_snapshots()
+
+def fetch_snapshots(bus, pool = None, dataset = None, schedule = None):
+    """
+    Returns all the snapshots matching the filters as a list of
+    [name, creation] pairs, oldest first, by paging through the
+    running daemon's list_snapshots() method. Raises
+    dbus.DBusException if the daemon can't be reached, or if the
+    snapshots keep changing while the pages are fetched.
+    """
+    remote = bus.get_object(BUSNAME, AUTOSNAPPATH)
+    iface = dbus.Interface(remote, AUTOSNAPIFACE)
+    for attempt in range(FETCH_RETRIES):
+        result = []
+        first = None
+        while True:
+            page,total,serial = iface.list_snapshots(pool or "",
+                                                     dataset or "",
+                                                     schedule or "",
+                                                     len(result), MAX_PAGE)
+            if first == None:
+                first = serial
+            elif serial != first:
+                # Snapshots came or went in between pages. Start over.
+                break
+            result.extend([[str(name), int(creation)] \
+                           for name,creation in page])
+            if len(page) == 0 or len(result) >= total:
+                return result
+    # Snapshots kept changing. A partial list mustn't pass for the
+    # whole.
+    raise dbus.DBusException("Snapshots kept changing while listing " \
+                             "them. Giving up after %d attempts" \
+                             % FETCH_RETRIES)
+
 class RsyncBackup(dbus.service.Object):
     """
     D-Bus object for Time Slider's rsync backup feature.
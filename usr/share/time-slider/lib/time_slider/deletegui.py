@@ -28,6 +28,7 @@ import getopt
 import locale
 import shutil
 import fcntl
+import dbus
 from bisect import insort
 
 try:
@@ -74,6 +75,8 @@ gtk.glade.bindtextdomain(GETTEXT_DOMAIN, LOCALE_PATH)
 gtk.glade.textdomain(GETTEXT_DOMAIN)
 
 from . import zfs
+from . import dbussvc
+from . import catalog
 from .rbac import RBACprofile
 
 class RsyncBackup:
@@ -676,15 +679,19 @@ class ScanSnapshots(threading.Thread):
         return result
 
     def rescan(self):
-        cloned = self.datasets.list_cloned_snapshots()
+        cloned = set(self.datasets.list_cloned_snapshots())
         self.snapshots = []
-        snaplist = self.datasets.list_snapshots()
+        # Ask time-sliderd, which has all the snapshots at hand, before
+        # resorting to listing them all with zfs(1).
+        try:
+            snaplist = dbussvc.fetch_snapshots(dbus.SystemBus())
+        except dbus.DBusException:
+            zfs.Datasets.snapshots.attach_catalog(catalog.open_catalog())
+            snaplist = self.datasets.list_snapshots()
         for snapname,snaptime in snaplist:
             # Filter out snapshots that are the root
             # of cloned filesystems or volumes
-            try:
-                cloned.index(snapname)
-            except ValueError:
+            if snapname not in cloned:
                 snapshot = zfs.Snapshot(snapname, snaptime)
                 self.snapshots.append(snapshot)
 
@@ -714,6 +721,11 @@ class DeleteSnapshots(threading.Thread):
                     self.errors.append(str(inst))
             deleted += 1
             self.progress = deleted / (total * 1.0)
+        # Let time-sliderd know its snapshot list is out of date.
+        try:
+            dbussvc.refresh_snapshots(dbus.SystemBus())
+        except dbus.DBusException:
+            pass
         self.completed = True
 
 def main(argv):
@@ -21,7 +21,13 @@
 #
 
 import configparser
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
 import sys
+import threading
 import time_slider.util as util
 
 # Default config file name position
@@ -33,8 +39,18 @@ default_properties = {
         'zpool/emergency-level': 95,
         'zpool/critical-level': 90,
         'zpool/warning-level': 80,
+        'zpool/cleanup-plan-only': 'false',
         'zfs/sep': '_',
+        'zfs/batch-snapshots': 'false',
+        'zfs/skip-unchanged': 'false',
         'daemon/verbose': 'true',
+        'daemon/command-helpers': 0,
+        'daemon/zfs-backend': 'auto',
+        'daemon/metrics-port': 0,
+        'daemon/metrics-textfile': '',
+        'daemon/trace-buffer': 1000,
+        'daemon/slow-command-threshold': 10000,
+        'daemon/snapshot-catalog': '/var/cache/time-slider/snapshots.db',
         'state': 'online',
     },
     'system/filesystem/zfs/auto-snapshot:monthly': {
@@ -79,22 +95,207 @@ class MyConfigParser(configparser.ConfigParser):
             for k,v in content.items():
                 self.set(section, k, str(v))
 
+class ParsedConfig:
+    """
+    The configuration file as parsed at one point in time, along with
+    all of its values for quick lookups.
+    """
+    def __init__(self, path):
+        # Taken before reading, so that a change while reading makes
+        # the result look stale rather than current.
+        self.path = path
+        self.stamp = _get_stamp(path)
+        self.parser = MyConfigParser()
+        self.parser.read(path)
+        self.values = {}
+        for section in self.parser.sections():
+            values = {}
+            for option in self.parser.options(section):
+                try:
+                    values[option] = self.parser.get(section, option)
+                except configparser.Error:
+                    # Left for Config.get() to report.
+                    pass
+            self.values[section] = values
+
+def _get_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+# The process wide parsed configuration, shared by all Config objects.
+# Reparsed when configfile changes, as noticed by the ConfigWatcher if
+# one is running, or by checking the file's stat() details otherwise.
+_parsed = None
+_parsedLock = threading.Lock()
+_watcher = None
+
+def get_parsed():
+    """
+    Returns the ParsedConfig of the current configfile, parsing it
+    only if it changed since the last time.
+    """
+    global _parsed
+    _parsedLock.acquire()
+    try:
+        parsed = _parsed
+        if parsed == None or parsed.path != configfile:
+            parsed = None
+        elif _watcher == None or _watcher.path != configfile:
+            if _get_stamp(configfile) != parsed.stamp:
+                parsed = None
+        if parsed == None:
+            parsed = ParsedConfig(configfile)
+            _parsed = parsed
+        return parsed
+    finally:
+        _parsedLock.release()
+
+def invalidate():
+    """
+    Makes the next Config() parse the configuration file again
+    """
+    global _parsed
+    _parsedLock.acquire()
+    _parsed = None
+    _parsedLock.release()
+
 class Config:
     def __init__(self):
-        self.config = MyConfigParser()
-        self.config.read(configfile)
+        parsed = get_parsed()
+        self.config = parsed.parser
+        self.values = parsed.values
 
     def get(self, section, option):
         try:
-            result = self.config.get(section, option)
-            util.debug('CONFIG: GET section %s, option %s with value %s\n' % (section, option, result), 1)
-            return result
-        except (configparser.NoOptionError, configparser.NoSectionError):
-            util.debug('CONFIG: NOTFOUND section %s, option %s\n' % (section, option), 1)
-            return ''
+            result = self.values[section][option.lower()]
+        except KeyError:
+            try:
+                result = self.config.get(section, option)
+            except (configparser.NoOptionError, configparser.NoSectionError):
+                util.debug('CONFIG: NOTFOUND section %s, option %s\n' % (section, option), 1)
+                return ''
+        util.debug('CONFIG: GET section %s, option %s with value %s\n' % (section, option, result), 1)
+        return result
 
     def sections(self):
         return self.config.sections()
 
+
+# inotify(7) event masks
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_IGNORED = 0x00008000
+_IN_CLOEXEC = 0o2000000
+_EVENT = struct.Struct("iIII")
+
+class ConfigWatcher(threading.Thread):
+    """
+    Watches configfile for changes with inotify(7). On a change, drops
+    the parsed configuration and calls callback with no arguments,
+    from the watcher's thread. The directory holding the file is
+    watched rather than the file itself so that files replaced by
+    renaming a new one over them, the way editors save, keep being
+    watched.
+    """
+    def __init__(self, callback, path = None):
+        """
+        Raises OSError if inotify is not available or the directory
+        can't be watched.
+        """
+        threading.Thread.__init__(self, name="config-watcher")
+        self.daemon = True
+        if path == None:
+            path = configfile
+        self.path = path
+        self.callback = callback
+        self.logger = logging.getLogger('time-slider')
+        self._dirname,self._basename = os.path.split(os.path.abspath(path))
+        self._basename = os.fsencode(self._basename)
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        try:
+            init = libc.inotify_init1
+            addwatch = libc.inotify_add_watch
+        except AttributeError:
+            raise OSError("inotify is not supported")
+        self._fd = init(_IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        mask = _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | \
+               _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | \
+               _IN_DELETE_SELF | _IN_MOVE_SELF
+        if addwatch(self._fd, os.fsencode(self._dirname), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, "%s: %s" \
+                          % (self._dirname, os.strerror(errno)))
+
+    def run(self):
+        while True:
+            try:
+                data = os.read(self._fd, 4096)
+            except OSError as message:
+                self.logger.error("Stopped watching %s: %s" \
+                                  % (self.path, str(message)))
+                break
+            changed = False
+            gone = False
+            offset = 0
+            while offset + _EVENT.size <= len(data):
+                wd,mask,cookie,length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & (_IN_DELETE_SELF | _IN_MOVE_SELF | _IN_IGNORED):
+                    # The directory itself went away
+                    changed = True
+                    gone = True
+                elif name == self._basename:
+                    changed = True
+            if changed == True:
+                invalidate()
+                self.callback()
+            if gone == True:
+                self.logger.error("Stopped watching %s: %s went away" \
+                                  % (self.path, self._dirname))
+                break
+        os.close(self._fd)
+        stop_watching(self)
+
+def watch(callback):
+    """
+    Starts a ConfigWatcher on configfile, which calls callback on
+    every change, and returns it. Raises OSError if the file can't be
+    watched, in which case changes are still noticed by Config(), just
+    not announced.
+    """
+    global _watcher
+    watcher = ConfigWatcher(callback)
+    _parsedLock.acquire()
+    _watcher = watcher
+    _parsedLock.release()
+    watcher.start()
+    return watcher
+
+def stop_watching(watcher):
+    """
+    Goes back to checking the configuration file for changes on every
+    Config() if watcher is the one in use.
+    """
+    global _watcher
+    _parsedLock.acquire()
+    if _watcher == watcher:
+        _watcher = None
+    _parsedLock.release()
+
 def configdump():
     MyConfigParser().write(sys.stdout)
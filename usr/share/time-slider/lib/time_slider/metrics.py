@@ -0,0 +1,333 @@
+#!/usr/bin/python3
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+"""
+Counters, gauges and histograms of what the daemon does, in the
+Prometheus text exposition format. They are served over HTTP on the
+local host by a MetricsServer and/or written out periodically for the
+node_exporter textfile collector by a TextfileWriter.
+"""
+
+import os
+import threading
+import http.server
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+LONG_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+# Seconds between two writes of the textfile
+TEXTFILE_INTERVAL = 60
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n") \
+                     .replace("\"", "\\\"")
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value == int(value):
+        return str(int(value))
+    return repr(value)
+
+def _format_labels(names, values, extra = None):
+    pairs = ["%s=\"%s\"" % (n, _escape(v)) for n,v in zip(names, values)]
+    if extra != None:
+        pairs.append("%s=\"%s\"" % extra)
+    if len(pairs) == 0:
+        return ""
+    return "{%s}" % ",".join(pairs)
+
+
+class Metric:
+    """
+    Base class of the metric types. A metric has one value (or set of
+    values for histograms) per combination of label values.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames = (),
+                 registry = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        if registry == None:
+            registry = REGISTRY
+        registry.register(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError("%s takes the labels %s" \
+                             % (self.name, ", ".join(self.labelnames)))
+        return tuple([str(l) for l in labels])
+
+    def _new_value(self):
+        return 0
+
+    def _samples(self, key, value):
+        return [(self.name, key, None, value)]
+
+    def reset(self):
+        self._lock.acquire()
+        self._values = {}
+        self._lock.release()
+
+    def collect(self):
+        """
+        Returns the lines of the text exposition of the metric
+        """
+        lines = ["# HELP %s %s" % (self.name, _escape(self.documentation)),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        self._lock.acquire()
+        samples = []
+        for key in sorted(self._values.keys()):
+            samples.extend(self._samples(key, self._values[key]))
+        self._lock.release()
+        for name,key,extra,value in samples:
+            lines.append("%s%s %s" % \
+                         (name, _format_labels(self.labelnames, key, extra),
+                          _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    """
+    A value that only ever goes up
+    """
+    kind = "counter"
+
+    def inc(self, *labels, amount = 1):
+        key = self._key(labels)
+        self._lock.acquire()
+        self._values[key] = self._values.get(key, 0) + amount
+        self._lock.release()
+
+    def get(self, *labels):
+        self._lock.acquire()
+        value = self._values.get(self._key(labels), 0)
+        self._lock.release()
+        return value
+
+
+class Gauge(Metric):
+    """
+    A value that can be set to anything
+    """
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        key = self._key(labels)
+        self._lock.acquire()
+        self._values[key] = value
+        self._lock.release()
+
+    def get(self, *labels):
+        self._lock.acquire()
+        value = self._values.get(self._key(labels), 0)
+        self._lock.release()
+        return value
+
+
+class Histogram(Metric):
+    """
+    Counts observations in cumulative buckets, and keeps their sum
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames = (),
+                 buckets = DEFAULT_BUCKETS, registry = None):
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        Metric.__init__(self, name, documentation, labelnames, registry)
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        self._lock.acquire()
+        entry = self._values.get(key)
+        if entry == None:
+            # Per bucket counts (not cumulative), then the sum
+            entry = [0] * len(self.buckets) + [0.0]
+            self._values[key] = entry
+        for idx,bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[idx] += 1
+                break
+        entry[-1] += value
+        self._lock.release()
+
+    def get_count(self, *labels):
+        self._lock.acquire()
+        entry = self._values.get(self._key(labels))
+        count = 0
+        if entry != None:
+            count = sum(entry[:-1])
+        self._lock.release()
+        return count
+
+    def _samples(self, key, entry):
+        result = []
+        count = 0
+        for idx,bound in enumerate(self.buckets):
+            count += entry[idx]
+            result.append((self.name + "_bucket", key,
+                           ("le", _format_value(float(bound))), count))
+        result.append((self.name + "_sum", key, None, entry[-1]))
+        result.append((self.name + "_count", key, None, count))
+        return result
+
+
+class Registry:
+    """
+    The set of metrics to expose
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def register(self, metric):
+        self._lock.acquire()
+        for existing in self._metrics:
+            if existing.name == metric.name:
+                self._lock.release()
+                raise ValueError("Duplicate metric: %s" % metric.name)
+        self._metrics.append(metric)
+        self._lock.release()
+
+    def reset(self):
+        """
+        Zeroes all the metrics
+        """
+        self._lock.acquire()
+        metrics = self._metrics[:]
+        self._lock.release()
+        for metric in metrics:
+            metric.reset()
+
+    def render(self):
+        """
+        Returns the text exposition of all the metrics
+        """
+        self._lock.acquire()
+        metrics = self._metrics[:]
+        self._lock.release()
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+# The registry metrics go in unless told otherwise
+REGISTRY = Registry()
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent and not worth logging.
+        pass
+
+
+class MetricsServer:
+    """
+    Serves the metrics over HTTP from a background thread. Only binds
+    to the loopback interface unless told otherwise.
+    """
+    def __init__(self, port, address = "127.0.0.1", registry = None):
+        if registry == None:
+            registry = REGISTRY
+        self.port = port
+        self.address = address
+        self._server = http.server.ThreadingHTTPServer((address, port),
+                                                       _MetricsHandler)
+        self._server.daemon_threads = True
+        self._server.registry = registry
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="metrics-server")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+class TextfileWriter:
+    """
+    Writes the metrics to path every interval seconds, in a form the
+    node_exporter textfile collector picks up. The file is replaced
+    atomically so the collector never reads a partial file.
+    """
+    def __init__(self, path, interval = TEXTFILE_INTERVAL, registry = None):
+        if registry == None:
+            registry = REGISTRY
+        self.path = path
+        self.interval = interval
+        self._registry = registry
+        self._stop = threading.Event()
+        # Fail early if the file can't be written.
+        self.write()
+        self._thread = threading.Thread(target=self._run,
+                                        name="metrics-textfile")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self):
+        tmppath = "%s.%d.tmp" % (self.path, os.getpid())
+        f = open(tmppath, "w")
+        try:
+            f.write(self._registry.render())
+        finally:
+            f.close()
+        os.rename(tmppath, self.path)
+
+    def _run(self):
+        while self._stop.wait(self.interval) == False:
+            try:
+                self.write()
+            except OSError:
+                # Try again next time round. The previous file, if
+                # any, stays in place meanwhile.
+                pass
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        try:
+            self.write()
+        except OSError:
+            pass
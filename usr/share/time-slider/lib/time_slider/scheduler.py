@@ -0,0 +1,315 @@
+#!/usr/bin/python3
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+import time
+import datetime
+import calendar
+import heapq
+
+_MINUTE = 60
+_HOUR = _MINUTE * 60
+_DAY = _HOUR * 24
+_WEEK = _DAY * 7
+
+intervals = {"weeks" : _WEEK, "days" : _DAY, "hours" : _HOUR, "minutes" : _MINUTE}
+
+
+class CronExpression:
+    """
+    A cron(8) style schedule: "minute hour day-of-month month
+    day-of-week", in local time. Fields take "*", numbers, ranges,
+    lists and steps, eg. "*/15 8-18 * * mon-fri". Month and day names
+    and the @hourly, @daily, @weekly, @monthly and @yearly shorthands
+    are understood as well. Raises ValueError if the expression can't
+    be parsed.
+    """
+    shorthands = {"@hourly" : "0 * * * *",
+                  "@daily" : "0 0 * * *",
+                  "@midnight" : "0 0 * * *",
+                  "@weekly" : "0 0 * * 0",
+                  "@monthly" : "0 0 1 * *",
+                  "@yearly" : "0 0 1 1 *",
+                  "@annually" : "0 0 1 1 *"}
+    monthnames = ["jan", "feb", "mar", "apr", "may", "jun",
+                  "jul", "aug", "sep", "oct", "nov", "dec"]
+    daynames = ["sun", "mon", "tue", "wed", "thu", "fri", "sat"]
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = self.shorthands.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise ValueError("\'%s\' is not a valid cron expression" \
+                             % (expression))
+        self.minutes = self.__parse(fields[0], 0, 59)
+        self.hours = self.__parse(fields[1], 0, 23)
+        self.mdays = self.__parse(fields[2], 1, 31)
+        self.months = self.__parse(fields[3], 1, 12, self.monthnames, 1)
+        wdays = self.__parse(fields[4], 0, 7, self.daynames, 0)
+        # Both 0 and 7 mean Sunday.
+        if 7 in wdays:
+            wdays.discard(7)
+            wdays.add(0)
+        self.wdays = wdays
+        # cron(8) matches either day field if both are restricted.
+        self.__anyday = fields[2] != "*" and fields[4] != "*"
+
+    @staticmethod
+    def is_cron_expression(text):
+        """
+        Returns True if text looks like a cron expression rather than
+        one of the named intervals.
+        """
+        text = text.strip()
+        return text.startswith("@") or len(text.split()) == 5
+
+    def __parse(self, field, low, high, names = None, offset = 0):
+        result = set()
+        for item in field.lower().split(','):
+            step = 1
+            if '/' in item:
+                item,step = item.split('/', 1)
+                step = int(step)
+                if step < 1:
+                    raise ValueError("Invalid step in \'%s\'" % (field))
+            if item == "*":
+                first,last = low,high
+            elif '-' in item:
+                first,last = item.split('-', 1)
+                first = self.__value(first, names, offset)
+                last = self.__value(last, names, offset)
+            else:
+                first = self.__value(item, names, offset)
+                last = first
+                if step != 1:
+                    last = high
+            if first < low or last > high or first > last:
+                raise ValueError("\'%s\' is out of range %d-%d" \
+                                 % (field, low, high))
+            result.update(range(first, last + 1, step))
+        return result
+
+    def __value(self, text, names, offset):
+        if names != None and text in names:
+            return names.index(text) + offset
+        return int(text)
+
+    def __day_matches(self, dt):
+        mday = dt.day in self.mdays
+        wday = (dt.weekday() + 1) % 7 in self.wdays
+        if self.__anyday == True:
+            return mday or wday
+        return mday and wday
+
+    def next_after(self, t):
+        """
+        Returns the first time after t, in seconds since the epoch,
+        that matches the expression.
+        """
+        dt = datetime.datetime.fromtimestamp(int(t) // _MINUTE * _MINUTE) + \
+             datetime.timedelta(minutes=1)
+        # Give up on expressions like "0 0 31 2 *" that never match.
+        limit = dt.year + 8
+        while dt.year <= limit:
+            if dt.month not in self.months:
+                if dt.month == 12:
+                    dt = datetime.datetime(dt.year + 1, 1, 1)
+                else:
+                    dt = datetime.datetime(dt.year, dt.month + 1, 1)
+                continue
+            if self.__day_matches(dt) == False:
+                dt = datetime.datetime(dt.year, dt.month, dt.day) + \
+                     datetime.timedelta(days=1)
+                continue
+            if dt.hour not in self.hours:
+                hours = [h for h in self.hours if h > dt.hour]
+                if len(hours) == 0:
+                    dt = datetime.datetime(dt.year, dt.month, dt.day) + \
+                         datetime.timedelta(days=1)
+                else:
+                    dt = datetime.datetime(dt.year, dt.month, dt.day,
+                                           min(hours))
+                continue
+            if dt.minute not in self.minutes:
+                minutes = [m for m in self.minutes if m > dt.minute]
+                if len(minutes) == 0:
+                    dt = datetime.datetime(dt.year, dt.month, dt.day,
+                                           dt.hour) + \
+                         datetime.timedelta(hours=1)
+                else:
+                    dt = datetime.datetime(dt.year, dt.month, dt.day,
+                                           dt.hour, min(minutes))
+                continue
+            return int(time.mktime(dt.timetuple()))
+        raise ValueError("\'%s\' never matches" % (self.expression))
+
+
+class Scheduler:
+    """
+    Keeps track of when each snapshot schedule is next due.
+
+    The default schedules (monthly, weekly, daily, hourly, frequent, in
+    that order) overlap: a snapshot taken for one of them also counts
+    for all the more frequent ones after it. There are only a handful
+    of those, so they are simply scanned. Custom schedules are
+    independent of each other and are kept in a priority queue, so
+    finding the next one due and rescheduling the one that fired are
+    logarithmic in the number of custom schedules.
+    """
+    def __init__(self, defaults, customs):
+        """
+        Raises ValueError if a schedule has an invalid interval.
+
+        Keyword arguments:
+        defaults -- List of [schedule, interval, period, keep] lists
+                    for the default schedules, in order of dominance
+        customs -- Same for the custom schedules
+        """
+        self.last = {}
+        self.next = {}
+        self.__details = {}
+        self.__cron = {}
+        self.__defaults = [details[0] for details in defaults]
+        self.__rank = {}
+        self.__heap = []
+        for details in list(defaults) + list(customs):
+            schedule,interval,period,keep = details
+            if interval in intervals or interval == "months":
+                pass
+            elif CronExpression.is_cron_expression(interval):
+                self.__cron[schedule] = CronExpression(interval)
+            else:
+                raise ValueError("%s schedule has invalid interval: \'%s\'" \
+                                 % (schedule, interval))
+            self.__details[schedule] = (interval, period)
+            self.__rank[schedule] = len(self.__rank)
+            self.last[schedule] = 0
+            self.next[schedule] = 0
+
+    def get_dependents(self, schedule):
+        """
+        Returns the schedules whose next due time depends on when
+        schedule last fired, including schedule itself.
+        """
+        if schedule in self.__defaults:
+            return self.__defaults[self.__defaults.index(schedule):]
+        return [schedule]
+
+    def fired(self, schedule, t):
+        """
+        Records that schedule fired at time t and reschedules it and
+        its dependents.
+        """
+        self.last[schedule] = t
+        self.update(self.get_dependents(schedule))
+
+    def update(self, schedules = None):
+        """
+        Recalculates when the schedules are next due, all of them if
+        schedules is None.
+        """
+        if schedules == None:
+            schedules = list(self.__details.keys())
+        for schedule in schedules:
+            due = self.__calculate(schedule)
+            self.next[schedule] = due
+            if schedule not in self.__defaults:
+                heapq.heappush(self.__heap,
+                               (due, self.__rank[schedule], schedule))
+        # Updates leave the superseded entries behind. Don't let them
+        # pile up.
+        if len(self.__heap) > 2 * len(self.__details) + 64:
+            self.__heap = [(self.next[s], self.__rank[s], s) \
+                           for s in self.__details \
+                           if s not in self.__defaults]
+            heapq.heapify(self.__heap)
+
+    def __calculate(self, schedule):
+        interval,period = self.__details[schedule]
+        last = self.last[schedule]
+        if schedule in self.__cron:
+            return self.__cron[schedule].next_after(last)
+        if interval != "months": # months is non-constant. See below.
+            if schedule in self.__defaults:
+                # This is one of the default schedules so check for an
+                # overlap with one of the dominant schedules.
+                for s in self.__defaults[:self.__defaults.index(schedule)]:
+                    last = max(last, self.last[s])
+            return last + intervals[interval] * period
+
+        snap_tm = time.gmtime(last)
+        # Increment year if period >= than 1 calender year.
+        year = snap_tm.tm_year
+        year += period // 12
+        period = period % 12
+
+        mon = (snap_tm.tm_mon + period) % 12
+        # Result of 0 actually means december.
+        if mon == 0:
+            mon = 12
+        # Account for period that spans calendar year boundary.
+        elif snap_tm.tm_mon + period > 12:
+            year += 1
+
+        d,dlastmon = calendar.monthrange(snap_tm.tm_year, snap_tm.tm_mon)
+        d,dnewmon = calendar.monthrange(year, mon)
+        mday = snap_tm.tm_mday
+        if dlastmon > dnewmon and snap_tm.tm_mday > dnewmon:
+           mday = dnewmon
+
+        tm =(year, mon, mday, \
+            snap_tm.tm_hour, snap_tm.tm_min, snap_tm.tm_sec, \
+            0, 0, -1)
+        return calendar.timegm(tm)
+
+    def next_due(self, now = None):
+        """
+        Returns a tuple of the time the next snapshot is due and its
+        schedule, or (None, None) if there are no schedules. When
+        several are overdue, the most dominant default schedule goes
+        first, since the ones it dominates may not be due anymore
+        afterwards.
+        """
+        if now == None:
+            now = int(time.time())
+        earliest,schedule = None,None
+        for s in self.__defaults:
+            due = self.next[s]
+            if due <= now:
+                #Default Schedule - so break out at the first
+                #schedule that is overdue. The subordinate schedules
+                #will re-adjust afterwards.
+                earliest,schedule = due,s
+                break
+            elif earliest == None or due < earliest:
+                earliest,schedule = due,s
+
+        # Drop queue entries superseded by later updates.
+        while len(self.__heap) > 0:
+            due,rank,s = self.__heap[0]
+            if s in self.next and self.next[s] == due:
+                break
+            heapq.heappop(self.__heap)
+        if len(self.__heap) > 0:
+            due,rank,s = self.__heap[0]
+            if earliest == None or due < earliest:
+                earliest,schedule = due,s
+        return earliest,schedule
@@ -0,0 +1,341 @@
+#!/usr/bin/python3
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+"""
+Simulates weeks or months of time-slider operation in seconds, to see
+what a configuration does before deploying it. The snapshot manager of
+the daemon runs unmodified against an emulated system (see zfsemu)
+and a virtual clock, while a synthetic workload writes to the
+datasets. The zpool capacity is checked after every workload step,
+the way the capacity monitor would, and remedial cleanups run
+synchronously.
+
+The virtual clock stands in for time.time() and time.sleep() for the
+duration of the simulation.
+
+Usage: python3 -m time_slider.simulator [options]
+"""
+
+import sys
+import time
+import random
+import logging
+import argparse
+
+from . import zfs
+from . import zfsemu
+from . import timesliderd
+import time_slider.linux.timesliderconfig as timesliderconfig
+
+_DAY = 24 * 60 * 60
+
+
+class Notifications:
+    """
+    Takes the place of the D-Bus service and counts the capacity
+    notifications the daemon would have sent.
+    """
+    def __init__(self):
+        self.sent = []
+
+    def capacity_exceeded(self, poolname, severity, threshold):
+        self.sent.append((poolname, severity, threshold))
+
+
+class SimulatedSnapshotManager(timesliderd.SnapshotManager):
+    """
+    The daemon's snapshot manager, minus D-Bus, signal handling and
+    background threads. Remedial cleanups run synchronously.
+    """
+    def __init__(self):
+        self._init_state()
+        self._dbus = Notifications()
+        self.refresh()
+
+    def _configure_catalog(self, path):
+        # Emulated snapshots have no business in the real catalog.
+        pass
+
+    def _perform_cleanup(self, zpools):
+        for zpool in zpools:
+            lock = self._get_cleanup_lock(zpool.name)
+            if lock.acquire(False) == False:
+                continue
+            self._cleanup_pool(zpool, lock)
+
+    def run_once(self):
+        """
+        Does whatever is due now. Returns the time the next snapshot
+        is due or None if there are no schedules.
+        """
+        return self._run_once()
+
+    def check_capacity(self):
+        """
+        Flags the zpools above the warning level for a cleanup
+        """
+        if self._remedialCleanup == False:
+            return
+        space = zfs.get_zpool_space([zpool.name for zpool in self._zpools])
+        for name,(used,available) in space.items():
+            if 100.0 * used / (used + available) > self._warningLevel:
+                self._capacity_exceeded(name)
+
+
+class Workload:
+    """
+    Writes to the emulated datasets at a steady rate per dataset.
+    """
+    def __init__(self, emulator, names, rate, overwrite, idle, seed = 0):
+        """
+        Keyword arguments:
+        emulator -- The ZFSEmulator to write to
+        names -- Names of the datasets to write to
+        rate -- Average number of bytes written per dataset per day
+        overwrite -- Fraction of the written data replacing existing
+                     data rather than adding to it
+        idle -- Fraction of the datasets never written to
+        seed -- Random seed (default 0)
+        """
+        rand = random.Random(seed)
+        self.emulator = emulator
+        self.overwrite = overwrite
+        # Daily write rate of each dataset. Busy datasets vary around
+        # the average.
+        self.rates = {}
+        for name in names:
+            if rand.random() < idle:
+                continue
+            self.rates[name] = rate * rand.uniform(0.5, 1.5) / (1 - idle)
+        self.written = 0
+
+    def run(self, seconds):
+        """
+        Writes what the datasets write in the given number of seconds
+        """
+        for name,rate in self.rates.items():
+            nbytes = int(rate * seconds / _DAY)
+            self.written += self.emulator.write(name, nbytes,
+                                                int(nbytes * self.overwrite))
+
+
+class DayReport:
+    def __init__(self, day):
+        self.day = day
+        self.snapshots = 0
+        self.peakfill = 0.0
+        self.commands = 0
+        self.walltime = 0.0
+        # Snapshots destroyed by remedial cleanups
+        self.cleaned = 0
+
+    def __str__(self):
+        return "%5d %11d %9.1f%% %10d %9d %9.3f" \
+               % (self.day, self.snapshots, self.peakfill, self.commands,
+                  self.cleaned, self.walltime)
+
+
+def get_fill(emulator):
+    """
+    Returns the highest capacity percentage of the emulated zpools
+    """
+    result = 0.0
+    for pool in emulator.pools.values():
+        result = max(result, 100.0 * pool.get_used() / pool.size)
+    return result
+
+
+def count_snapshots(emulator):
+    """
+    Returns a dictionary of the number of snapshots per schedule.
+    Snapshots not taken by time-slider are counted under None.
+    """
+    result = {}
+    for dataset in emulator.datasets.values():
+        for snapshot in dataset.snapshots:
+            match = zfs.AUTOSNAPLABEL.match(snapshot.label)
+            schedule = None
+            if match != None:
+                schedule = match.group(1)
+            result[schedule] = result.get(schedule, 0) + 1
+    return result
+
+
+def populate(emulator, args):
+    """
+    Creates the zpools and datasets to simulate, all tagged for
+    auto snapshots, with their initial data. Returns the dataset
+    names.
+    """
+    names = []
+    for idx in range(args.pools):
+        poolname = "pool%d" % (idx)
+        emulator.create_pool(poolname, args.pool_size)
+        emulator.create_dataset(poolname,
+                                props = {"com.sun:auto-snapshot" : "true"})
+        for dsidx in range(args.datasets):
+            name = "%s/fs%d" % (poolname, dsidx)
+            emulator.create_dataset(name)
+            emulator.write(name, args.initial_size)
+            names.append(name)
+    return names
+
+
+def simulate(args, out = sys.stdout):
+    """
+    Runs the simulation. Returns the list of DayReports.
+    """
+    clock = zfsemu.VirtualClock(args.start)
+    emulator = zfsemu.ZFSEmulator(clock.time, passthrough = False,
+                                  seed = args.seed)
+    names = populate(emulator, args)
+    workload = Workload(emulator, names, args.write_rate, args.overwrite,
+                        args.idle, args.seed)
+    if args.config != None:
+        timesliderconfig.configfile = args.config
+
+    realtime = time.time
+    realsleep = time.sleep
+    previous = zfsemu.install(emulator)
+    time.time = clock.time
+    time.sleep = clock.advance
+    reports = []
+    try:
+        manager = SimulatedSnapshotManager()
+        start = clock.time()
+        end = start + args.days * _DAY
+        report = DayReport(1)
+        began = time.perf_counter()
+        cleaned = 0
+        emulator.reset_stats()
+        out.write("  day   snapshots  peak fill   commands   cleaned" \
+                  "    wall s\n")
+        while clock.time() < end:
+            nexttime = manager.run_once()
+            if manager._cleanupError != None:
+                raise RuntimeError(manager._cleanupError)
+            cleaned += sum([len(d) for d in manager._destroyedsnaps.values()])
+            manager._destroyedsnaps = {}
+            report.peakfill = max(report.peakfill, get_fill(emulator))
+
+            # Move on to the next snapshot or workload step, or the
+            # end of the day, whichever comes first.
+            now = clock.time()
+            dayend = start + report.day * _DAY
+            step = min(args.step, dayend - now)
+            if nexttime != None and nexttime > now:
+                step = min(step, nexttime - now)
+            step = max(step, 1)
+            workload.run(step)
+            clock.advance(step)
+            manager.check_capacity()
+            report.peakfill = max(report.peakfill, get_fill(emulator))
+
+            if clock.time() >= dayend:
+                report.snapshots = emulator.get_snapshot_count()
+                report.commands = sum(emulator.get_stats().values())
+                report.cleaned = cleaned
+                report.walltime = time.perf_counter() - began
+                out.write(str(report) + "\n")
+                reports.append(report)
+                report = DayReport(report.day + 1)
+                cleaned = 0
+                emulator.reset_stats()
+                began = time.perf_counter()
+    finally:
+        time.time = realtime
+        time.sleep = realsleep
+        zfsemu.install(previous)
+
+    counts = count_snapshots(emulator)
+    out.write("\nSnapshots after %d days:\n" % (args.days))
+    for schedule in sorted(counts.keys(), key=str):
+        out.write("  %-20s %d\n" % (schedule, counts[schedule]))
+    out.write("Peak fill: %.1f%%, data written: %s, " \
+              "zfs/zpool commands: %d, wall time: %.3f s\n" \
+              % (max([r.peakfill for r in reports] + [0]),
+                 zfsemu.nicenum(workload.written),
+                 sum([r.commands for r in reports]),
+                 sum([r.walltime for r in reports])))
+    return reports
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="time_slider.simulator",
+                                     description="Simulate time-slider " \
+                                     "snapshot schedules and retention " \
+                                     "on emulated zpools")
+    parser.add_argument("--config", default=None,
+                        help="time-slider configuration file to simulate " \
+                        "(default %s)" % timesliderconfig.configfile)
+    parser.add_argument("--days", type=int, default=30,
+                        help="Number of days to simulate (default 30)")
+    parser.add_argument("--start", type=int, default=None,
+                        help="Simulated start time in seconds since the " \
+                        "epoch (default now)")
+    parser.add_argument("--pools", type=int, default=1,
+                        help="Number of zpools (default 1)")
+    parser.add_argument("--pool-size", type=zfsemu.parse_size,
+                        default="1T", help="Size of each zpool (default 1T)")
+    parser.add_argument("--datasets", type=int, default=20,
+                        help="Number of filesystems per zpool (default 20)")
+    parser.add_argument("--initial-size", type=zfsemu.parse_size,
+                        default="10G",
+                        help="Initial data per filesystem (default 10G)")
+    parser.add_argument("--write-rate", type=zfsemu.parse_size,
+                        default="2G",
+                        help="Average bytes written per filesystem per " \
+                        "day (default 2G)")
+    parser.add_argument("--overwrite", type=float, default=0.8,
+                        help="Fraction of written data that replaces " \
+                        "existing data (default 0.8)")
+    parser.add_argument("--idle", type=float, default=0.0,
+                        help="Fraction of filesystems that are never " \
+                        "written to (default 0)")
+    parser.add_argument("--step", type=int, default=15 * 60,
+                        help="Longest workload step in seconds " \
+                        "(default 900)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed (default 0)")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Show the daemon's log messages, including " \
+                        "debug output")
+    args = parser.parse_args(argv)
+    if args.idle < 0 or args.idle >= 1:
+        parser.error("--idle must be at least 0 and less than 1")
+
+    # The report is what matters. Keep the daemon quiet unless asked.
+    logging.basicConfig(format="%(message)s")
+    if args.verbose == True:
+        logging.getLogger('time-slider').setLevel(logging.DEBUG)
+    else:
+        logging.getLogger('time-slider').setLevel(logging.CRITICAL + 1)
+    try:
+        simulate(args)
+    except RuntimeError as message:
+        sys.stderr.write("Simulation failed: %s\n" % str(message))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -29,10 +29,10 @@ import getopt
 import syslog
 import time
 import datetime
-import calendar
 import signal
 import argparse
 import logging
+import concurrent.futures
 from logging.handlers import SysLogHandler
 
 from gi.repository import GLib as glib
@@ -44,7 +44,15 @@ import dbus.mainloop.glib
 
 from . import dbussvc
 from . import zfs
+from . import zfsbackend
 from . import smf
+from . import cleanup
+from . import capacity
+from . import cmdhelper
+from . import scheduler
+from . import metrics
+from . import tracing
+from . import catalog
 import time_slider.linux.timeslidersmf as timeslidersmf
 import time_slider.linux.autosnapsmf as autosnapsmf
 # import plugin
@@ -58,6 +66,50 @@ _HOUR = _MINUTE * 60
 _DAY = _HOUR * 24
 _WEEK = _DAY * 7
 
+# Maximum number of zpools to run remedial cleanups on concurrently
+_CLEANUP_WORKERS = 4
+
+# Rescans of the snapshot cache asked for over D-Bus are carried out
+# at most this often, in seconds
+_SNAPSHOT_REFRESH_INTERVAL = 60
+
+# Where SIGUSR2 dumps the trace of recently run commands
+TRACE_DUMPFILE = "/var/tmp/time-sliderd-trace.json"
+
+_snapshotsTaken = metrics.Counter("timeslider_snapshot_sets_total",
+                                  "Auto snapshot sets taken",
+                                  ["schedule"])
+_snapshotDuration = metrics.Histogram( \
+                        "timeslider_snapshot_duration_seconds",
+                        "Time taken to create a schedule's snapshots",
+                        ["schedule"])
+_snapshotsSkipped = metrics.Counter("timeslider_snapshots_skipped_total",
+                                   "Snapshots of unchanged datasets left " \
+                                   "out of auto snapshot sets",
+                                   ["schedule"])
+_schedulerLag = metrics.Histogram("timeslider_scheduler_lag_seconds",
+                                  "Time between when a snapshot was due " \
+                                  "and when it was taken",
+                                  ["schedule"],
+                                  buckets=metrics.LONG_BUCKETS)
+_lastSchedulerLag = metrics.Gauge("timeslider_scheduler_last_lag_seconds",
+                                  "Lag of the latest snapshot taken",
+                                  ["schedule"])
+_pruneDuration = metrics.Histogram("timeslider_prune_duration_seconds",
+                                   "Time taken to purge a dataset's " \
+                                   "snapshots of a schedule",
+                                   ["schedule"])
+_snapshotsDestroyed = metrics.Counter( \
+                          "timeslider_snapshots_destroyed_total",
+                          "Snapshots destroyed, by reason: empty, " \
+                          "expired or cleanup",
+                          ["reason"])
+_cleanupDuration = metrics.Histogram("timeslider_cleanup_duration_seconds",
+                                     "Time taken by remedial cleanups of " \
+                                     "a schedule's snapshots",
+                                     ["pool", "schedule"],
+                                     buckets=metrics.LONG_BUCKETS)
+
 
 # Status codes for actual zpool capacity levels.
 # These are relative to the SMF property defined
@@ -67,26 +119,81 @@ STATUS_WARNING = 1 # Above specified user threshold level
 STATUS_CRITICAL = 2 # Above specified critical threshhold level
 STATUS_EMERGENCY = 3 # Above specified emergency threshhold level
 
-intervals = {"weeks" : _WEEK, "days" : _DAY, "hours" : _HOUR, "minutes" : _MINUTE}
-
 
 class SnapshotManager(threading.Thread):
 
     def __init__(self, bus):
+        self._init_state()
+        self._dbus = dbussvc.AutoSnap(bus,
+                                      '/org/opensolaris/TimeSlider/autosnap',
+                                      self)
+        self.refresh()
+        self._capacityMonitor.start()
+
+        # Seems we're up and running OK.
+        # Signal our parent so we can daemonise
+        os.kill(os.getppid(), signal.SIGUSR1)
+
+        # SMF/svc.startd sends SIGHUP to force a
+        # a refresh of the daemon
+        signal.signal(signal.SIGHUP, self._signalled)
+        # Dumps the command trace for inspection
+        signal.signal(signal.SIGUSR2, self._signalled)
+        # Changes to the configuration file trigger a refresh too
+        try:
+            timesliderconfig.watch(self._config_changed)
+        except OSError as message:
+            self.logger.error("Can't watch %s for changes: %s" \
+                              % (timesliderconfig.configfile, str(message)))
+
+        # Init done. Now initiaslise threading.
+        threading.Thread.__init__ (self)
+        self.setDaemon(True)
+
+    def _init_state(self):
+        """
+        Sets up everything but the D-Bus service, signal handling and
+        the background threads, so that the scheduling and cleanup
+        logic can also be driven by other means, eg. the simulator.
+        """
         # Used to wake up the run() method prematurely in the event
-        # of a SIGHUP/SMF refresh
+        # of a SIGHUP/SMF refresh. _wakeup is set if that happened
+        # while run() was busy, so that it doesn't go to sleep.
         self._conditionLock = threading.Condition(threading.RLock())
+        self._wakeup = False
         # Used when schedules are being rebuilt or examined.
         self._refreshLock = threading.Lock()
-        # Indicates that cleanup is in progress when locked
+        # Guards _cleanupLocks, the per zpool locks that indicate a
+        # cleanup or purge is in progress on the zpool when locked
         self._cleanupLock = threading.Lock()
+        self._cleanupLocks = {}
+        # Remedial cleanups run in the background, one worker per zpool,
+        # so that snapshots keep getting taken on schedule meanwhile.
+        self._cleanupExecutor = concurrent.futures.ThreadPoolExecutor( \
+                                    max_workers=_CLEANUP_WORKERS,
+                                    thread_name_prefix="cleanup")
+        # Set by a cleanup worker that failed, for run() to pick up
+        self._cleanupError = None
+        # Names of zpools the capacity monitor flagged for a cleanup
+        self._cleanupDue = set()
         self._datasets = zfs.Datasets()
+        # Latest auto snapshot inventory of each schedule, for queries
+        # over D-Bus. Dropped on refresh.
+        self._inventoryLock = threading.Lock()
+        self._inventories = {}
+        # Set when a rescan of the snapshot cache has been asked for,
+        # and when the last one was carried out
+        self._snapshotRefreshDue = False
+        self._snapshotsRefreshed = 0
         # Indicates that schedules need to be rebuilt from scratch
         self._stale = True
-        self._lastCleanupCheck = 0;
         self._zpools = []
         self._poolstatus = {}
-        self._destroyedsnaps = []
+        self._destroyedsnaps = {}
+        self._commandHelpers = None
+        self._metricsServer = None
+        self._metricsTextfile = None
+        self._catalog = None
         self.logger = logging.getLogger('time-slider')
 
         # This is also checked during the refresh() method but we need
@@ -98,25 +205,11 @@ class SnapshotManager(threading.Thread):
             self.logger.error("Error determing whether debugging is enabled")
             self.verbose = False
 
-        self._dbus = dbussvc.AutoSnap(bus,
-                                      '/org/opensolaris/TimeSlider/autosnap',
-                                      self)
-
         # self._plugin = plugin.PluginManager(self.verbose)
         self.exitCode = smf.SMF_EXIT_OK
-        self.refresh()
-
-        # Seems we're up and running OK.
-        # Signal our parent so we can daemonise
-        os.kill(os.getppid(), signal.SIGUSR1)
-
-        # SMF/svc.startd sends SIGHUP to force a
-        # a refresh of the daemon
-        signal.signal(signal.SIGHUP, self._signalled)
-
-        # Init done. Now initiaslise threading.
-        threading.Thread.__init__ (self)
-        self.setDaemon(True)
+        # Watches zpool capacity and wakes up run() when a cleanup
+        # is needed, instead of run() checking periodically.
+        self._capacityMonitor = capacity.CapacityMonitor(self._capacity_exceeded)
 
     def run(self):
         # Deselect swap and dump volumes so they don't get snapshotted.
@@ -134,19 +227,7 @@ class SnapshotManager(threading.Thread):
         waittime = None
         while True:
             try:
-                self.refresh()
-                # First check and, if necessary, perform any remedial cleanup.
-                # This is best done before creating any new snapshots which may
-                # otherwise get immediately gobbled up by the remedial cleanup.
-                if self._needs_cleanup() == True:
-                    self._perform_cleanup()
-                    # Check to see if cleanup actually deleted anything before
-                    # notifying the user. Avoids the popup appearing continuously
-                    if len(self._destroyedsnaps) > 0:
-                        self._send_notification()
-                    self._send_to_syslog()
-
-                nexttime = self._check_snapshots()
+                nexttime = self._run_once()
                 # Overdue snapshots are already taken automatically
                 # inside _check_snapshots() so nexttime should never be
                 # < 0. It can be None however, which is fine since it
@@ -162,14 +243,20 @@ class SnapshotManager(threading.Thread):
                         # and catch up on it the next time through the loop
                         continue
                 # waittime could be None if no auto-snap schedules are online
+                # The lock is only held while waiting, so that waking
+                # up this thread never waits for it to get done.
                 self._conditionLock.acquire()
-                if waittime:
+                if self._wakeup == True:
+                    pass
+                elif waittime:
                     util.debug("Waiting %d seconds" % (waittime), self.verbose)
                     self._conditionLock.wait(waittime)
-                else: #None. Just wait a while to check for cleanups.
+                else: #None. Wait for a cleanup or a refresh.
                     util.debug("No auto-snapshot schedules online.", \
                                self.verbose)
-                    self._conditionLock.wait(_MINUTE * 15)
+                    self._conditionLock.wait()
+                self._wakeup = False
+                self._conditionLock.release()
 
             except OSError as message:
                 self.logger.error("Caught OSError exception in snapshot" +
@@ -191,15 +278,88 @@ class SnapshotManager(threading.Thread):
                 # Exit this thread
                 break
 
+    def _run_once(self):
+        """
+        Does whatever is due now. Returns the time the next snapshot
+        is due or None if there are no schedules.
+        """
+        if self._cleanupError != None:
+            # A background cleanup failed. Exit this thread the
+            # same way as if it had failed here.
+            raise RuntimeError(self._cleanupError)
+        self.refresh()
+        refreshtime = self._refresh_snapshot_cache()
+        # First check and, if necessary, start any remedial cleanup.
+        # This is best done before creating any new snapshots which may
+        # otherwise get immediately gobbled up by the remedial cleanup.
+        # Cleanups run in the background so that snapshots of other
+        # zpools don't fall behind schedule in the meantime.
+        zpools = self._needs_cleanup()
+        if len(zpools) > 0:
+            self._perform_cleanup(zpools)
+
+        nexttime = self._check_snapshots()
+        zfs.Datasets.snapshots.flush()
+        if refreshtime != None and (nexttime == None or \
+                                    refreshtime < nexttime):
+            nexttime = refreshtime
+        return nexttime
+
+    def _refresh_snapshot_cache(self):
+        """
+        Rescans the snapshot cache if asked to by refresh_snapshots(),
+        but no more often than every _SNAPSHOT_REFRESH_INTERVAL
+        seconds. Returns the time a rescan held back is due, or None.
+        """
+        if self._snapshotRefreshDue == False:
+            return None
+        duetime = self._snapshotsRefreshed + _SNAPSHOT_REFRESH_INTERVAL
+        if time.time() < duetime:
+            return int(duetime) + 1
+        self._snapshotRefreshDue = False
+        self._snapshotsRefreshed = time.time()
+        with tracing.caller("refresh"):
+            self._datasets.refresh_snapshots()
+            zfs.Datasets.snapshots.validate()
+        return None
+
     def _signalled(self, signum, frame):
-        if signum == signal.SIGHUP:
-            if self._refreshLock.acquire(False) == False:
-                return
+        if signum == signal.SIGUSR2:
+            # Not in the signal handler, which may have interrupted
+            # a thread holding the tracer's lock.
+            dumper = threading.Thread(target=self._dump_trace,
+                                      name="trace-dump")
+            dumper.daemon = True
+            dumper.start()
+        elif signum == signal.SIGHUP:
+            # Even if a refresh is running, it may already have read
+            # the old configuration. refresh() picks this up next time.
             self._stale = True
-            self._refreshLock.release()
-            self._conditionLock.acquire()
-            self._conditionLock.notify()
-            self._conditionLock.release()
+            self._wake()
+
+    def _wake(self):
+        """
+        Wakes up run(), or has it go round again straight away if it's
+        busy. Doesn't wait for run() to finish what it's doing.
+        """
+        self._conditionLock.acquire()
+        self._wakeup = True
+        self._conditionLock.notify()
+        self._conditionLock.release()
+
+    def _config_changed(self):
+        util.debug("%s changed" % timesliderconfig.configfile, self.verbose)
+        self._signalled(signal.SIGHUP, None)
+
+    def _dump_trace(self):
+        try:
+            tracing.tracer.dump(TRACE_DUMPFILE)
+        except OSError as message:
+            self.logger.error("Failed to dump the command trace: %s" \
+                              % str(message))
+        else:
+            self.logger.info("Dumped the command trace to %s" \
+                             % TRACE_DUMPFILE)
 
     def refresh(self):
         """
@@ -207,13 +367,25 @@ class SnapshotManager(threading.Thread):
         of date and rebuilds and updates if necessary
         """
         self._refreshLock.acquire()
-        if self._stale == True:
-            self._configure_svc_props()
-            self._rebuild_schedules()
-            self._update_schedules()
-            # self._plugin.refresh()
-            self._stale = False
-        self._refreshLock.release()
+        try:
+            if self._stale == True:
+                # Cleared before reading the configuration, so that a
+                # change made meanwhile makes for another refresh.
+                self._stale = False
+                self._inventoryLock.acquire()
+                self._inventories = {}
+                self._inventoryLock.release()
+                try:
+                    with tracing.caller("refresh"):
+                        self._configure_svc_props()
+                        self._rebuild_schedules()
+                        self._update_schedules()
+                except Exception:
+                    self._stale = True
+                    raise
+                # self._plugin.refresh()
+        finally:
+            self._refreshLock.release()
 
     def _configure_svc_props(self):
         try:
@@ -249,6 +421,88 @@ class SnapshotManager(threading.Thread):
             self._criticalLevel = crit
             self._emergencyLevel = emer
 
+        try:
+            helpers = self._smf.get_command_helpers()
+        except (RuntimeError, ValueError) as message:
+            self.logger.error("Can't determine number of command helpers")
+            self.logger.error("Assuming default value: 0")
+            helpers = 0
+        self._configure_command_helpers(helpers)
+
+        try:
+            port = self._smf.get_metrics_port()
+        except (RuntimeError, ValueError) as message:
+            self.logger.error("Can't determine the metrics port")
+            self.logger.error("Assuming default value: 0")
+            port = 0
+        try:
+            textfile = self._smf.get_metrics_textfile()
+        except RuntimeError as message:
+            self.logger.error("Can't determine the metrics textfile")
+            self.logger.error("Assuming default value: none")
+            textfile = ""
+        self._configure_metrics(port, textfile)
+
+        try:
+            capacity = self._smf.get_trace_buffer()
+        except (RuntimeError, ValueError) as message:
+            self.logger.error("Can't determine the command trace size")
+            self.logger.error("Assuming default value: %d" \
+                              % tracing.DEFAULT_CAPACITY)
+            capacity = tracing.DEFAULT_CAPACITY
+        try:
+            threshold = self._smf.get_slow_command_threshold()
+        except (RuntimeError, ValueError) as message:
+            self.logger.error("Can't determine the slow command threshold")
+            self.logger.error("Assuming default value: 0")
+            threshold = 0
+        tracing.tracer.configure(max(capacity, 1), threshold / 1000.0)
+
+        try:
+            path = self._smf.get_snapshot_catalog()
+        except RuntimeError as message:
+            self.logger.error("Can't determine the snapshot catalog path")
+            self.logger.error("Assuming default value: %s" \
+                              % catalog.CATALOG_PATH)
+            path = catalog.CATALOG_PATH
+        self._configure_catalog(path)
+
+        try:
+            backend = zfsbackend.get_backend(self._smf.get_zfs_backend(),
+                                             zfs.ZFSCMD)
+        except (RuntimeError, ValueError) as message:
+            self.logger.error("Can't set up the configured zfs backend")
+            self.logger.error("Details:\n" + \
+                             "--------BEGIN ERROR MESSAGE--------\n" + \
+                             str(message) + \
+                             "\n---------END ERROR MESSAGE---------")
+            self.logger.error("Using zfs(1) instead")
+            backend = zfsbackend.CommandBackend(zfs.ZFSCMD)
+        util.debug("Using the %s zfs backend" % backend.name, self.verbose)
+        zfs.set_backend(backend)
+
+        try:
+            self._cleanupPlanOnly = self._smf.get_cleanup_plan_only()
+        except RuntimeError as message:
+            self.logger.error("Can't determine whether to only plan cleanups")
+            self.logger.error("Assuming default value: False")
+            self._cleanupPlanOnly = False
+
+        try:
+            self._batchSnapshots = self._smf.get_batch_snapshots()
+        except RuntimeError as message:
+            self.logger.error("Can't determine whether to batch snapshots")
+            self.logger.error("Assuming default value: False")
+            self._batchSnapshots = False
+
+        try:
+            self._skipUnchanged = self._smf.get_skip_unchanged()
+        except RuntimeError as message:
+            self.logger.error("Can't determine whether to skip unchanged " \
+                              "datasets")
+            self.logger.error("Assuming default value: False")
+            self._skipUnchanged = False
+
         try:
             self._keepEmpties = self._smf.get_keep_empties()
         except RuntimeError as message:
@@ -265,11 +519,9 @@ class SnapshotManager(threading.Thread):
         # separator character for datestamps. Windows filesystems such as
         # CIFS and FAT choke on this character so now we use a user definable
         # separator value, with a default value of "_"
-        # We need to check for both the old and new format when looking for
-        # snapshots.
+        # Both the old and new format are recognised by the zfs module's
+        # snapshot schedule index when looking for snapshots.
         self._separator = self._smf.get_separator()
-        self._prefix = "%s[:%s]" \
-            % (autosnapsmf.SNAPLABELPREFIX, self._separator)
 
         # Rebuild pool list
         self._zpools = []
@@ -290,14 +542,94 @@ class SnapshotManager(threading.Thread):
             # Propogate exception up to thread's run() method
             raise RuntimeError(message)
 
+        if self._remedialCleanup == True:
+            self._capacityMonitor.configure([zpool.name for zpool in self._zpools],
+                                            [self._warningLevel,
+                                             self._criticalLevel,
+                                             self._emergencyLevel],
+                                            self.verbose)
+        else:
+            self._capacityMonitor.configure([], [], self.verbose)
+
+    def _configure_command_helpers(self, count):
+        """
+        Starts count helper processes to run commands through, or goes
+        back to forking commands directly if count is 0.
+        """
+        if self._commandHelpers != None:
+            if self._commandHelpers.size == count:
+                return
+            util.set_command_backend(None)
+            self._commandHelpers.close()
+            self._commandHelpers = None
+        if count <= 0:
+            return
+        try:
+            self._commandHelpers = cmdhelper.CommandHelperPool(count)
+        except OSError as message:
+            self.logger.error("Failed to start command helpers: %s" \
+                              % str(message))
+            return
+        util.debug("Running commands through %d helpers" % count, \
+                   self.verbose)
+        util.set_command_backend(self._commandHelpers)
+
+    def _configure_metrics(self, port, textfile):
+        """
+        Serves the metrics on the given local port and writes them to
+        textfile, replacing whatever was set up before. A port of 0 or
+        an empty textfile name disables the respective exporter.
+        """
+        if self._metricsServer != None and self._metricsServer.port != port:
+            self._metricsServer.close()
+            self._metricsServer = None
+        if self._metricsServer == None and port > 0:
+            try:
+                self._metricsServer = metrics.MetricsServer(port)
+            except OSError as message:
+                self.logger.error("Failed to serve metrics on port %d: %s" \
+                                  % (port, str(message)))
+            else:
+                util.debug("Serving metrics on port %d" % port, \
+                           self.verbose)
+
+        if self._metricsTextfile != None and \
+           self._metricsTextfile.path != textfile:
+            self._metricsTextfile.close()
+            self._metricsTextfile = None
+        if self._metricsTextfile == None and len(textfile) > 0:
+            try:
+                self._metricsTextfile = metrics.TextfileWriter(textfile)
+            except OSError as message:
+                self.logger.error("Failed to write metrics to %s: %s" \
+                                  % (textfile, str(message)))
+            else:
+                util.debug("Writing metrics to %s" % textfile, \
+                           self.verbose)
+
+    def _configure_catalog(self, path):
+        """
+        Keeps the snapshot catalog at path, or none if path is empty
+        """
+        if self._catalog != None:
+            if self._catalog.path == path:
+                return
+            zfs.Datasets.snapshots.attach_catalog(None)
+            self._catalog.close()
+            self._catalog = None
+        if len(path) == 0:
+            return
+        self._catalog = catalog.open_catalog(path, readonly=False)
+        if self._catalog != None:
+            util.debug("Keeping a snapshot catalog in %s" % path, \
+                       self.verbose)
+            zfs.Datasets.snapshots.attach_catalog(self._catalog)
 
     def _rebuild_schedules(self):
         """
         Builds 2 lists of default and custom auto-snapshot SMF instances
         """
 
-        self._last = {}
-        self._next = {}
         self._keep = {}
 
         try:
@@ -316,34 +648,33 @@ class SnapshotManager(threading.Thread):
             _defaultSchedules.extend(_customSchedules)
             self._allSchedules = tuple(_defaultSchedules)
             for schedule,i,p,keep in self._allSchedules:
-                self._last[schedule] = 0
-                self._next[schedule] = 0
                 self._keep[schedule] = keep
 
-    def _update_schedules(self):
-        interval = 0
-        idx = 1 # Used to index subsets for schedule overlap calculation
-        last = None
-
-        for schedule,interval,period,keep in self._allSchedules:
-            # Shortcut if we've already processed this schedule and it's
-            # still up to date. Don't skip the default schedules though
-            # because overlap affects their scheduling
-            if [schedule,interval,period,keep] not in \
-                self._defaultSchedules and \
-                (self._next[schedule] > self._last[schedule]):
-                util.debug("Short circuiting %s recalculation" \
-                           % (schedule), \
-                           self.verbose)
-                continue
+        try:
+            self._scheduler = scheduler.Scheduler(self._defaultSchedules,
+                                                  self._customSchedules)
+        except ValueError as message:
+            self.exitCode = smf.SMF_EXIT_ERR_CONFIG
+            self.logger.error(str(message))
+            #Propogate up to thread's run() method
+            raise RuntimeError(message)
+        self._last = self._scheduler.last
+        self._next = self._scheduler.next
+
+    def _update_schedules(self, schedules = None):
+        """
+        Recalculates when the given schedules are next due, or all of
+        them if schedules is None.
+        """
+        if schedules == None:
+            schedules = [s for s,i,p,k in self._allSchedules]
 
+        for schedule in schedules:
             # If we don't have an internal timestamp for the given schedule
             # ask zfs for the last snapshot and get it's creation timestamp.
             if self._last[schedule] == 0:
                 try:
-                    snaps = self._datasets.list_snapshots("%s%s" % \
-                                                         (self._prefix,
-                                                          schedule))
+                    snaps = self._datasets.list_snapshots(schedule=schedule)
                 except RuntimeError as message:
                     self.exitCode = smf.SMF_EXIT_ERR_FATAL
                     self.logger.error("Failed to list snapshots during schedule update")
@@ -356,90 +687,12 @@ class SnapshotManager(threading.Thread):
                                self.verbose)
                     self._last[schedule] = snaps[-1][1]
 
-            last = self._last[schedule]
-            if interval != "months": # months is non-constant. See below.
-                util.debug("Recalculating %s schedule" % (schedule), \
-                           self.verbose)
-                try:
-                    totalinterval = intervals[interval] * period
-                except KeyError:
-                    self.exitCode = smf.SMF_EXIT_ERR_CONFIG
-                    self.logger.error(schedule + \
-                                      " schedule has invalid interval: " + \
-                                      "'%s\'" % interval)
-                    #Propogate up to thread's run() method
-                    raise RuntimeError
-                if [schedule,interval,period,keep] in self._defaultSchedules:
-                    # This is one of the default schedules so check for an
-                    # overlap with one of the dominant shchedules.
-                    for s,i,p,k in self._defaultSchedules[:idx]:
-                        last = max(last, self._last[s])
-                    idx += 1
-
-            else: # interval == "months"
-                if self._next[schedule] > last:
-                    util.debug("Short circuiting " + \
-                               schedule + \
-                               " recalculation", \
-                               self.verbose)
-                    continue
-                util.debug("Recalculating %s schedule" % (schedule), \
-                           self.verbose)
-                snap_tm = time.gmtime(self._last[schedule])
-                # Increment year if period >= than 1 calender year.
-                year = snap_tm.tm_year
-                year += period // 12
-                period = period % 12
-
-                mon = (snap_tm.tm_mon + period) % 12
-                # Result of 0 actually means december.
-                if mon == 0:
-                    mon = 12
-                # Account for period that spans calendar year boundary.
-                elif snap_tm.tm_mon + period > 12:
-                    year += 1
-
-                d,dlastmon = calendar.monthrange(snap_tm.tm_year, snap_tm.tm_mon)
-                d,dnewmon = calendar.monthrange(year, mon)
-                mday = snap_tm.tm_mday
-                if dlastmon > dnewmon and snap_tm.tm_mday > dnewmon:
-                   mday = dnewmon
-
-                tm =(year, mon, mday, \
-                    snap_tm.tm_hour, snap_tm.tm_min, snap_tm.tm_sec, \
-                    0, 0, -1)
-                newt = calendar.timegm(tm)
-                new_tm = time.gmtime(newt)
-                totalinterval = newt - self._last[schedule]
-
-            self._next[schedule] = last + totalinterval
+            util.debug("Recalculating %s schedule" % (schedule), \
+                       self.verbose)
+        self._scheduler.update(schedules)
 
     def _next_due(self):
-        schedule = None
-        earliest = None
-        now = int(time.time())
-
-        for s,i,p,k in self._defaultSchedules:
-            due = self._next[s]
-            if due <= now:
-                #Default Schedule - so break out at the first
-                #schedule that is overdue. The subordinate schedules
-                #will re-adjust afterwards.
-                earliest,schedule = due,s
-                break
-            elif earliest != None:
-                if due < earliest:
-                    earliest,schedule = due,s
-            else: #FIXME better optimisation with above condition
-                earliest,schedule = due,s
-        for s,i,p,k in self._customSchedules:
-            due = self._next[s]
-            if earliest != None:
-                if due < earliest:
-                    earliest,schedule = due,s
-            else: #FIXME better optimisation with above condition
-                earliest,schedule = due,s
-        return earliest,schedule
+        return self._scheduler.next_due(int(time.time()))
 
     def _check_snapshots(self):
         """
@@ -453,10 +706,27 @@ class SnapshotManager(threading.Thread):
         self._refreshLock.release()
         now = int(time.time())
         while next != None and next <= now:
-            label = self._take_snapshots(schedule)
+            if self._batchSnapshots == True:
+                due = self._collect_due(now)
+                with tracing.caller("schedule:%s" % ",".join(due)):
+                    self._take_snapshot_batch(due, now)
+                self._refreshLock.acquire()
+                next,schedule = self._next_due();
+                self._refreshLock.release()
+                if next != None:
+                    dt = datetime.datetime.fromtimestamp(next)
+                    util.debug("Next snapshot is %s due at: %s" % \
+                               (schedule, dt.isoformat()), \
+                               self.verbose)
+                continue
+            self._record_lag(schedule, next, int(time.time()))
+            with tracing.caller("schedule:%s" % schedule):
+                label = self._take_snapshots(schedule)
             # self._plugin.execute_plugins(schedule, label)
             self._refreshLock.acquire()
-            self._update_schedules()
+            # Only the schedule that fired and the ones overlapping
+            # with it need to be recalculated.
+            self._update_schedules(self._scheduler.get_dependents(schedule))
             next,schedule = self._next_due();
             self._refreshLock.release()
             dt = datetime.datetime.fromtimestamp(next)
@@ -465,15 +735,24 @@ class SnapshotManager(threading.Thread):
                        self.verbose)
         return next
 
+    def _record_lag(self, schedule, due, now):
+        # A schedule's first snapshot is due whenever it comes round.
+        if self._last[schedule] == 0:
+            return
+        _schedulerLag.observe(now - due, schedule)
+        _lastSchedulerLag.set(now - due, schedule)
+
     def _take_snapshots(self, schedule):
         # Set the time before taking snapshot to avoid clock skew due
         # to time taken to complete snapshot.
         tm = int(time.time())
         label = "%s%s%s-%s" % \
                 (autosnapsmf.SNAPLABELPREFIX, self._separator, schedule,
-                 datetime.datetime.now().strftime("%Y-%m-%d-%Hh%M"))
+                 datetime.datetime.fromtimestamp(tm).strftime("%Y-%m-%d-%Hh%M"))
+        start = time.monotonic()
         try:
-            self._datasets.create_auto_snapshot_set(label, tag=schedule)
+            skipped = self._datasets.create_auto_snapshot_set(label,
+                          tag=schedule, skipunchanged=self._skipUnchanged)
         except RuntimeError as message:
             # Write an error message, set the exit code and pass it up the
             # stack so the thread can terminate
@@ -481,12 +760,90 @@ class SnapshotManager(threading.Thread):
                              % (schedule))
             self.exitCode = smf.SMF_EXIT_MON_DEGRADE
             raise RuntimeError(message)
+        _snapshotDuration.observe(time.monotonic() - start, schedule)
+        _snapshotsTaken.inc(schedule)
+        self._record_skipped(schedule, skipped)
         self._last[schedule] = tm;
-        self._perform_purge(schedule)
+        self._perform_purge([schedule])
         return label
 
-    def _prune_snapshots(self, dataset, schedule):
-        """Cleans out zero sized snapshots, kind of cautiously"""
+    def _record_skipped(self, schedule, skipped):
+        if len(skipped) == 0:
+            return
+        _snapshotsSkipped.inc(schedule, amount=len(skipped))
+        util.debug("Skipped %d unchanged datasets for schedule %s" \
+                   % (len(skipped), schedule), self.verbose)
+
+    def _collect_due(self, now):
+        """
+        Returns all the schedules due at time now, in the order
+        _next_due() yields them, and reschedules them as if they had
+        fired. A default schedule dominated by another due one is only
+        included if it's still due once the overlap is accounted for.
+        """
+        due = []
+        self._refreshLock.acquire()
+        next,schedule = self._next_due()
+        while next != None and next <= now:
+            self._record_lag(schedule, next, now)
+            due.append(schedule)
+            self._last[schedule] = now
+            self._update_schedules(self._scheduler.get_dependents(schedule))
+            next,schedule = self._next_due()
+        self._refreshLock.release()
+        return due
+
+    def _take_snapshot_batch(self, schedules, tm):
+        """
+        Takes the snapshots of all the schedules together, with one
+        zfs(1) listing, as few snapshot operations as possible and
+        a single combined purge pass.
+        """
+        stamp = datetime.datetime.fromtimestamp(tm).strftime("%Y-%m-%d-%Hh%M")
+        labels = []
+        for schedule in schedules:
+            labels.append((schedule, "%s%s%s-%s" % \
+                           (autosnapsmf.SNAPLABELPREFIX, self._separator,
+                            schedule, stamp)))
+        util.debug("Taking %s snapshots together" % ", ".join(schedules), \
+                   self.verbose)
+        start = time.monotonic()
+        try:
+            inventories = \
+                self._datasets.get_auto_snapshot_inventories(schedules)
+            skipped = self._datasets.create_auto_snapshot_sets(labels,
+                          inventories, skipunchanged=self._skipUnchanged)
+        except RuntimeError as message:
+            # Write an error message, set the exit code and pass it up the
+            # stack so the thread can terminate
+            self.logger.error("Failed to create snapshots for schedules: %s" \
+                             % ", ".join(schedules))
+            self.exitCode = smf.SMF_EXIT_MON_DEGRADE
+            raise RuntimeError(message)
+        # The schedules' snapshots were all taken together, so each of
+        # them took as long as the lot.
+        elapsed = time.monotonic() - start
+        for schedule in schedules:
+            _snapshotDuration.observe(elapsed, schedule)
+            _snapshotsTaken.inc(schedule)
+            self._record_skipped(schedule, skipped[schedule])
+        self._perform_purge(schedules, inventories)
+        return labels
+
+    def _prune_snapshots(self, dataset, schedule, usage = None):
+        """
+        Cleans out zero sized snapshots, kind of cautiously.
+        usage is the dataset's snapshot usage table as returned by
+        _fetch_snapshot_usage(), if already at hand. Returns the table
+        if it's still up to date afterwards, None otherwise.
+        """
+        start = time.monotonic()
+        try:
+            return self._prune_dataset(dataset, schedule, usage)
+        finally:
+            _pruneDuration.observe(time.monotonic() - start, schedule)
+
+    def _prune_dataset(self, dataset, schedule, usage):
             # Per schedule: We want to delete 0 sized
             # snapshots but we need to keep at least one around (the most
             # recent one) for each schedule so that that overlap is
@@ -506,7 +863,7 @@ class SnapshotManager(threading.Thread):
             # the pool doesn't run low on available space before that.
 
         try:
-            snaps = dataset.list_snapshots("%s%s" % (self._prefix,schedule))
+            snaps = [s for s,t in dataset.list_snapshots(schedule=schedule)]
             # Clone the list because we want to remove items from it
             # while iterating through it.
             remainingsnaps = snaps[:]
@@ -515,77 +872,144 @@ class SnapshotManager(threading.Thread):
             self.exitCode = smf.SMF_EXIT_ERR_FATAL
             raise RuntimeError(message)
 
+        # Used sizes and user holds of all the dataset's snapshots,
+        # fetched in one go by _fetch_snapshot_usage()
+        userrefs = None
+
         if (self._keepEmpties == False):
             try: # remove the newest one from the list.
                 snaps.pop()
             except IndexError:
                 pass
-            for snapname in snaps:
-                try:
-                    snapshot = zfs.Snapshot(snapname)
-                except Exception as message:
-                    self.logger.error(str(message))
-                    # Not fatal, just skip to the next snapshot
+            # Destroying a snapshot can change the used size of its
+            # immediate neighbours (data shared only with the destroyed
+            # snapshot becomes unique to them), so neighbours are not
+            # trusted to be zero sized until the usage table has been
+            # fetched again.
+            while len(snaps) > 0:
+                if usage == None:
+                    usage = self._fetch_snapshot_usage(dataset)
+                order = [name for name,used,refs in usage]
+                position = dict([(name, idx) for idx,name in enumerate(order)])
+                userrefs = dict([(name, refs) for name,used,refs in usage])
+                stale = set()
+                doomed = []
+                for snapname in snaps[:]:
+                    if snapname in stale:
+                        continue
+                    snaps.remove(snapname)
+                    idx = position.get(snapname)
+                    if idx == None:
+                        # Already gone.
+                        remainingsnaps.remove(snapname)
+                        continue
+                    if usage[idx][1] != 0:
+                        continue
+                    util.debug("Destroying zero sized: " + snapname, \
+                               self.verbose)
+                    doomed.append(snapname)
+                    remainingsnaps.remove(snapname)
+                    if idx > 0:
+                        stale.add(order[idx - 1])
+                    if idx < len(order) - 1:
+                        stale.add(order[idx + 1])
+                # None of the snapshots in this round are neighbours of
+                # each other so they can all go in one batch.
+                if len(doomed) == 0:
                     continue
-
+                usage = None
                 try:
-                    if snapshot.get_used_size() == 0:
-                        util.debug("Destroying zero sized: " + snapname, \
-                                   self.verbose)
-                        try:
-                            snapshot.destroy()
-                        except RuntimeError as message:
-                            self.logger.error("Failed to destroy snapshot: " +
-                                             snapname)
-                            self.exitCode = smf.SMF_EXIT_MON_DEGRADE
-                            # Propogate exception so thread can exit
-                            raise RuntimeError(message)
-                        remainingsnaps.remove(snapname)
+                    self._datasets.destroy_snapshots(doomed,
+                                                     userrefs=userrefs)
                 except RuntimeError as message:
-                    self.logger.error("Can not determine used size of: " + \
-                                     snapname)
+                    self.logger.error("Failed to destroy snapshots: " +
+                                     ", ".join(doomed))
                     self.exitCode = smf.SMF_EXIT_MON_DEGRADE
-                    #Propogate the exception to the thead run() method
+                    # Propogate exception so thread can exit
                     raise RuntimeError(message)
+                _snapshotsDestroyed.inc("empty", amount=len(doomed))
 
         # Deleting individual snapshots instead of recursive sets
         # breaks the recursion chain and leaves child snapshots
         # dangling so we need to take care of cleaning up the
         # snapshots.
         target = len(remainingsnaps) - self._keep[schedule]
-        counter = 0
-        while counter < target:
-            util.debug("Destroy expired snapshot: " + \
-                       remainingsnaps[counter],
-                       self.verbose)
-            try:
-                snapshot = zfs.Snapshot(remainingsnaps[counter])
-            except Exception as message:
-                    self.logger.error(str(message))
-                    # Not fatal, just skip to the next snapshot
-                    counter += 1
-                    continue
-            try:
-                snapshot.destroy()
-            except RuntimeError as message:
-                self.logger.error("Failed to destroy snapshot: " +
-                                 snapshot.name)
-                self.exitCode = smf.SMF_EXIT_ERR_FATAL
-                # Propogate exception so thread can exit
-                raise RuntimeError(message)
-            else:
-                counter += 1
+        if target <= 0:
+            return usage
+        if userrefs == None:
+            if usage == None:
+                usage = self._fetch_snapshot_usage(dataset)
+            userrefs = dict([(name, refs) for name,used,refs in usage])
+        expired = []
+        for snapname in remainingsnaps[:target]:
+            # Skip over snapshots that are already gone.
+            if snapname in userrefs:
+                util.debug("Destroy expired snapshot: " + snapname,
+                           self.verbose)
+                expired.append(snapname)
+        if len(expired) == 0:
+            return usage
+        try:
+            self._datasets.destroy_snapshots(expired, userrefs=userrefs)
+        except RuntimeError as message:
+            self.logger.error("Failed to destroy snapshots: " +
+                             ", ".join(expired))
+            self.exitCode = smf.SMF_EXIT_ERR_FATAL
+            # Propogate exception so thread can exit
+            raise RuntimeError(message)
+        _snapshotsDestroyed.inc("expired", amount=len(expired))
+        return None
 
-    def _perform_purge(self, schedule):
-        """Cautiously cleans out zero sized snapshots"""
+    def _fetch_snapshot_usage(self, dataset):
+        try:
+            return dataset.list_snapshot_usage()
+        except RuntimeError as message:
+            self.logger.error("Can not determine used size of " \
+                             "snapshots of: " + dataset.name)
+            self.exitCode = smf.SMF_EXIT_MON_DEGRADE
+            #Propogate the exception to the thead run() method
+            raise RuntimeError(message)
+
+    def _perform_purge(self, schedules, inventories = None):
+        """
+        Cautiously cleans out zero sized snapshots of the schedules.
+        Each dataset is visited once for all of the schedules.
+        """
         # We need to avoid accidentally pruning auto snapshots received
         # from one zpool to another. We ensure this by examining only
         # snapshots whose parent fileystems and volumes are explicitly
         # tagged to be snapshotted.
         try:
-            for name in self._datasets.list_auto_snapshot_sets(schedule):
+            if inventories == None:
+                inventories = \
+                    self._datasets.get_auto_snapshot_inventories(schedules)
+            self._inventoryLock.acquire()
+            self._inventories.update(inventories)
+            self._inventoryLock.release()
+            sets = {}
+            for schedule in schedules:
+                for name in inventories[schedule].list_included():
+                    sets.setdefault(name, []).append(schedule)
+            for name in sorted(sets.keys()):
+                # Leave zpools alone while a remedial cleanup is destroying
+                # their snapshots. They get purged on the next run.
+                poolname = name.split("/", 1)[0]
+                lock = self._get_cleanup_lock(poolname)
+                if lock.acquire(False) == False:
+                    util.debug("Cleanup running on %s. Not purging %s" \
+                               % (poolname, name), \
+                               self.verbose)
+                    continue
                 dataset = zfs.ReadWritableDataset(name)
-                self._prune_snapshots(dataset, schedule)
+                try:
+                    # The snapshot usage table stays valid from one
+                    # schedule to the next until something is destroyed.
+                    usage = None
+                    for schedule in sets[name]:
+                        usage = self._prune_snapshots(dataset, schedule,
+                                                      usage)
+                finally:
+                    lock.release()
         except RuntimeError as message:
             self.logger.error("Error listing datasets during " + \
                              "removal of expired snapshots")
@@ -593,101 +1017,219 @@ class SnapshotManager(threading.Thread):
             # Propogate up to thread's run() method
             raise RuntimeError(message)
 
+    def query_snapshots(self, pool = None, dataset = None, schedule = None,
+                        offset = 0, limit = None):
+        """
+        Returns a page of the snapshots matching the filters, oldest
+        first, from the snapshot cache as it stands. Rescans are left
+        to the snapshot manager thread, so as not to hold up the main
+        loop. See zfs.SnapshotCache.list_page()
+        """
+        return zfs.Datasets.snapshots.list_page(pool, dataset, schedule,
+                                                offset, limit, cached=True)
+
+    def refresh_snapshots(self):
+        """
+        Asks the snapshot manager thread to rescan all snapshots. See
+        _refresh_snapshot_cache()
+        """
+        self._snapshotRefreshDue = True
+        self._wake()
+
+    def query_auto_snapshot_sets(self, schedule):
+        """
+        Returns the filesystems and volumes included in the schedule's
+        snapshots, as of the schedule's last snapshot if possible.
+        """
+        self._inventoryLock.acquire()
+        inventory = self._inventories.get(schedule)
+        self._inventoryLock.release()
+        if inventory == None:
+            with tracing.caller("query"):
+                inventories = \
+                    self._datasets.get_auto_snapshot_inventories([schedule])
+            inventory = inventories[schedule]
+            self._inventoryLock.acquire()
+            self._inventories.setdefault(schedule, inventory)
+            self._inventoryLock.release()
+        return inventory.list_included()
+
+    def query_pool_capacity(self):
+        """
+        Returns a dictionary of the (used, available) byte counts of the
+        zpools, as last sampled by the capacity monitor if possible.
+        """
+        names = [zpool.name for zpool in self._zpools]
+        result = self._capacityMonitor.get_samples()
+        missing = [name for name in names if name not in result]
+        if len(missing) > 0:
+            with tracing.caller("query"):
+                result.update(zfs.get_zpool_space(missing))
+        return dict([(name, result[name]) for name in names \
+                     if name in result])
+
+    def _get_cleanup_lock(self, poolname):
+        """
+        Returns the lock that is held while a remedial cleanup or
+        a purge is running on the named zpool.
+        """
+        self._cleanupLock.acquire()
+        lock = self._cleanupLocks.setdefault(poolname, threading.Lock())
+        self._cleanupLock.release()
+        return lock
+
+    def _capacity_exceeded(self, poolname):
+        """
+        Called by the capacity monitor when a zpool exceeds one
+        of the cleanup levels. Wakes up run() to deal with it.
+        """
+        self._cleanupLock.acquire()
+        self._cleanupDue.add(poolname)
+        self._cleanupLock.release()
+        self._wake()
+
     def _needs_cleanup(self):
+        """
+        Returns the list of zpools that need a remedial cleanup and
+        don't already have one running.
+        """
+        self._cleanupLock.acquire()
+        due = self._cleanupDue
+        self._cleanupDue = set()
+        self._cleanupLock.release()
         if self._remedialCleanup == False:
             # Sys admin has explicitly instructed for remedial cleanups
             # not to be performed.
-            return False
-        now = int(time.time())
-        # Don't run checks any less than 15 minutes apart.
-        if self._cleanupLock.acquire(False) == False:
-            #Indicates that a cleanup is already running.
-            return False
-        # FIXME - Make the cleanup interval equal to the minimum snapshot interval
-        # if custom snapshot schedules are defined and enabled.
-        elif ((now - self._lastCleanupCheck) < (_MINUTE * 15)):
-            pass
-        else:
-            for zpool in self._zpools:
-                try:
-                    if zpool.get_capacity() > self._warningLevel:
-                        # Before getting into a panic, determine if the pool
-                        # is one we actually take snapshots on, by checking
-                        # for one of the "auto-snapshot:<schedule> tags. Not
-                        # super fast, but it only happens under exceptional
-                        # circumstances of a zpool nearing it's capacity.
-
-                        for sched in self._allSchedules:
-                            sets = zpool.list_auto_snapshot_sets(sched[0])
-                            if len(sets) > 0:
-                                util.debug("%s needs a cleanup" \
-                                           % zpool.name, \
-                                           self.verbose)
-                                self._cleanupLock.release()
-                                return True
-                except RuntimeError as message:
-                    self.logger.error("Error checking zpool capacity of: " + \
-                                     zpool.name)
-                    self._cleanupLock.release()
-                    self.exitCode = smf.SMF_EXIT_ERR_FATAL
-                    # Propogate up to thread's run() mehod.
-                    raise RuntimeError(message)
-            self._lastCleanupCheck = int(time.time())
-        self._cleanupLock.release()
-        return False
-
-    def _perform_cleanup(self):
-        if self._cleanupLock.acquire(False) == False:
-            # Cleanup already running. Skip
-            return
-        self._destroyedsnaps = []
+            return []
+        zpools = []
         for zpool in self._zpools:
+            if zpool.name not in due:
+                continue
+            if self._get_cleanup_lock(zpool.name).locked():
+                #Indicates that a cleanup is already running.
+                continue
             try:
-                self._poolstatus[zpool.name] = 0
-                capacity = zpool.get_capacity()
-                if capacity > self._warningLevel:
-                    self._run_warning_cleanup(zpool)
-                    self._poolstatus[zpool.name] = 1
-                    capacity = zpool.get_capacity()
-                if capacity > self._criticalLevel:
-                    self._run_critical_cleanup(zpool)
-                    self._poolstatus[zpool.name] = 2
-                    capacity = zpool.get_capacity()
-                if capacity > self._emergencyLevel:
-                    self._run_emergency_cleanup(zpool)
-                    self._poolstatus[zpool.name] = 3
-                    capacity = zpool.get_capacity()
-                if capacity > self._emergencyLevel:
-                    self._run_emergency_cleanup(zpool)
-                    self._poolstatus[zpool.name] = 4
-            # This also catches exceptions thrown from _run_<level>_cleanup()
-            # and _run_cleanup() in methods called by _perform_cleanup()
+                # Before getting into a panic, determine if the pool
+                # is one we actually take snapshots on, by checking
+                # for one of the "auto-snapshot:<schedule> tags. Not
+                # super fast, but it only happens under exceptional
+                # circumstances of a zpool nearing it's capacity.
+                for sched in self._allSchedules:
+                    sets = zpool.list_auto_snapshot_sets(sched[0])
+                    if len(sets) > 0:
+                        util.debug("%s needs a cleanup" \
+                                   % zpool.name, \
+                                   self.verbose)
+                        zpools.append(zpool)
+                        break
             except RuntimeError as message:
-                self.logger.error("Remedial space cleanup failed because " + \
-                                 "of failure to determinecapacity of: " + \
+                self.logger.error("Error checking auto snapshot sets of: " + \
                                  zpool.name)
                 self.exitCode = smf.SMF_EXIT_ERR_FATAL
-                self._cleanupLock.release()
-                # Propogate up to thread's run() method.
+                # Propogate up to thread's run() mehod.
                 raise RuntimeError(message)
+        return zpools
 
-            # Bad - there's no more snapshots left and nothing
-            # left to delete. We don't disable the service since
-            # it will permit self recovery and snapshot
-            # retention when space becomes available on
-            # the pool (hopefully).
-            util.debug("%s pool status after cleanup:" \
-                       % zpool.name, \
-                       self.verbose)
-            util.debug(zpool, self.verbose)
-        util.debug("Cleanup completed. %d snapshots were destroyed" \
-                   % len(self._destroyedsnaps), \
+    def _perform_cleanup(self, zpools):
+        """
+        Hands the zpools over to the cleanup workers. Returns without
+        waiting for the cleanups to complete.
+        """
+        for zpool in zpools:
+            lock = self._get_cleanup_lock(zpool.name)
+            if lock.acquire(False) == False:
+                # Cleanup already running. Skip
+                continue
+            future = self._cleanupExecutor.submit(self._cleanup_pool,
+                                                  zpool, lock)
+            future.add_done_callback(self._cleanup_done)
+
+    def _cleanup_done(self, future):
+        """
+        Called when a cleanup worker is done. Makes sure whatever it
+        raised doesn't get lost with the future.
+        """
+        if future.cancelled() == True:
+            return
+        error = future.exception()
+        if error != None:
+            self.logger.error("Remedial space cleanup failed: %s" \
+                              % str(error))
+            self._cleanup_failed(error)
+
+    def _cleanup_failed(self, message):
+        """
+        Hands a cleanup failure over to the thread's run() method and
+        wakes it up.
+        """
+        self.exitCode = smf.SMF_EXIT_ERR_FATAL
+        self._cleanupError = message
+        self._wake()
+
+    def _cleanup_pool(self, zpool, lock):
+        """
+        Runs in a cleanup worker. Releases lock, which the caller must
+        have acquired, when done, whatever happens.
+        """
+        try:
+            with tracing.caller("cleanup:%s" % zpool.name):
+                self._cleanup_pool_locked(zpool)
+            zfs.Datasets.snapshots.flush()
+        finally:
+            lock.release()
+
+    def _cleanup_pool_locked(self, zpool):
+        self._destroyedsnaps[zpool.name] = []
+        try:
+            self._poolstatus[zpool.name] = 0
+            capacity = zpool.get_capacity()
+            if capacity > self._warningLevel:
+                self._run_warning_cleanup(zpool)
+                self._poolstatus[zpool.name] = 1
+                capacity = zpool.get_capacity()
+            if capacity > self._criticalLevel:
+                self._run_critical_cleanup(zpool)
+                self._poolstatus[zpool.name] = 2
+                capacity = zpool.get_capacity()
+            if capacity > self._emergencyLevel:
+                self._run_emergency_cleanup(zpool)
+                self._poolstatus[zpool.name] = 3
+                capacity = zpool.get_capacity()
+            if capacity > self._emergencyLevel:
+                self._run_emergency_cleanup(zpool)
+                self._poolstatus[zpool.name] = 4
+        # This also catches exceptions thrown from _run_<level>_cleanup()
+        # and _run_cleanup() in methods called by _cleanup_pool(),
+        # including zfs.ZPoolFaultedError for a faulted zpool.
+        except Exception as message:
+            self.logger.error("Remedial space cleanup failed because " + \
+                             "of failure to determinecapacity of: " + \
+                             zpool.name)
+            self._cleanup_failed(message)
+            return
+
+        # Bad - there's no more snapshots left and nothing
+        # left to delete. We don't disable the service since
+        # it will permit self recovery and snapshot
+        # retention when space becomes available on
+        # the pool (hopefully).
+        util.debug("%s pool status after cleanup:" \
+                   % zpool.name, \
+                   self.verbose)
+        util.debug(zpool, self.verbose)
+        destroyedsnaps = self._destroyedsnaps[zpool.name]
+        util.debug("Cleanup of %s completed. %d snapshots were destroyed" \
+                   % (zpool.name, len(destroyedsnaps)), \
                    self.verbose)
         # Avoid needless list iteration for non-debug mode
-        if self.verbose == True and len(self._destroyedsnaps) > 0:
-            for snap in self._destroyedsnaps:
+        if self.verbose == True and len(destroyedsnaps) > 0:
+            for snap in destroyedsnaps:
                 self.logger.error("\t%s" % snap)
-        self._cleanupLock.release()
+        # Check to see if cleanup actually deleted anything before
+        # notifying the user. Avoids the popup appearing continuously
+        if len(destroyedsnaps) > 0:
+            self._send_notification(zpool)
+        self._send_to_syslog(zpool)
 
     def _run_warning_cleanup(self, zpool):
         util.debug("Performing warning level cleanup on %s" % \
@@ -728,10 +1270,18 @@ class SnapshotManager(threading.Thread):
                 self._run_cleanup(zpool, schedule, self._emergencyLevel)
 
     def _run_cleanup(self, zpool, schedule, threshold):
+        start = time.monotonic()
+        try:
+            self._run_schedule_cleanup(zpool, schedule, threshold)
+        finally:
+            _cleanupDuration.observe(time.monotonic() - start,
+                                     zpool.name, schedule)
+
+    def _run_schedule_cleanup(self, zpool, schedule, threshold):
         clonedsnaps = []
         snapshots = []
         try:
-            clonedsnaps = self._datasets.list_cloned_snapshots()
+            clonedsnaps = set(self._datasets.list_cloned_snapshots())
         except RuntimeError as message:
                 self.logger.error("Error (non-fatal) listing cloned snapshots" +
                                  " while recovering pool capacity")
@@ -741,13 +1291,11 @@ class SnapshotManager(threading.Thread):
                                  "\n--------END ERROR MESSAGE--------")
 
         # Build a list of snapshots in the given schedule, that are not
-        # cloned, and sort the result in reverse chronological order.
+        # cloned, oldest first.
         try:
             snapshots = [s for s,t in \
-                            zpool.list_snapshots("%s%s" \
-                            % (self._prefix,schedule)) \
+                            zpool.list_snapshots(schedule=schedule) \
                             if not s in clonedsnaps]
-            snapshots.reverse()
         except RuntimeError as message:
             self.logger.error("Error listing snapshots" +
                              " while recovering pool capacity")
@@ -755,101 +1303,103 @@ class SnapshotManager(threading.Thread):
             # Propogate the error up to the thread's run() method.
             raise RuntimeError(message)
 
-        while zpool.get_capacity() > threshold:
-            if len(snapshots) == 0:
+        """This is not an exact science. Deleteing a zero sized
+        snapshot can have unpredictable results. For example a
+        pair of snapshots may share exclusive reference to a large
+        amount of data (eg. a large core file). The usage of both
+        snapshots will initially be seen to be 0 by zfs(1). Deleting
+        one of the snapshots will make the data become unique to the
+        single remaining snapshot that references it uniquely. The
+        remaining snapshot's size will then show up as non zero. So
+        deleting 0 sized snapshot is not as pointless as it might seem.
+        The planner accounts for this by asking zfs(1) for a dry run
+        estimate of what destroying a whole set of snapshots frees,
+        rather than destroying one at a time and observing the before
+        and after results."""
+        planner = cleanup.CleanupPlanner(zpool, self._datasets)
+        while True:
+            plan = planner.plan(snapshots, threshold)
+            if plan.needed <= 0:
+                return
+            if len(plan.snapshots) == 0:
                 self.logger.info( \
                               "No more %s snapshots left" \
                                % schedule)
                 return
+            if self._cleanupPlanOnly == True:
+                # Only report what would be done.
+                self.logger.info(str(plan))
+                return
 
-            """This is not an exact science. Deleteing a zero sized
-            snapshot can have unpredictable results. For example a
-            pair of snapshots may share exclusive reference to a large
-            amount of data (eg. a large core file). The usage of both
-            snapshots will initially be seen to be 0 by zfs(1). Deleting
-            one of the snapshots will make the data become unique to the
-            single remaining snapshot that references it uniquely. The
-            remaining snapshot's size will then show up as non zero. So
-            deleting 0 sized snapshot is not as pointless as it might seem.
-            It also means we have to loop through this, each snapshot set
-            at a time and observe the before and after results. Perhaps
-            better way exists...."""
-
-            # Start with the oldest first
-            snapname = snapshots.pop()
-            snapshot = zfs.Snapshot(snapname)
             # It would be nicer, for performance purposes, to delete sets
             # of snapshots recursively but this might destroy more data than
             # absolutely necessary, plus the previous purging of zero sized
             # snapshots can easily break the recursion chain between
             # filesystems.
-            # On the positive side there should be fewer snapshots and they
-            # will mostly non-zero so we should get more effectiveness as a
-            # result of deleting snapshots since they should be nearly always
-            # non zero sized.
-            util.debug("Destroying %s" % snapname, self.verbose)
+            util.debug(str(plan), self.verbose)
             try:
-                snapshot.destroy()
+                self._datasets.destroy_snapshots(plan.snapshots)
             except RuntimeError as message:
                 # Would be nice to be able to mark service as degraded here
                 # but it's better to try to continue on rather than to give
                 # up alltogether (SMF maintenance state)
-                self.logger.error("Warning: Cleanup failed to destroy: %s" % \
-                                 (snapshot.name))
+                self.logger.error("Warning: Cleanup failed to destroy " \
+                                 "%s snapshots" % (schedule))
                 self.logger.error("Details:\n%s" % (str(message)))
-            else:
-                self._destroyedsnaps.append(snapname)
-            # Give zfs some time to recalculate.
-            time.sleep(3)
-
-    def _send_to_syslog(self):
-        for zpool in self._zpools:
-            status = self._poolstatus[zpool.name]
-            if status == 4:
-                self.logger.critical( \
-                              "All automatic snapshots were destroyed" \
-                               % (zpool.name, self._emergencyLevel))
-            elif status == 3:
-                self.logger.error( \
-                              "%s exceeded %d%% capacity. " \
-                              "Automatic snapshots over 1 hour old were destroyed" \
-                               % (zpool.name, self._emergencyLevel))
-            elif status == 2:
-                self.logger.critical( \
-                              "%s exceeded %d%% capacity. " \
-                              "Weekly, hourly and daily automatic snapshots were destroyed" \
-                               % (zpool.name, self._criticalLevel))
-            elif status == 1:
-                self.logger.warning( \
-                              "%s exceeded %d%% capacity. " \
-                              "Hourly and daily automatic snapshots were destroyed" \
-                               % (zpool.name, self._warningLevel))
-
-        if len(self._destroyedsnaps) > 0:
+                return
+            self._destroyedsnaps[zpool.name].extend(plan.snapshots)
+            _snapshotsDestroyed.inc("cleanup", amount=len(plan.snapshots))
+            snapshots = snapshots[len(plan.snapshots):]
+            if plan.exhausted == True:
+                self.logger.info( \
+                              "No more %s snapshots left" \
+                               % schedule)
+                return
+            # Give zfs some time to recalculate before checking whether
+            # the estimate held up.
+            zpool.wait_for_freeing()
+
+    def _send_to_syslog(self, zpool):
+        status = self._poolstatus[zpool.name]
+        if status == 4:
+            self.logger.critical( \
+                          "%s exceeded %d%% capacity. " \
+                          "All automatic snapshots were destroyed" \
+                           % (zpool.name, self._emergencyLevel))
+        elif status == 3:
+            self.logger.error( \
+                          "%s exceeded %d%% capacity. " \
+                          "Automatic snapshots over 1 hour old were destroyed" \
+                           % (zpool.name, self._emergencyLevel))
+        elif status == 2:
+            self.logger.critical( \
+                          "%s exceeded %d%% capacity. " \
+                          "Weekly, hourly and daily automatic snapshots were destroyed" \
+                           % (zpool.name, self._criticalLevel))
+        elif status == 1:
             self.logger.warning( \
-                          "%d automatic snapshots were destroyed" \
-                           % len(self._destroyedsnaps))
+                          "%s exceeded %d%% capacity. " \
+                          "Hourly and daily automatic snapshots were destroyed" \
+                           % (zpool.name, self._warningLevel))
 
-    def _send_notification(self):
-        worstpool = None
-        worststatus = 0
+        destroyedsnaps = self._destroyedsnaps[zpool.name]
+        if len(destroyedsnaps) > 0:
+            self.logger.warning( \
+                          "%d automatic snapshots were destroyed on %s" \
+                           % (len(destroyedsnaps), zpool.name))
 
-        for zpool in self._zpools:
-            status = self._poolstatus[zpool.name]
-            # >= to ensure that something should always be set.
-            if status >= worststatus:
-                worstpool = zpool.name
-                worststatus = status
+    def _send_notification(self, zpool):
+        status = self._poolstatus[zpool.name]
 
         #FIXME make the various levels indexible
-        if worststatus == 4:
-            self._dbus.capacity_exceeded(worstpool, 4, self._emergencyLevel)
-        elif worststatus == 3:
-            self._dbus.capacity_exceeded(worstpool, 3, self._emergencyLevel)
-        elif worststatus == 2:
-            self._dbus.capacity_exceeded(worstpool, 2, self._criticalLevel)
-        elif worststatus == 1:
-            self._dbus.capacity_exceeded(worstpool, 1, self._warningLevel)
+        if status == 4:
+            self._dbus.capacity_exceeded(zpool.name, 4, self._emergencyLevel)
+        elif status == 3:
+            self._dbus.capacity_exceeded(zpool.name, 3, self._emergencyLevel)
+        elif status == 2:
+            self._dbus.capacity_exceeded(zpool.name, 2, self._criticalLevel)
+        elif status == 1:
+            self._dbus.capacity_exceeded(zpool.name, 1, self._warningLevel)
         #elif: 0 everything is fine. Do nothing.
 
 
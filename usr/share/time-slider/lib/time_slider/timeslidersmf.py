@@ -63,6 +63,18 @@ class TimeSliderSMF(smf.SMFInstance):
         else:
             return False
 
+    def get_batch_snapshots(self):
+        if self.get_prop(ZFSPROPGROUP, "batch-snapshots") == "true":
+            return True
+        else:
+            return False
+
+    def get_skip_unchanged(self):
+        if self.get_prop(ZFSPROPGROUP, "skip-unchanged") == "true":
+            return True
+        else:
+            return False
+
     def is_custom_selection(self):
         value = self.get_prop(ZFSPROPGROUP, "custom-selection")
         if value == "true":
@@ -83,6 +95,13 @@ class TimeSliderSMF(smf.SMFInstance):
         else:
             return True
 
+    def get_cleanup_plan_only(self):
+        value = self.get_prop(ZPOOLPROPGROUP, "cleanup-plan-only")
+        if value == "true":
+            return True
+        else:
+            return False
+
     def get_cleanup_level(self, cleanupType):
         if cleanupType not in cleanupTypes:
             raise ValueError("\'%s\' is not a valid cleanup type" % \
@@ -127,6 +146,31 @@ class TimeSliderSMF(smf.SMFInstance):
         else:
             return False
 
+    def get_command_helpers(self):
+        value = self.get_prop(DAEMONPROPGROUP, "command-helpers")
+        return int(value)
+
+    def get_zfs_backend(self):
+        return self.get_prop(DAEMONPROPGROUP, "zfs-backend")
+
+    def get_metrics_port(self):
+        value = self.get_prop(DAEMONPROPGROUP, "metrics-port")
+        return int(value)
+
+    def get_metrics_textfile(self):
+        return self.get_prop(DAEMONPROPGROUP, "metrics-textfile")
+
+    def get_trace_buffer(self):
+        value = self.get_prop(DAEMONPROPGROUP, "trace-buffer")
+        return int(value)
+
+    def get_slow_command_threshold(self):
+        value = self.get_prop(DAEMONPROPGROUP, "slow-command-threshold")
+        return int(value)
+
+    def get_snapshot_catalog(self):
+        return self.get_prop(DAEMONPROPGROUP, "snapshot-catalog")
+
     def __eq__(self, other):
         if self.fs_name == other.fs_name and \
            self.interval == other.interval and \
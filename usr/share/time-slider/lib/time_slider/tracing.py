@@ -0,0 +1,228 @@
+#!/usr/bin/python3
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+"""
+Records a span for every command run through util.run_command(): what
+was run, on whose behalf, from where in the code, how long it took,
+how much output it produced and how it exited. The most recent spans
+are kept in a ring buffer that can be dumped as JSON, and commands
+slower than a threshold are logged as they complete.
+
+Callers say on whose behalf commands are run with caller(), eg.
+
+    with tracing.caller("schedule:hourly"):
+        ...
+
+Commands run outside of any caller() block are attributed to the
+program itself.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import collections
+import contextlib
+
+# Number of spans kept by default
+DEFAULT_CAPACITY = 1000
+# Commands taking longer than this many seconds are logged. 0 disables
+# the slow command log.
+DEFAULT_THRESHOLD = 0
+
+# Longest argument list kept in a span, in characters
+MAX_ARGV = 256
+
+# Frames of these modules are skipped when looking for the call site
+_INTERNAL = ("util.py", "tracing.py")
+
+_local = threading.local()
+
+
+def _program():
+    if len(sys.argv) > 0 and len(sys.argv[0]) > 0:
+        return os.path.basename(sys.argv[0])
+    return "python"
+
+
+@contextlib.contextmanager
+def caller(name):
+    """
+    Attributes the commands run by the current thread inside the
+    with block to name. Nested blocks are joined with "/".
+    """
+    stack = getattr(_local, "callers", None)
+    if stack == None:
+        stack = []
+        _local.callers = stack
+    stack.append(name)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+def get_caller():
+    """
+    Returns whom the current thread is running commands for
+    """
+    stack = getattr(_local, "callers", None)
+    if stack == None or len(stack) == 0:
+        return _program()
+    return "/".join(stack)
+
+def get_call_site():
+    """
+    Returns "module:function:line" of the innermost frame outside of
+    run_command() and this module.
+    """
+    frame = sys._getframe(1)
+    while frame != None and \
+          os.path.basename(frame.f_code.co_filename) in _INTERNAL:
+        frame = frame.f_back
+    if frame == None:
+        return None
+    module = os.path.splitext(os.path.basename(frame.f_code.co_filename))[0]
+    return "%s:%s:%d" % (module, frame.f_code.co_name, frame.f_lineno)
+
+def summarise(command):
+    """
+    Returns command as a single string, cut short if it's very long
+    """
+    result = " ".join([str(arg) for arg in command])
+    if len(result) > MAX_ARGV:
+        result = result[:MAX_ARGV - 3] + "..."
+    return result
+
+
+class Span:
+    """
+    One command run
+    """
+    __slots__ = ("started", "argv", "command", "caller", "site", "thread",
+                 "duration", "outsize", "status")
+
+    def __init__(self, command, name):
+        self.started = time.time()
+        self.argv = summarise(command)
+        self.command = name
+        self.caller = get_caller()
+        self.site = get_call_site()
+        self.thread = threading.current_thread().name
+        self.duration = None
+        self.outsize = 0
+        # Exit status, or None if the command couldn't be run at all
+        self.status = None
+
+    def as_dict(self):
+        return dict([(name, getattr(self, name)) for name in self.__slots__])
+
+    def __str__(self):
+        return "%.3fs %s (caller %s, at %s, status %s, %d bytes output)" \
+               % (self.duration, self.argv, self.caller, self.site,
+                  self.status, self.outsize)
+
+
+class Tracer:
+    """
+    Keeps the most recent spans and logs the slow ones
+    """
+    def __init__(self, capacity = DEFAULT_CAPACITY,
+                 threshold = DEFAULT_THRESHOLD):
+        self._lock = threading.Lock()
+        self._spans = collections.deque(maxlen=capacity)
+        self.threshold = threshold
+        self.logger = logging.getLogger('time-slider')
+
+    def configure(self, capacity, threshold):
+        """
+        Changes the number of spans kept, keeping the most recent
+        ones, and the slow command threshold in seconds.
+        """
+        self._lock.acquire()
+        if capacity != self._spans.maxlen:
+            self._spans = collections.deque(self._spans, maxlen=capacity)
+        self.threshold = threshold
+        self._lock.release()
+
+    def start(self, command, name):
+        """
+        Returns a new span for command, with name as its short name
+        """
+        return Span(command, name)
+
+    def finish(self, span, elapsed, outsize, status):
+        span.duration = elapsed
+        span.outsize = outsize
+        span.status = status
+        self._lock.acquire()
+        self._spans.append(span)
+        threshold = self.threshold
+        self._lock.release()
+        if threshold > 0 and elapsed >= threshold:
+            self.logger.warning("Slow command: %s" % str(span))
+
+    def get_spans(self):
+        """
+        Returns the spans kept, oldest first
+        """
+        self._lock.acquire()
+        spans = list(self._spans)
+        self._lock.release()
+        return spans
+
+    def get_summary(self):
+        """
+        Returns a list of (caller, site, command, count, total duration)
+        tuples of the spans kept, most time consuming first.
+        """
+        totals = {}
+        for span in self.get_spans():
+            key = (span.caller, span.site, span.command)
+            count,duration = totals.get(key, (0, 0.0))
+            totals[key] = (count + 1, duration + span.duration)
+        result = [key + value for key,value in totals.items()]
+        result.sort(key=lambda entry: entry[4], reverse=True)
+        return result
+
+    def dump(self, path):
+        """
+        Writes the spans kept and their summary to path as JSON
+        """
+        spans = self.get_spans()
+        summary = [dict(zip(("caller", "site", "command", "count",
+                             "duration"), entry)) \
+                   for entry in self.get_summary()]
+        tmppath = "%s.%d.tmp" % (path, os.getpid())
+        f = open(tmppath, "w")
+        try:
+            json.dump({"pid" : os.getpid(),
+                       "dumped" : time.time(),
+                       "summary" : summary,
+                       "spans" : [span.as_dict() for span in spans]},
+                      f, indent=1)
+        finally:
+            f.close()
+        os.rename(tmppath, path)
+
+tracer = Tracer()
@@ -25,9 +25,64 @@ import subprocess
 import sys
 import syslog
 import math
+import time
 import gio
 import logging
 
+from . import metrics
+from . import tracing
+
+commandsrun = metrics.Counter("timeslider_commands_total",
+                              "Commands run through run_command()",
+                              ["command"])
+commandfailures = metrics.Counter("timeslider_command_failures_total",
+                                  "Commands that failed to run or " \
+                                  "exited with a non-zero status",
+                                  ["command"])
+commandduration = metrics.Histogram("timeslider_command_duration_seconds",
+                                    "Time taken by commands run through " \
+                                    "run_command()",
+                                    ["command"])
+
+def command_name(command):
+    """
+    Returns a short name for command, suitable for grouping commands
+    by: the program's base name, followed by its subcommand if it has
+    one, eg. "zfs list".
+    """
+    args = list(command)
+    if len(args) > 1 and os.path.basename(args[0]) == "pfexec":
+        args = args[1:]
+    if len(args) == 0:
+        return ""
+    name = os.path.basename(args[0])
+    if len(args) > 1 and args[1].isalpha():
+        name = "%s %s" % (name, args[1])
+    return name
+
+def _record_command(name, elapsed, failed):
+    commandsrun.inc(name)
+    if failed == True:
+        commandfailures.inc(name)
+    commandduration.observe(elapsed, name)
+
+# When set, run_command() hands commands to this object's run() method
+# instead of forking them itself. See set_command_backend().
+_commandBackend = None
+
+def set_command_backend(backend):
+    """
+    Makes run_command() execute commands through backend, an object
+    with a run(command) method returning a tuple of standard out,
+    standard error and exit status, such as a
+    cmdhelper.CommandHelperPool. Returns the previous backend.
+    None restores running commands directly.
+    """
+    global _commandBackend
+    previous = _commandBackend
+    _commandBackend = backend
+    return previous
+
 def run_command(command, raise_on_try=True):
     """
     Wrapper function around subprocess.Popen
@@ -35,20 +90,34 @@ def run_command(command, raise_on_try=True):
     Throws a RunTimeError if the command failed to execute or
     if the command returns a non-zero exit status.
 
-    Assume the output is UTF-8 encoded
+    Assume the output is UTF-8 encoded. Bytes that aren't are
+    decoded with surrogateescape, the same as by the command helper.
     """
 
     debug("Trying to run command %s" % (command), True)
+    span = tracing.tracer.start(command, command_name(command))
+    start = time.monotonic()
+    backend = _commandBackend
     try:
-        p = subprocess.Popen(command,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             close_fds=True)
-        outdata,errdata = (x.decode('utf-8') for x in p.communicate())
-        err = p.wait()
+        if backend == None:
+            p = subprocess.Popen(command,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 close_fds=True)
+            outdata,errdata = (x.decode('utf-8', 'surrogateescape') \
+                               for x in p.communicate())
+            err = p.wait()
+        else:
+            outdata,errdata,err = backend.run(command)
     except OSError as message:
+        elapsed = time.monotonic() - start
+        _record_command(span.command, elapsed, True)
+        tracing.tracer.finish(span, elapsed, 0, None)
         raise RuntimeError("%s subprocess error:\n %s" % \
                             (command, str(message)))
+    elapsed = time.monotonic() - start
+    _record_command(span.command, elapsed, err != 0)
+    tracing.tracer.finish(span, elapsed, len(outdata) + len(errdata), err)
     if err != 0 and raise_on_try:
         raise RuntimeError('%s failed with exit code %d\n%s' % \
                             (str(command), err, errdata))
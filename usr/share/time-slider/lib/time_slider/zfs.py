@@ -23,9 +23,12 @@
 import subprocess
 import re
 import threading
-from bisect import insort, bisect_left, bisect_right
+import time
+from bisect import insort, bisect_left
 
 from . import util
+from . import zfsbackend
+from .autosnapsmf import SNAPLABELPREFIX
 
 BYTESPERMB = 1048576
 
@@ -34,6 +37,393 @@ PFCMD = "/usr/bin/pfexec"
 ZFSCMD = "/usr/sbin/zfs"
 ZPOOLCMD = "/usr/sbin/zpool"
 
+# Maximum age in seconds of the snapshot cache before a full rescan is
+# done in order to pick up snapshots created or destroyed by others.
+SNAPSHOT_CACHE_TTL = 60 * 60
+
+# Snapshot labels generated by time-slider look like:
+# zfs-auto-snap_<schedule>-YYYY-MM-DD-HHhMM
+# where the separator is ":" for older snapshots and user definable
+# otherwise.
+AUTOSNAPLABEL = re.compile(r"^%s.(.+)-\d{4}-\d{2}-\d{2}-\d{2}h\d{2}$" \
+                           % SNAPLABELPREFIX)
+
+
+# Backend creating, destroying, holding and releasing snapshots.
+# Picked on first use unless set with set_backend().
+_backend = None
+_backendlock = threading.Lock()
+
+def get_backend():
+    """
+    Returns the backend the module uses to modify snapshots. Defaults
+    to libzfs_core when the pyzfs bindings are installed and to
+    running zfs(1) otherwise.
+    """
+    global _backend
+    _backendlock.acquire()
+    if _backend == None:
+        _backend = zfsbackend.get_backend("auto", ZFSCMD)
+    _backendlock.release()
+    return _backend
+
+def set_backend(backend):
+    """
+    Makes the module use backend, as returned by
+    zfsbackend.get_backend(), to modify snapshots.
+    """
+    global _backend
+    _backendlock.acquire()
+    _backend = backend
+    _backendlock.release()
+
+
+def split_snapshot_name(name):
+    """
+    Splits a snapshot name into its pool, dataset and schedule
+    components. The schedule is None unless the snapshot label
+    is one generated by time-slider.
+    """
+    dataset,label = name.split('@', 1)
+    pool = dataset.split('/', 1)[0]
+    schedule = None
+    match = AUTOSNAPLABEL.match(label)
+    if match != None:
+        schedule = match.group(1)
+    return pool,dataset,schedule
+
+
+class SnapshotCache:
+    """
+    Indexed cache of all snapshots on the system sorted by creation
+    time, oldest first. Besides the global list, snapshots are indexed
+    by pool, by dataset and by time-slider schedule, alone and in
+    combination, so that lookups are a dictionary hit plus a bisection
+    on creation time.
+
+    Snapshots created, destroyed or released through this module are
+    patched into the cache in place. A full rescan via zfs(1) is only
+    performed when the cache has been invalidated (generation mismatch)
+    or is older than its time to live. Rescans run without holding the
+    lock, so that lookups of the contents as they stand don't wait for
+    them, and changes made meanwhile are replayed on the result.
+
+    With a catalog attached (see the catalog module), the first load
+    comes from the catalog if it's still valid, and changes and full
+    rescans are recorded in it.
+    """
+    def __init__(self, ttl = SNAPSHOT_CACHE_TTL):
+        self.lock = threading.RLock()
+        # Held while rescanning, so that there is one rescan at a time
+        self.scanlock = threading.Lock()
+        self.ttl = ttl
+        # Bumped by invalidate(). Contents loaded under an older
+        # generation are considered stale.
+        self.generation = 0
+        # Bumped on every change to the contents. Allows clients
+        # to detect that results they hold are out of date.
+        self.serial = 0
+        self.hits = 0
+        self.misses = 0
+        self.rescans = 0
+        self.updates = 0
+        self.catalogloads = 0
+        self.catalog = None
+        self.__loadgeneration = None
+        self.__loadtime = 0
+        # (name, creation) of the snapshots added, and (name, None) of
+        # those removed, while a rescan is running. None otherwise.
+        self.__scanlog = None
+        # (creation, name) keys of all snapshots, and of each index
+        # entry, kept in sorted order.
+        self.__keys = []
+        self.__index = {}
+        self.__creation = {}
+
+    def __index_keys(self, name):
+        """
+        Returns the index entries a snapshot belongs to
+        """
+        pool,dataset,schedule = split_snapshot_name(name)
+        result = [("pool", pool, None), ("dataset", dataset, None)]
+        if schedule != None:
+            result.extend([("pool", pool, schedule),
+                           ("dataset", dataset, schedule),
+                           (None, None, schedule)])
+        return result
+
+    def invalidate(self):
+        """
+        Force a full rescan on the next lookup
+        """
+        self.lock.acquire()
+        self.generation += 1
+        self.lock.release()
+
+    def is_loaded(self):
+        """
+        Returns True if the cache holds contents that can be patched
+        in place, False if the next lookup will rescan anyway.
+        """
+        self.lock.acquire()
+        result = self.__loadgeneration == self.generation
+        self.lock.release()
+        return result
+
+    def validate(self):
+        """
+        Make sure the cache contents are current, rescanning if the
+        generation or time to live don't match. Returns the serial
+        number of the contents.
+        """
+        self.lock.acquire()
+        stale = self.__is_stale()
+        if stale == False:
+            self.hits += 1
+        self.lock.release()
+        if stale == False:
+            return self.serial
+
+        self.scanlock.acquire()
+        try:
+            # Another thread may have rescanned meanwhile.
+            self.lock.acquire()
+            stale = self.__is_stale()
+            if self.__loadgeneration != self.generation:
+                self.misses += 1
+            generation = self.generation
+            if stale == True:
+                self.__scanlog = []
+            self.lock.release()
+            if stale == True:
+                try:
+                    self.__rescan(generation)
+                finally:
+                    self.lock.acquire()
+                    self.__scanlog = None
+                    self.lock.release()
+            return self.serial
+        finally:
+            self.scanlock.release()
+
+    def __is_stale(self):
+        return self.__loadgeneration != self.generation or \
+               time.time() - self.__loadtime > self.ttl
+
+    def list(self, pool = None, dataset = None, schedule = None,
+             start = None, end = None):
+        """
+        Returns a list of [name, creation] pairs sorted by creation
+        time, oldest first.
+
+        Keyword arguments:
+        pool -- Only snapshots on this zpool (default None)
+        dataset -- Only snapshots of this filesystem or volume
+                   (default None)
+        schedule -- Only snapshots taken by this time-slider schedule
+                    (default None)
+        start -- Only snapshots created at or after this time
+                 (default None)
+        end -- Only snapshots created before this time (default None)
+        """
+        self.validate()
+        self.lock.acquire()
+        try:
+            keys = self.__select(pool, dataset, schedule)
+            lo = 0
+            hi = len(keys)
+            if start != None:
+                lo = bisect_left(keys, (start,))
+            if end != None:
+                hi = bisect_left(keys, (end,))
+            return [[name, creation] for creation,name in keys[lo:hi]]
+        finally:
+            self.lock.release()
+
+    def list_page(self, pool = None, dataset = None, schedule = None,
+                  offset = 0, limit = None, cached = False):
+        """
+        Returns a page of the list() results, without building the
+        whole list: a tuple of up to limit [name, creation] pairs
+        starting at offset, the total number of matching snapshots and
+        the serial number of the cache contents. A change in serial
+        number between pages means the pages may be inconsistent.
+
+        With cached True, the contents are returned as they stand,
+        even if out of date, rather than rescanned. Raises RuntimeError
+        if they have never been loaded.
+        """
+        if cached == False:
+            self.validate()
+        self.lock.acquire()
+        try:
+            if self.__loadgeneration == None:
+                raise RuntimeError("The snapshot cache hasn't been " \
+                                   "loaded yet")
+            serial = self.serial
+            keys = self.__select(pool, dataset, schedule)
+            if limit == None:
+                end = len(keys)
+            else:
+                end = offset + limit
+            page = [[name, creation] for creation,name in keys[offset:end]]
+            return page,len(keys),serial
+        finally:
+            self.lock.release()
+
+    def __select(self, pool, dataset, schedule):
+        if dataset != None:
+            return self.__index.get(("dataset", dataset, schedule), [])
+        elif pool != None:
+            return self.__index.get(("pool", pool, schedule), [])
+        elif schedule != None:
+            return self.__index.get((None, None, schedule), [])
+        return self.__keys
+
+    def attach_catalog(self, catalog):
+        """
+        Loads from and records changes in catalog, a
+        catalog.SnapshotCatalog, from now on. None detaches the
+        current catalog.
+        """
+        self.lock.acquire()
+        self.catalog = catalog
+        self.lock.release()
+
+    def flush(self):
+        """
+        Writes out the changes queued for the catalog, if any
+        """
+        self.lock.acquire()
+        if self.catalog != None:
+            self.catalog.flush()
+        self.lock.release()
+
+    def __rescan(self, generation):
+        """
+        Reloads the contents, as of generation, from the catalog or
+        zfs(1). Runs without holding the lock, other than to swap in
+        the result.
+        """
+        snaps = None
+        loadtime = time.time()
+        if self.catalog != None and self.__loadgeneration == None:
+            # Nothing loaded yet. Try the catalog before enumerating
+            # all snapshots.
+            loaded = self.catalog.load(self.ttl)
+            if loaded != None:
+                snaps,loadtime = loaded
+                self.catalogloads += 1
+        if snaps == None:
+            snaps = []
+            cmd = [ZFSCMD, "get", "-H", "-p", "-o", "value,name", "creation"]
+            outdata,errdata = util.run_command(cmd, True)
+            for line in outdata.rstrip().split('\n'):
+                line = line.split()
+                if len(line) == 2 and line[1].find('@') != -1:
+                    snaps.append((int(line[0]), line[1]))
+            snaps.sort()
+            if self.catalog != None:
+                self.catalog.replace(snaps)
+        index = {}
+        for key in snaps:
+            for idx in self.__index_keys(key[1]):
+                index.setdefault(idx, []).append(key)
+        creations = dict((name, creation) for creation,name in snaps)
+        self.lock.acquire()
+        try:
+            self.__keys = snaps
+            self.__index = index
+            self.__creation = creations
+            self.__loadgeneration = generation
+            self.__loadtime = loadtime
+            self.serial += 1
+            self.rescans += 1
+            # The rescan may or may not have seen these changes.
+            # Making them again does no harm either way.
+            for name,creation in self.__scanlog:
+                if creation == None:
+                    self.__remove(name)
+                else:
+                    self.__add(name, creation)
+        finally:
+            self.lock.release()
+
+    def add(self, name, creation):
+        """
+        Insert a newly created snapshot into the cache
+        """
+        self.lock.acquire()
+        try:
+            if self.__scanlog != None:
+                self.__scanlog.append((name, creation))
+            if self.__loadgeneration == self.generation:
+                self.__add(name, creation)
+        finally:
+            self.lock.release()
+
+    def __add(self, name, creation):
+        if name in self.__creation:
+            return
+        key = (creation, name)
+        self.__creation[name] = creation
+        for keys in [self.__keys] + \
+                    [self.__index.setdefault(idx, []) \
+                     for idx in self.__index_keys(name)]:
+            # New snapshots are nearly always the most recent ones
+            # so this is usually an append.
+            if len(keys) == 0 or keys[-1] < key:
+                keys.append(key)
+            else:
+                insort(keys, key)
+        if self.catalog != None:
+            self.catalog.add(name, creation)
+        self.serial += 1
+        self.updates += 1
+
+    def remove(self, name):
+        """
+        Remove a destroyed snapshot from the cache
+        """
+        self.lock.acquire()
+        try:
+            if self.__scanlog != None:
+                self.__scanlog.append((name, None))
+            if self.__loadgeneration == self.generation:
+                self.__remove(name)
+        finally:
+            self.lock.release()
+
+    def __remove(self, name):
+        if name not in self.__creation:
+            return
+        key = (self.__creation.pop(name), name)
+        del self.__keys[bisect_left(self.__keys, key)]
+        for idx in self.__index_keys(name):
+            keys = self.__index[idx]
+            del keys[bisect_left(keys, key)]
+            if len(keys) == 0:
+                del self.__index[idx]
+        if self.catalog != None:
+            self.catalog.remove(name)
+        self.serial += 1
+        self.updates += 1
+
+    def get_stats(self):
+        """
+        Returns a dictionary of cache hit, miss, rescan and in place
+        update counters.
+        """
+        self.lock.acquire()
+        result = {"hits" : self.hits,
+                  "misses" : self.misses,
+                  "rescans" : self.rescans,
+                  "updates" : self.updates,
+                  "catalogloads" : self.catalogloads,
+                  "size" : len(self.__keys)}
+        self.lock.release()
+        return result
+
 
 class Datasets(Exception):
     """
@@ -44,15 +434,15 @@ class Datasets(Exception):
     # Class wide instead of per-instance in order to avoid duplication
     filesystems = None
     volumes = None
-    snapshots = None
+    snapshots = SnapshotCache()
 
     # Mutex locks to prevent concurrent writes to above class wide
-    # dataset lists.
+    # dataset lists. The snapshot cache does its own locking.
     _filesystemslock = threading.Lock()
     _volumeslock = threading.Lock()
-    snapshotslock = threading.Lock()
 
-    def create_auto_snapshot_set(self, label, tag = None):
+    def create_auto_snapshot_set(self, label, tag = None,
+                                 skipunchanged = False):
         """
         Create a complete set of snapshots as if this were
         for a standard zfs-auto-snapshot operation.
@@ -67,99 +457,167 @@ class Datasets(Exception):
             on a zfs dataset, the property corresponding to the tag will
             override the wildcard property: "com.sun:auto-snapshot"
             Default value = None
+        skipunchanged:
+            Leave out the datasets that haven't been written to since
+            their latest snapshot of the schedule (Default False)
+
+        Returns the list of datasets left out, sorted by name.
         """
-        everything = []
-        included = []
-        excluded = []
-        single = []
-        recursive = []
-        finalrecursive = []
+        inventory = AutoSnapshotInventory(tag)
+        unchanged = set()
+        if skipunchanged == True:
+            unchanged = inventory.list_unchanged()
+
+        if len(unchanged) == 0:
+            finalrecursive,single = inventory.classify()
+            self.create_snapshots(finalrecursive, label, True)
+            self.create_snapshots(single, label, False)
+        else:
+            # Recursive snapshots would take in the unchanged datasets,
+            # so name the remaining ones explicitly.
+            self.create_snapshots([name for name in \
+                                   inventory.list_snapshotted() \
+                                   if name not in unchanged], label, False)
+        return sorted(unchanged)
+
+    def get_auto_snapshot_inventories(self, tags):
+        """
+        Returns a dictionary mapping each of the schedule tags to an
+        AutoSnapshotInventory, using a single zfs(1) invocation.
+        """
+        return list_auto_snapshot_inventories(tags)
 
-        # Get auto-snap property in two passes. First with the schedule
-        # specific tag override value, then with the general property value
-        cmd = [ZFSCMD, "list", "-H", "-t", "filesystem,volume",
-               "-o", "name,com.sun:auto-snapshot", "-s", "name"]
-        if tag:
-            overrideprop = "com.sun:auto-snapshot:" + tag
-            scmd = [ZFSCMD, "list", "-H", "-t", "filesystem,volume",
-                    "-o", "name," + overrideprop, "-s", "name"]
-            outdata,errdata = util.run_command(scmd)
-            for line in outdata.rstrip().split('\n'):
-                line = line.split()
-                # Skip over unset values.
-                if line[1] == "-":
-                    continue
-                # Add to everything list. This is used later
-                # for identifying parents/children of a given
-                # filesystem or volume.
-                everything.append(line[0])
-                if line[1] == "true":
-                    included.append(line[0])
-                elif line[1] == "false":
-                    excluded.append(line[0])
-        # Now use the general property. If no value
-        # was set in the first pass, we set it here.
-        outdata,errdata = util.run_command(cmd)
-        for line in outdata.rstrip().split('\n'):
-            line = line.split()
-            idx = bisect_right(everything, line[0])
-            if len(everything) == 0 or \
-               everything[idx-1] != line[0]:
-                # Dataset is neither included nor excluded so far
-                if line[1] == "-":
+    def create_auto_snapshot_sets(self, labels, inventories = None,
+                                  skipunchanged = False):
+        """
+        Create the snapshot sets of several schedules at once. Instead
+        of recursive snapshots, every dataset is named explicitly so
+        that all of a zpool's snapshots are taken in a single atomic
+        backend operation. zfs only takes one snapshot per dataset at
+        a time, so a dataset in several of the sets needs one operation
+        per set it is in.
+
+        Keyword arguments:
+        labels -- List of (tag, label) tuples
+        inventories -- Dictionary of the tags' AutoSnapshotInventory
+                       instances, if already at hand (Default None)
+        skipunchanged -- Leave out the datasets that haven't been
+                         written to since their latest snapshot of
+                         the schedule (Default False)
+
+        Returns a dictionary mapping each of the tags to the list of
+        datasets left out of its set, sorted by name.
+        """
+        if inventories == None:
+            inventories = self.get_auto_snapshot_inventories( \
+                              [tag for tag,label in labels])
+        skipped = {}
+        rounds = []
+        taken = {}
+        for tag,label in labels:
+            unchanged = set()
+            if skipunchanged == True:
+                unchanged = inventories[tag].list_unchanged()
+            skipped[tag] = sorted(unchanged)
+            for name in inventories[tag].list_snapshotted():
+                if name in unchanged:
                     continue
-                everything.insert(idx, line[0])
-                if line[1] == "true":
-                    included.insert(0, line[0])
-                elif line[1] == "false":
-                    excluded.append(line[0])
-
-        # Now figure out what can be recursively snapshotted and what
-        # must be singly snapshotted. Single snapshot restrictions apply
-        # to those datasets who have a child in the excluded list.
-        # 'included' is sorted in reverse alphabetical order.
-        for datasetname in included:
-            excludedchild = False
-            idx = bisect_right(everything, datasetname)
-            children = [name for name in everything[idx:] if \
-                        name.find(datasetname) == 0]
-            for child in children:
-                idx = bisect_left(excluded, child)
-                if idx < len(excluded) and excluded[idx] == child:
-                    excludedchild = True
-                    single.append(datasetname)
-                    break
-            if excludedchild == False:
-                # We want recursive list sorted in alphabetical order
-                # so insert instead of append to the list.
-                # Also, remove all children from the recursive
-                # list, as they are covered by the parent
-                recursive = [x for x in recursive if x not in children]
-                recursive.insert(0, datasetname)
-
-        for datasetname in recursive:
-            parts = datasetname.rsplit('/', 1)
-            parent = parts[0]
-            if parent == datasetname:
-                # Root filesystem of the Zpool, so
-                # this can't be inherited and must be
-                # set locally.
-                finalrecursive.append(datasetname)
-                continue
-            idx = bisect_right(recursive, parent)
-            if len(recursive) > 0 and \
-               recursive[idx-1] == parent:
-                # Parent already marked for recursive snapshot: so skip
-                continue
-            else:
-                finalrecursive.append(datasetname)
+                count = taken.get(name, 0)
+                if count == len(rounds):
+                    rounds.append([])
+                rounds[count].append("%s@%s" % (name, label))
+                taken[name] = count + 1
+        for names in rounds:
+            self.__create_snapshot_round(names)
+        return skipped
+
+    def __create_snapshot_round(self, names):
+        """
+        Creates snapshots, at most one per dataset, and patches the
+        snapshot cache. Errors are printed rather than raised as it
+        can't be told which of the snapshots got created.
+        """
+        try:
+            get_backend().snapshot(names)
+        except RuntimeError as message:
+            print(str(message))
+            self.refresh_snapshots()
+            return
+        if Datasets.snapshots.is_loaded() == False:
+            return
 
-        for name in finalrecursive:
-            dataset = ReadWritableDataset(name)
-            dataset.create_snapshot(label, True)
-        for name in single:
-            dataset = ReadWritableDataset(name)
-            dataset.create_snapshot(label, False)
+        # Snapshots created together in a zpool share a transaction
+        # group and so their creation time.
+        first = {}
+        for name in names:
+            first.setdefault(name.split('/', 1)[0].split('@', 1)[0], name)
+        try:
+            cmd = [ZFSCMD, "get", "-H", "-p", "-o", "name,value",
+                   "creation"] + list(first.values())
+            outdata,errdata = util.run_command(cmd)
+            creation = {}
+            for line in outdata.rstrip().split('\n'):
+                name,value = line.split('\t')
+                creation[name.split('/', 1)[0].split('@', 1)[0]] = int(value)
+        except (RuntimeError, ValueError):
+            self.refresh_snapshots()
+            return
+        for name in names:
+            poolname = name.split('/', 1)[0].split('@', 1)[0]
+            if poolname in creation:
+                Datasets.snapshots.add(name, creation[poolname])
+
+    def create_snapshots(self, fsnames, snaplabel, recursive = False):
+        """
+        Create snapshots of a list of filesystems and volumes, all with
+        the same label, in a single backend operation. Errors are
+        printed rather than raised, as it can't be told which of the
+        snapshots got created.
+
+        Keyword arguments:
+        fsnames -- Names of the filesystems and volumes to snapshot
+        snaplabel -- The part of the snapshot names after the "@"
+        recursive -- Recursively snapshot children of the datasets
+                     (default False)
+        """
+        if len(fsnames) == 0:
+            return
+        names = ["%s@%s" % (fsname, snaplabel) for fsname in fsnames]
+        try:
+            get_backend().snapshot(names, recursive)
+        except RuntimeError as message:
+            print(str(message))
+            # Can't tell what got created, so let the next lookup rescan.
+            self.refresh_snapshots()
+            return
+        if Datasets.snapshots.is_loaded() == False:
+            return
+
+        # A recursive snapshot is atomic, so all snapshots in the set
+        # share the creation time of the top level one.
+        try:
+            cmd = [ZFSCMD, "get", "-H", "-p", "-o", "name,value",
+                   "creation"] + names
+            outdata,errdata = util.run_command(cmd)
+            creation = {}
+            for line in outdata.rstrip().split('\n'):
+                name,value = line.split('\t')
+                creation[name.split('@', 1)[0]] = int(value)
+            if recursive == True:
+                backend = zfsbackend.CommandBackend(ZFSCMD)
+                children = backend.list_descendents(fsnames)
+            else:
+                children = fsnames
+        except (RuntimeError, ValueError):
+            self.refresh_snapshots()
+            return
+        for fsname in children:
+            root = fsname
+            while root not in creation and root.find('/') != -1:
+                root = root.rsplit('/', 1)[0]
+            if root in creation:
+                Datasets.snapshots.add("%s@%s" % (fsname, snaplabel),
+                                       creation[root])
 
     def list_auto_snapshot_sets(self, tag = None):
         """
@@ -177,41 +635,8 @@ class Datasets(Exception):
             override the wildcard property: "com.sun:auto-snapshot"
             Default value = None
         """
-        #Get auto-snap property in two passes. First with the global
-        #value, then overriding with the label/schedule specific value
-
-        included = []
-        excluded = []
-
-        cmd = [ZFSCMD, "list", "-H", "-t", "filesystem,volume",
-               "-o", "name,com.sun:auto-snapshot", "-s", "name"]
-        if tag:
-            overrideprop = "com.sun:auto-snapshot:" + tag
-            scmd = [ZFSCMD, "list", "-H", "-t", "filesystem,volume",
-                    "-o", "name," + overrideprop, "-s", "name"]
-            outdata,errdata = util.run_command(scmd)
-            for line in outdata.rstrip().split('\n'):
-                line = line.split()
-                if line[1] == "true":
-                    included.append(line[0])
-                elif line[1] == "false":
-                    excluded.append(line[0])
-        outdata,errdata = util.run_command(cmd)
-        for line in outdata.rstrip().split('\n'):
-            line = line.split()
-            # Only set values that aren't already set. Don't override
-            try:
-                included.index(line[0])
-                continue
-            except ValueError:
-                try:
-                    excluded.index(line[0])
-                    continue
-                except ValueError:
-                    # Dataset is not listed in either list.
-                    if line[1] == "true":
-                        included.append(line[0])
-        return included
+        inventory = AutoSnapshotInventory(tag)
+        return inventory.list_included()
 
     def list_filesystems(self, pattern = None):
         """
@@ -291,42 +716,30 @@ class Datasets(Exception):
                     volumes.append(volname)
         return volumes
 
-    def list_snapshots(self, pattern = None):
+    def list_snapshots(self, pattern = None, schedule = None):
         """
         List pattern matching snapshots sorted by creation date.
         Oldest listed first
 
         Keyword arguments:
         pattern -- Filter according to pattern (default None)
+        schedule -- Only list snapshots taken by this time-slider
+                    schedule. Served from the schedule index rather
+                    than by matching every snapshot (default None)
         """
         snapshots = []
-        Datasets.snapshotslock.acquire()
-        if Datasets.snapshots == None:
-            Datasets.snapshots = []
-            snaps = []
-            cmd = [ZFSCMD, "get", "-H", "-p", "-o", "value,name", "creation"]
-            try:
-                outdata,errdata = util.run_command(cmd, True)
-            except RuntimeError as message:
-                Datasets.snapshotslock.release()
-                raise RuntimeError(str(message))
-            for dataset in outdata.rstrip().split('\n'):
-                if re.search("@", dataset):
-                    insort(snaps, dataset.split())
-            for snap in snaps:
-                Datasets.snapshots.append([snap[1], int(snap[0])])
         if pattern == None:
-            snapshots = Datasets.snapshots[:]
+            snapshots = Datasets.snapshots.list(schedule = schedule)
         else:
             # Regular expression pattern to match "pattern" parameter.
             regexpattern = ".*@.*%s" % pattern
             patternobj = re.compile(regexpattern)
 
-            for snapname,snaptime in Datasets.snapshots:
+            for snapname,snaptime in \
+                Datasets.snapshots.list(schedule = schedule):
                 patternmatchobj = re.match(patternobj, snapname)
                 if patternmatchobj != None:
                     snapshots.append([snapname, snaptime])
-        Datasets.snapshotslock.release()
         return snapshots
 
     def list_cloned_snapshots(self):
@@ -366,21 +779,281 @@ class Datasets(Exception):
                 result.append(details[1])
         return result
 
+    def get_reclaim_size(self, names):
+        """
+        Returns the number of bytes that destroying the list of snapshots
+        as a set would free, according to a "zfs destroy -n" dry run.
+        This accounts for space shared only among the given snapshots,
+        which is not included in any of their "used" property values.
+        """
+        groups = {}
+        for name in names:
+            fsname,snaplabel = name.split('@', 1)
+            groups.setdefault(fsname, []).append(snaplabel)
+        result = 0
+        for fsname,snaplabels in groups.items():
+            for arg in zfsbackend.destroy_args(fsname, snaplabels):
+                cmd = [ZFSCMD, "destroy", "-n", "-v", "-p", arg]
+                outdata,errdata = util.run_command(cmd)
+                for line in outdata.rstrip().split('\n'):
+                    line = line.split()
+                    if len(line) == 2 and line[0] == "reclaim":
+                        result += int(line[1])
+        return result
+
+    def destroy_snapshots(self, names, deferred = True, userrefs = None):
+        """
+        Destroy a list of snapshots using as few backend operations as
+        possible: one ioctl per zpool with libzfs_core, or one zfs(1)
+        invocation per filesystem or volume otherwise. Raises
+        RuntimeError if any of them fail. zfs(1) fails for a dataset
+        none of whose snapshots in names exist anymore, and skips
+        missing ones otherwise.
+
+        Keyword arguments:
+        names -- List of snapshot names to destroy
+        deferred -- Perform a deferred destroy (default True)
+        userrefs -- Dictionary mapping snapshot names to their number
+                    of user holds, if known to the caller. Otherwise
+                    snapshots that may have been kept around by a
+                    deferred destroy are looked up after the destroy
+                    (default None)
+        """
+        if userrefs == None:
+            userrefs = {}
+        try:
+            get_backend().destroy_snapshots(names, deferred)
+        except RuntimeError:
+            # Some of the snapshots may be gone, others not. Only a
+            # rescan can tell.
+            Datasets.snapshots.invalidate()
+            raise
+
+        for fsname,snaplabels in zfsbackend.group_by_dataset(names):
+            # Patch the global snapshot cache. Snapshots with user holds
+            # survive a deferred destroy, so where the holds are unknown
+            # see what is left of the dataset's snapshots.
+            unknown = False
+            for snaplabel in snaplabels:
+                name = "%s@%s" % (fsname, snaplabel)
+                if deferred == False or userrefs.get(name) == 0:
+                    Datasets.snapshots.remove(name)
+                elif userrefs.get(name) == None:
+                    unknown = True
+            if unknown == True and Datasets.snapshots.is_loaded() == True:
+                ReadWritableDataset(fsname).list_snapshot_usage()
+
     def refresh_snapshots(self):
         """
         Should be called when snapshots have been created or deleted
-        and a rescan should be performed. Rescan gets deferred until
-        next invocation of zfs.Dataset.list_snapshots()
+        by other means than this module and a rescan should be
+        performed. Rescan gets deferred until next invocation of
+        zfs.Dataset.list_snapshots()
         """
-        # FIXME in future.
-        # This is a little sub-optimal because we should be able to modify
-        # the snapshot list in place in some situations and regenerate the
-        # snapshot list without calling out to zfs(1m). But on the
-        # pro side, we will pick up any new snapshots since the last
-        # scan that we would be otherwise unaware of.
-        Datasets.snapshotslock.acquire()
-        Datasets.snapshots = None
-        Datasets.snapshotslock.release()
+        Datasets.snapshots.invalidate()
+
+    def get_snapshot_cache_stats(self):
+        """
+        Returns the hit/miss/rescan counters of the snapshot cache
+        """
+        return Datasets.snapshots.get_stats()
+
+
+class AutoSnapshotInventory:
+    """
+    Inventory of all zfs filesystems and volumes along with their
+    effective "com.sun:auto-snapshot" property value for a schedule.
+    Both the general property and the schedule specific override are
+    fetched in a single zfs(1) invocation. Datasets are indexed by name
+    so that parent lookups are dictionary hits, which makes the
+    recursive/single snapshot classification linear in the number of
+    datasets.
+    """
+    def __init__(self, tag = None, outdata = None):
+        """
+        Keyword arguments:
+        tag:
+            A string indicating one of the standard auto-snapshot schedules
+            tags to check (eg. "frequent" will map to the tag:
+            com.sun:auto-snapshot:frequent). If specified as a zfs property
+            on a zfs dataset, the property corresponding to the tag will
+            override the wildcard property: "com.sun:auto-snapshot"
+            Default value = None
+        outdata:
+            Pre-fetched output of the zfs list command issued by
+            list_command(). Used to avoid running zfs(1) when the
+            listing is already available (Default None)
+        """
+        self.tag = tag
+        # Dataset names in the order listed by zfs(1) (sorted by name)
+        self.names = []
+        # Effective auto-snapshot value for each dataset.
+        self.values = {}
+        if outdata == None:
+            outdata,errdata = util.run_command(self.list_command())
+        self.__parse(outdata)
+
+    def list_command(self):
+        """
+        Returns the zfs(1) command used to build the inventory
+        """
+        props = "name,com.sun:auto-snapshot"
+        if self.tag:
+            props = props + ",com.sun:auto-snapshot:" + self.tag
+        return [ZFSCMD, "list", "-H", "-t", "filesystem,volume",
+                "-o", props, "-s", "name"]
+
+    def __parse(self, outdata):
+        for line in outdata.split('\n'):
+            line = line.split('\t')
+            if len(line) < 2:
+                continue
+            name = line[0]
+            value = line[1]
+            # The schedule specific override, if set, always takes
+            # precedence over the general property value.
+            if len(line) > 2 and line[2] != "-":
+                value = line[2]
+            self.names.append(name)
+            self.values[name] = value
+
+    def list_included(self):
+        """
+        Returns a list of datasets tagged for auto snapshots,
+        sorted by name.
+        """
+        return [name for name in self.names if self.values[name] == "true"]
+
+    def list_excluded(self):
+        """
+        Returns a list of datasets explicitly excluded from auto
+        snapshots, sorted by name.
+        """
+        return [name for name in self.names if self.values[name] == "false"]
+
+    def classify(self):
+        """
+        Figures out what can be recursively snapshotted and what must be
+        singly snapshotted. Single snapshot restrictions apply to included
+        datasets that have a descendant in the excluded list.
+        Returns a tuple of the recursive snapshot roots and the singly
+        snapshotted datasets. Both lists are sorted by name.
+        """
+        # Mark every dataset that has an excluded dataset below it.
+        # Walking up stops at the first already marked ancestor so each
+        # dataset gets visited at most once.
+        tainted = set()
+        for name in self.list_excluded():
+            parent = name.rsplit('/', 1)[0]
+            while parent != name and parent not in tainted:
+                tainted.add(parent)
+                name = parent
+                parent = name.rsplit('/', 1)[0]
+
+        # A parent always sorts before its children, so by the time a
+        # dataset is examined it is known whether an ancestor already
+        # covers it with a recursive snapshot.
+        recursive = []
+        single = []
+        covered = set()
+        for name in self.names:
+            parent = name.rsplit('/', 1)[0]
+            if parent != name and parent in covered:
+                covered.add(name)
+                continue
+            if self.values[name] != "true":
+                continue
+            if name in tainted:
+                single.append(name)
+            else:
+                recursive.append(name)
+                covered.add(name)
+        return recursive,single
+
+    def list_snapshotted(self):
+        """
+        Returns the datasets that get snapshotted for the schedule:
+        the recursive snapshot roots with all their descendants plus
+        the singly snapshotted datasets, sorted by name.
+        """
+        recursive,single = self.classify()
+        roots = set(recursive)
+        single = set(single)
+        result = []
+        covered = set()
+        for name in self.names:
+            parent = name.rsplit('/', 1)[0]
+            if name in roots or (parent != name and parent in covered):
+                covered.add(name)
+                result.append(name)
+            elif name in single:
+                result.append(name)
+        return result
+
+    def list_unchanged(self):
+        """
+        Returns the set of snapshotted datasets that haven't been
+        written to since their latest snapshot of the schedule.
+        Datasets without a snapshot of the schedule are never
+        unchanged, so that each keeps at least one. The written space
+        of all the datasets whose latest snapshots share a label,
+        as the snapshots of a set do, is read with a single zfs(1)
+        invocation.
+        """
+        result = set()
+        if self.tag == None:
+            return result
+        bylabel = {}
+        for name in self.list_snapshotted():
+            snaps = Datasets.snapshots.list(dataset=name, schedule=self.tag)
+            if len(snaps) == 0:
+                continue
+            label = snaps[-1][0].split('@', 1)[1]
+            bylabel.setdefault(label, []).append(name)
+        for label,names in bylabel.items():
+            cmd = [ZFSCMD, "get", "-H", "-p", "-o", "name,value",
+                   "written@%s" % (label)] + names
+            try:
+                outdata,errdata = util.run_command(cmd)
+            except RuntimeError:
+                # Most likely a snapshot went away behind our back.
+                # Snapshotting a dataset needlessly does no harm.
+                continue
+            for line in outdata.rstrip().split('\n'):
+                try:
+                    name,value = line.split('\t')
+                except ValueError:
+                    continue
+                if value == "0":
+                    result.add(name)
+        return result
+
+
+def list_auto_snapshot_inventories(tags, outdata = None):
+    """
+    Returns a dictionary mapping each of the schedule tags to an
+    AutoSnapshotInventory, all built from a single zfs(1) invocation
+    fetching the schedule specific overrides of every tag at once.
+
+    Keyword arguments:
+    tags -- List of schedule tags, eg. ["daily", "hourly"]
+    outdata -- Pre-fetched output of the zfs list command
+               (Default None)
+    """
+    props = "name,com.sun:auto-snapshot" + \
+            "".join([",com.sun:auto-snapshot:" + tag for tag in tags])
+    if outdata == None:
+        cmd = [ZFSCMD, "list", "-H", "-t", "filesystem,volume",
+               "-o", props, "-s", "name"]
+        outdata,errdata = util.run_command(cmd)
+    lines = [line.split('\t') for line in outdata.split('\n')]
+    lines = [line for line in lines if len(line) >= 2 + len(tags)]
+    result = {}
+    for idx in range(len(tags)):
+        tagdata = "\n".join(["%s\t%s\t%s" % (line[0], line[1], line[2 + idx]) \
+                             for line in lines])
+        result[tags[idx]] = AutoSnapshotInventory(tags[idx], tagdata)
+    return result
 
 
 class ZPool:
@@ -393,7 +1066,6 @@ class ZPool:
         self.__datasets = Datasets()
         self.__filesystems = None
         self.__volumes = None
-        self.__snapshots = None
 
     def __get_health(self):
         """
@@ -413,6 +1085,14 @@ class ZPool:
         giving a more practical indication of how much capacity is used
         up on the pool.
         """
+        used,available = self.get_space()
+        return 100.0 * used/(used + available)
+
+    def get_space(self):
+        """
+        Returns a tuple of the "used" and "available" property values
+        of the pool's top-level filesystem, in bytes.
+        """
         if self.health == "FAULTED":
             raise ZPoolFaultedError("Can not determine capacity of zpool: %s" \
                                     "because it is in a FAULTED state" \
@@ -422,9 +1102,50 @@ class ZPool:
                "used,available", self.name]
         outdata,errdata = util.run_command(cmd)
         _used,_available = outdata.rstrip().split('\n')
-        used = float(_used)
-        available = float(_available)
-        return 100.0 * used/(used + available)
+        return int(_used),int(_available)
+
+    def get_freeing(self):
+        """
+        Returns the number of bytes still being freed asynchronously
+        after datasets or snapshots were destroyed. Returns 0 if the
+        pool doesn't support asynchronous destroy.
+        """
+        cmd = [ZPOOLCMD, "get", "-H", "-p", "-o", "value", "freeing",
+               self.name]
+        outdata,errdata = util.run_command(cmd, False)
+        try:
+            return int(outdata.strip())
+        except ValueError:
+            return 0
+
+    def wait_for_freeing(self, timeout = 60):
+        """
+        Wait until zfs has finished freeing the space of destroyed
+        snapshots so that capacity figures are meaningful again, or
+        until timeout seconds have passed.
+        """
+        deadline = time.time() + timeout
+        # Give zfs a moment to sync out the destroy in any case.
+        time.sleep(1)
+        while self.get_freeing() > 0 and time.time() < deadline:
+            time.sleep(1)
+
+    def list_snapshot_usage(self):
+        """
+        Returns the used size and number of user holds of all snapshots
+        on this pool, fetched in a single zfs(1) invocation, as a
+        dictionary mapping snapshot names to [used, userrefs].
+        """
+        cmd = [ZFSCMD, "list", "-H", "-p", "-r", "-t", "snapshot",
+               "-o", "name,used,userrefs", self.name]
+        outdata,errdata = util.run_command(cmd)
+        result = {}
+        for line in outdata.rstrip().split('\n'):
+            line = line.split()
+            if len(line) != 3:
+                continue
+            result[line[0]] = [int(line[1]), int(line[2])]
+        return result
 
     def get_available_size(self):
         """
@@ -517,42 +1238,29 @@ class ZPool:
                 result.append(datasetname)
         return result
 
-    def list_snapshots(self, pattern = None):
+    def list_snapshots(self, pattern = None, schedule = None):
         """
         List pattern matching snapshots sorted by creation date.
         Oldest listed first
 
         Keyword arguments:
         pattern -- Filter according to pattern (default None)
+        schedule -- Only list snapshots taken by this time-slider
+                    schedule (default None)
         """
-        # If there isn't a list of snapshots for this dataset
-        # already, create it now and store it in order to save
-        # time later for potential future invocations.
-        Datasets.snapshotslock.acquire()
-        if Datasets.snapshots == None:
-            self.__snapshots = None
-        Datasets.snapshotslock.release()
-        if self.__snapshots == None:
-            result = []
-            regexpattern = "^%s.*@"  % self.name
-            patternobj = re.compile(regexpattern)
-            for snapname,snaptime in self.__datasets.list_snapshots():
-                patternmatchobj = re.match(patternobj, snapname)
-                if patternmatchobj != None:
-                    result.append([snapname, snaptime])
-            # Results already sorted by creation time
-            self.__snapshots = result
+        snapshots = Datasets.snapshots.list(pool = self.name,
+                                            schedule = schedule)
         if pattern == None:
-            return self.__snapshots
+            return snapshots
         else:
-            snapshots = []
+            result = []
             regexpattern = "^%s.*@.*%s" % (self.name, pattern)
             patternobj = re.compile(regexpattern)
-            for snapname,snaptime in self.__snapshots:
+            for snapname,snaptime in snapshots:
                 patternmatchobj = re.match(patternobj, snapname)
                 if patternmatchobj != None:
-                    snapshots.append([snapname, snaptime])
-            return snapshots
+                    result.append([snapname, snaptime])
+            return result
 
     def __str__(self):
         return_string = "ZPool name: " + self.name
@@ -699,23 +1407,45 @@ class Snapshot(ReadableDataset):
                 return True
         return False
 
-    def destroy(self, deferred=True):
+    def destroy(self, deferred=True, userrefs=None):
         """
         Permanently remove this snapshot from the filesystem
         Performs deferred destruction by default.
+
+        Keyword arguments:
+        deferred -- Perform a deferred destroy (default True)
+        userrefs -- Number of user holds on the snapshot, if already
+                    known to the caller, eg. from
+                    ReadWritableDataset.list_snapshot_usage().
+                    Saves checking for the snapshot's existence
+                    (default None)
         """
-        # Be sure it genuninely exists before trying to destroy it
-        if self.exists() == False:
+        # Be sure it genuninely exists before trying to destroy it.
+        # The number of user holds tells whether a deferred destroy
+        # will really remove the snapshot or just mark it.
+        if userrefs == None:
+            userrefs = self.get_user_refs()
+        if userrefs == None:
+            Datasets.snapshots.remove(self.name)
             return
-        if deferred == False:
-            cmd = [ZFSCMD, "destroy", self.name]
-        else:
-            cmd = [ZFSCMD, "destroy", "-d", self.name]
+        get_backend().destroy_snapshots([self.name], deferred)
+        # Patch the global snapshot cache rather than forcing a rescan
+        # on the next call to Datasets.list_snapshots()
+        if deferred == False or userrefs == 0:
+            Datasets.snapshots.remove(self.name)
 
-        outdata,errdata = util.run_command(cmd)
-        # Clear the global snapshot cache so that a rescan will be
-        # triggered on the next call to Datasets.list_snapshots()
-        self.datasets.refresh_snapshots()
+    def get_user_refs(self):
+        """
+        Returns the number of user holds on the snapshot or None
+        if the snapshot does not exist (anymore).
+        """
+        cmd = [ZFSCMD, "get", "-H", "-p", "-o", "value", "userrefs",
+               self.name]
+        outdata,errdata = util.run_command(cmd, False)
+        result = outdata.strip()
+        if len(result) == 0:
+            return None
+        return int(result)
 
     def hold(self, tag):
         """
@@ -726,8 +1456,7 @@ class Snapshot(ReadableDataset):
         if self.exists() == False:
             return
 
-        cmd = [ZFSCMD, "hold", tag, self.name]
-        outdata,errdata = util.run_command(cmd)
+        get_backend().hold(tag, [self.name])
 
     def holds(self):
         """
@@ -753,17 +1482,27 @@ class Snapshot(ReadableDataset):
         """
         # FIXME raises exception if no hold exists.
         # Be sure it genuninely exists before trying to destroy it
-        if self.exists() == False:
+        userrefs = self.get_user_refs()
+        if userrefs == None:
+            Datasets.snapshots.remove(self.name)
             return
 
-        cmd = [ZFSCMD, "release", tag, self.name]
+        get_backend().release(tag, [self.name])
+        # Releasing the last hold might cause the snapshot to get
+        # automatically deleted by zfs if it was marked for deferred
+        # destruction. Update the global snapshot cache accordingly.
+        if userrefs <= 1 and self.get_user_refs() == None:
+            Datasets.snapshots.remove(self.name)
 
-        outdata,errdata = util.run_command(cmd)
-        # Releasing the snapshot might cause it get automatically
-        # deleted by zfs.
-        # Clear the global snapshot cache so that a rescan will be
-        # triggered on the next call to Datasets.list_snapshots()
-        self.datasets.refresh_snapshots()
+    def bookmark(self):
+        """
+        Creates a bookmark of the snapshot, named after it, and returns
+        it as a Bookmark. Incremental streams can be sent from the
+        bookmark after the snapshot itself is gone.
+        """
+        bookmark = Bookmark("%s#%s" % (self.fsname, self.snaplabel))
+        get_backend().bookmark({bookmark.name : self.name})
+        return bookmark
 
 
     def __str__(self):
@@ -777,6 +1516,38 @@ class Snapshot(ReadableDataset):
         return return_string
 
 
+class Bookmark(ReadableDataset):
+    """
+    ZFS bookmark object class. A bookmark takes no space and marks
+    the point in time of the snapshot it was created from.
+    """
+    def __init__(self, name):
+        ReadableDataset.__init__(self, name)
+        split = name.split("#", 1)
+        if split[0] == name:
+            raise ZFSError("\'%s\' is not a valid bookmark name" % (name))
+        self.fsname, self.label = split
+
+    def exists(self):
+        """
+        Returns True if the bookmark exists, False otherwise
+        """
+        # A missing bookmark is nothing out of the ordinary, so
+        # don't let zfs get fail over it.
+        cmd = [ZFSCMD, "get", "-H", "-o", "name", "type", self.name]
+        outdata,errdata = util.run_command(cmd, False)
+        return outdata.rstrip() == self.name
+
+    def destroy(self):
+        """
+        Permanently remove this bookmark
+        """
+        get_backend().destroy_bookmarks([self.name])
+
+    def __str__(self):
+        return "Bookmark name: " + self.name
+
+
 class ReadWritableDataset(ReadableDataset):
     """
     Base class for ZFS filesystems and volumes.
@@ -785,7 +1556,6 @@ class ReadWritableDataset(ReadableDataset):
     """
     def __init__(self, name, creation = None):
         ReadableDataset.__init__(self, name, creation)
-        self.__snapshots = None
 
     def __str__(self):
         return_string = "ReadWritableDataset name: " + self.name + "\n"
@@ -823,14 +1593,7 @@ class ReadWritableDataset(ReadableDataset):
             Recursively snapshot childfren of this dataset.
             Default = False
         """
-        cmd = [ZFSCMD, "snapshot"]
-        if recursive == True:
-            cmd.append("-r")
-        cmd.append("%s@%s" % (self.name, snaplabel))
-        outdata,errdata = util.run_command(cmd, False)
-        if errdata:
-            print(errdata)
-        self.datasets.refresh_snapshots()
+        self.datasets.create_snapshots([self.name], snaplabel, recursive)
 
     def list_children(self):
 
@@ -847,42 +1610,55 @@ class ReadWritableDataset(ReadableDataset):
         return result
 
 
-    def list_snapshots(self, pattern = None):
+    def list_snapshots(self, pattern = None, schedule = None):
         """
         List pattern matching snapshots sorted by creation date.
-        Oldest listed first
+        Oldest listed first. When a pattern is given only the
+        snapshot names are returned.
 
         Keyword arguments:
         pattern -- Filter according to pattern (default None)
+        schedule -- Only list snapshots taken by this time-slider
+                    schedule (default None)
         """
-        # If there isn't a list of snapshots for this dataset
-        # already, create it now and store it in order to save
-        # time later for potential future invocations.
-        Datasets.snapshotslock.acquire()
-        if Datasets.snapshots == None:
-            self.__snapshots = None
-        Datasets.snapshotslock.release()
-        if self.__snapshots == None:
-            result = []
-            regexpattern = "^%s@" % self.name
-            patternobj = re.compile(regexpattern)
-            for snapname,snaptime in self.datasets.list_snapshots():
-                patternmatchobj = re.match(patternobj, snapname)
-                if patternmatchobj != None:
-                    result.append([snapname, snaptime])
-            # Results already sorted by creation time
-            self.__snapshots = result
+        snapshots = Datasets.snapshots.list(dataset = self.name,
+                                            schedule = schedule)
         if pattern == None:
-            return self.__snapshots
+            return snapshots
         else:
-            snapshots = []
+            result = []
             regexpattern = "^%s@.*%s" % (self.name, pattern)
             patternobj = re.compile(regexpattern)
-            for snapname,snaptime in self.__snapshots:
+            for snapname,snaptime in snapshots:
                 patternmatchobj = re.match(patternobj, snapname)
                 if patternmatchobj != None:
-                    snapshots.append(snapname)
-            return snapshots
+                    result.append(snapname)
+            return result
+
+    def list_snapshot_usage(self):
+        """
+        Returns the used size and number of user holds of all snapshots
+        of this dataset, fetched in a single zfs(1) invocation, as a list
+        of [name, used, userrefs] sorted by creation, oldest first.
+        Cached snapshots of this dataset that no longer exist are
+        dropped from the global snapshot cache.
+        """
+        cmd = [ZFSCMD, "list", "-H", "-p", "-t", "snapshot", "-d", "1",
+               "-s", "createtxg", "-o", "name,used,userrefs", self.name]
+        outdata,errdata = util.run_command(cmd)
+        result = []
+        for line in outdata.rstrip().split('\n'):
+            line = line.split()
+            if len(line) != 3:
+                continue
+            result.append([line[0], int(line[1]), int(line[2])])
+
+        existing = set([name for name,used,userrefs in result])
+        if Datasets.snapshots.is_loaded() == True:
+            for name,ctime in Datasets.snapshots.list(dataset = self.name):
+                if name not in existing:
+                    Datasets.snapshots.remove(name)
+        return result
 
     def set_auto_snap(self, include, inherit = False):
         if inherit == True:
@@ -998,6 +1774,37 @@ def list_zpools():
     return result
 
 
+def get_zpool_space(poolnames):
+    """
+    Returns a dictionary mapping the names of zpools to tuples of the
+    "used" and "available" property values of their top-level
+    filesystems, in bytes, using a single zfs(1) invocation for all
+    of them. Zpools that can not be queried are left out.
+
+    Keyword arguments:
+    poolnames -- The names of the zpools to query
+    """
+    result = {}
+    if len(poolnames) == 0:
+        return result
+    cmd = [ZFSCMD, "get", "-H", "-p", "-o", "name,property,value", \
+           "used,available"] + list(poolnames)
+    # Don't give up on all zpools because one of them went away.
+    outdata,errdata = util.run_command(cmd, False)
+    values = {}
+    for line in outdata.rstrip().split('\n'):
+        try:
+            name,prop,value = line.split('\t')
+            values[(name, prop)] = int(value)
+        except ValueError:
+            continue
+    for name in poolnames:
+        if (name, "used") in values and (name, "available") in values:
+            result[name] = (values[(name, "used")],
+                            values[(name, "available")])
+    return result
+
+
 if __name__ == "__main__":
     for zpool in list_zpools():
         pool = ZPool(zpool)
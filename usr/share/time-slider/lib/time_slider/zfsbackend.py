@@ -0,0 +1,321 @@
+#!/usr/bin/python3
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+"""
+Backends carrying out the operations of the zfs module that modify
+snapshots: creating, destroying, holding and releasing them, and
+bookmarking them. The command backend runs zfs(1). The libzfs_core
+backend uses the pyzfs bindings to libzfs_core, when installed, to
+handle a whole set of snapshots in a single ioctl instead of one
+process per dataset.
+
+All backends raise RuntimeError when an operation fails, the same as
+util.run_command() does.
+"""
+
+from . import util
+
+# Maximum length of the comma separated snapshot list passed as a
+# single argument to "zfs destroy". Linux limits any single argument
+# to 128KiB so stay well below that.
+DESTROY_ARG_MAX = 32 * 1024
+
+# Names of the backends get_backend() knows about
+BACKENDS = ("auto", "cli", "libzfs_core")
+
+
+def destroy_args(fsname, snaplabels):
+    """
+    Returns a list of "fs@snap1,snap2,..." arguments for zfs destroy
+    covering all of snaplabels, each no longer than DESTROY_ARG_MAX.
+    """
+    chunks = [[]]
+    length = len(fsname) + 1
+    for snaplabel in snaplabels:
+        if len(chunks[-1]) > 0 and \
+           length + len(snaplabel) + 1 > DESTROY_ARG_MAX:
+            chunks.append([])
+            length = len(fsname) + 1
+        chunks[-1].append(snaplabel)
+        length += len(snaplabel) + 1
+    return ["%s@%s" % (fsname, ",".join(chunk)) for chunk in chunks]
+
+
+def group_by_pool(names):
+    """
+    Returns a list of lists of the snapshot or bookmark names, one
+    per zpool
+    """
+    groups = {}
+    for name in names:
+        pool = name.split('/', 1)[0].split('@', 1)[0].split('#', 1)[0]
+        groups.setdefault(pool, []).append(name)
+    return list(groups.values())
+
+
+def group_by_dataset(names):
+    """
+    Returns a list of (fsname, snaplabels) tuples for the snapshot
+    names, in the order the datasets first appear in.
+    """
+    groups = {}
+    order = []
+    for name in names:
+        fsname,snaplabel = name.split('@', 1)
+        if fsname not in groups:
+            groups[fsname] = []
+            order.append(fsname)
+        groups[fsname].append(snaplabel)
+    return [(fsname, groups[fsname]) for fsname in order]
+
+
+class CommandBackend:
+    """
+    Carries out zfs operations by running zfs(1)
+    """
+    name = "cli"
+
+    def __init__(self, zfscmd):
+        self.zfscmd = zfscmd
+
+    def snapshot(self, names, recursive = False):
+        """
+        Creates the snapshots, atomically per zpool. zfs(1) refuses
+        to snapshot datasets in different zpools in one go, so there is
+        one invocation per zpool.
+
+        Keyword arguments:
+        names -- List of full snapshot names to create
+        recursive -- Also snapshot all descendent datasets
+                     (default False)
+        """
+        # A failure in one zpool shouldn't stop the others from
+        # getting their snapshots.
+        errors = []
+        for group in group_by_pool(names):
+            cmd = [self.zfscmd, "snapshot"]
+            if recursive == True:
+                cmd.append("-r")
+            try:
+                outdata,errdata = util.run_command(cmd + group)
+            except RuntimeError as message:
+                errors.append(str(message))
+        if len(errors) > 0:
+            raise RuntimeError("\n".join(errors))
+
+    def destroy_snapshots(self, names, deferred = True):
+        """
+        Destroys the snapshots, using one zfs(1) invocation per
+        dataset where possible. Stops at the first invocation that
+        fails. zfs(1) skips snapshots that don't exist, unless none of
+        a dataset's do, in which case it fails.
+
+        Keyword arguments:
+        names -- List of full snapshot names to destroy
+        deferred -- Perform a deferred destroy (default True)
+        """
+        for fsname,snaplabels in group_by_dataset(names):
+            for arg in destroy_args(fsname, snaplabels):
+                cmd = [self.zfscmd, "destroy"]
+                if deferred == True:
+                    cmd.append("-d")
+                cmd.append(arg)
+                outdata,errdata = util.run_command(cmd)
+
+    def hold(self, tag, names):
+        """
+        Places a user hold called tag on each of the snapshots
+        """
+        for group in group_by_pool(names):
+            cmd = [self.zfscmd, "hold", tag] + group
+            outdata,errdata = util.run_command(cmd)
+
+    def bookmark(self, bookmarks):
+        """
+        Creates bookmarks, given as a dictionary mapping the full
+        bookmark names to the snapshots to bookmark. zfs(1) creates
+        one bookmark at a time.
+        """
+        for name,snapname in bookmarks.items():
+            cmd = [self.zfscmd, "bookmark", snapname, name]
+            outdata,errdata = util.run_command(cmd)
+
+    def destroy_bookmarks(self, names):
+        """
+        Destroys the bookmarks
+        """
+        for name in names:
+            cmd = [self.zfscmd, "destroy", name]
+            outdata,errdata = util.run_command(cmd)
+
+    def release(self, tag, names):
+        """
+        Releases the user hold called tag from each of the snapshots
+        """
+        for group in group_by_pool(names):
+            cmd = [self.zfscmd, "release", tag] + group
+            outdata,errdata = util.run_command(cmd)
+
+    def list_descendents(self, fsnames):
+        """
+        Returns the names of the filesystems and volumes fsnames and
+        all their descendents, using a single zfs(1) invocation.
+        """
+        cmd = [self.zfscmd, "list", "-H", "-r", "-t", "filesystem,volume",
+               "-o", "name"] + list(fsnames)
+        outdata,errdata = util.run_command(cmd)
+        return [line for line in outdata.rstrip().split('\n') \
+                if len(line) > 0]
+
+
+class LibZFSCoreBackend(CommandBackend):
+    """
+    Carries out zfs operations through libzfs_core. Raises ImportError
+    if the pyzfs bindings are not installed. Listing datasets still
+    takes zfs(1) since libzfs_core doesn't provide for it.
+    libzfs_core operates on one zpool at a time, so there is one
+    ioctl per zpool involved.
+    """
+    name = "libzfs_core"
+
+    def __init__(self, zfscmd):
+        import libzfs_core
+        import libzfs_core.exceptions
+        CommandBackend.__init__(self, zfscmd)
+        self.lzc = libzfs_core
+        self.errors = libzfs_core.exceptions
+
+    def __describe(self, operation, error):
+        """
+        Returns an error message for a libzfs_core exception
+        """
+        details = [str(error)]
+        # Operations on several snapshots report each failure separately
+        for suberror in getattr(error, "errors", None) or []:
+            details.append(str(suberror))
+        return "libzfs_core %s failed: %s" % (operation, "\n".join(details))
+
+    def snapshot(self, names, recursive = False):
+        if len(names) == 0:
+            return
+        if recursive == True:
+            # Expand into the whole tree below each snapshotted dataset
+            labels = dict([name.split('@', 1) for name in names])
+            expanded = []
+            seen = set()
+            for fsname in self.list_descendents(list(labels.keys())):
+                if fsname in seen:
+                    continue
+                seen.add(fsname)
+                root = fsname
+                while root not in labels:
+                    root = root.rsplit('/', 1)[0]
+                expanded.append("%s@%s" % (fsname, labels[root]))
+            names = expanded
+        errors = []
+        for group in group_by_pool(names):
+            snaps = [name.encode('utf-8') for name in group]
+            util.debug("lzc_snapshot %s" % (group), True)
+            try:
+                self.lzc.lzc_snapshot(snaps)
+            except self.errors.ZFSError as error:
+                errors.append(self.__describe("snapshot", error))
+        if len(errors) > 0:
+            raise RuntimeError("\n".join(errors))
+
+    def destroy_snapshots(self, names, deferred = True):
+        if len(names) == 0:
+            return
+        for group in group_by_pool(names):
+            snaps = [name.encode('utf-8') for name in group]
+            util.debug("lzc_destroy_snaps %s" % (group), True)
+            try:
+                self.lzc.lzc_destroy_snaps(snaps, deferred)
+            except self.errors.ZFSError as error:
+                raise RuntimeError(self.__describe("destroy", error))
+
+    def hold(self, tag, names):
+        if len(names) == 0:
+            return
+        for group in group_by_pool(names):
+            holds = dict([(name.encode('utf-8'), tag.encode('utf-8')) \
+                          for name in group])
+            try:
+                self.lzc.lzc_hold(holds)
+            except self.errors.ZFSError as error:
+                raise RuntimeError(self.__describe("hold", error))
+
+    def release(self, tag, names):
+        if len(names) == 0:
+            return
+        for group in group_by_pool(names):
+            holds = dict([(name.encode('utf-8'), [tag.encode('utf-8')]) \
+                          for name in group])
+            try:
+                self.lzc.lzc_release(holds)
+            except self.errors.ZFSError as error:
+                raise RuntimeError(self.__describe("release", error))
+
+    def bookmark(self, bookmarks):
+        if len(bookmarks) == 0:
+            return
+        for group in group_by_pool(list(bookmarks.keys())):
+            pairs = dict([(name.encode('utf-8'),
+                           bookmarks[name].encode('utf-8')) \
+                          for name in group])
+            try:
+                self.lzc.lzc_bookmark(pairs)
+            except self.errors.ZFSError as error:
+                raise RuntimeError(self.__describe("bookmark", error))
+
+    def destroy_bookmarks(self, names):
+        if len(names) == 0:
+            return
+        for group in group_by_pool(names):
+            try:
+                self.lzc.lzc_destroy_bookmarks([name.encode('utf-8') \
+                                                for name in group])
+            except self.errors.ZFSError as error:
+                raise RuntimeError(self.__describe("destroy bookmarks",
+                                                   error))
+
+
+def get_backend(name, zfscmd):
+    """
+    Returns a new backend instance.
+
+    Keyword arguments:
+    name -- One of BACKENDS. "auto" picks libzfs_core if the pyzfs
+            bindings are installed and the command backend otherwise.
+    zfscmd -- Path to zfs(1)
+    """
+    if name not in BACKENDS:
+        raise ValueError("\'%s\' is not a valid zfs backend" % (name))
+    if name == "cli":
+        return CommandBackend(zfscmd)
+    try:
+        return LibZFSCoreBackend(zfscmd)
+    except ImportError as message:
+        if name == "libzfs_core":
+            raise RuntimeError("libzfs_core backend not available: %s" \
+                               % str(message))
+    return CommandBackend(zfscmd)
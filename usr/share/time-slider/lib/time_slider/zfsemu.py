@@ -0,0 +1,1320 @@
+#!/usr/bin/python3
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+"""
+An in-memory emulation of zfs(1) and zpool(1), for benchmarking and
+simulating time-slider without real zpools.
+
+ZFSEmulator models zpools, filesystems, volumes and snapshots with
+their creation times, used, referenced and written space, user holds,
+deferred destroys, clones and user properties. It answers the zfs(1)
+and zpool(1) command lines used by time-slider with the same output
+the real commands produce. Installed with install(), every command
+run through util.run_command() goes to the emulator instead, so the
+unmodified zfs module, daemon and plugins run against it. zfs send
+and receive, which the plugins run as pipelines of their own, are
+not emulated.
+
+Space accounting follows how zfs tracks block birth and death times.
+Data written between two snapshots is one cohort. Overwriting or
+deleting data frees it proportionally from all live cohorts, and
+freed data that is still referenced by a snapshot stays charged to
+the snapshots until the last of them is destroyed.
+"""
+
+import os
+import time
+import getopt
+import random
+import threading
+import subprocess
+from bisect import bisect_left, bisect_right
+
+from . import util
+from . import zfs
+from . import zfsbackend
+
+# Properties whose values are byte counts
+SIZEPROPS = ("used", "referenced", "available", "written", "usedbysnapshots",
+             "usedbydataset", "usedbychildren", "volsize", "size",
+             "allocated", "free", "freeing")
+
+# Abbreviations zfs(1) accepts for property names
+ALIASES = {"refer" : "referenced", "avail" : "available",
+           "usedsnap" : "usedbysnapshots", "usedds" : "usedbydataset",
+           "usedchild" : "usedbychildren", "alloc" : "allocated",
+           "cap" : "capacity"}
+
+# Native properties that can be set, with their default values
+SETTABLE = {"mountpoint" : None, "canmount" : "on", "compression" : "off",
+            "atime" : "on", "readonly" : "off", "snapdir" : "hidden"}
+
+# Read only native properties
+READONLY = ("name", "type", "creation", "used", "referenced", "available",
+            "written", "userrefs", "origin", "mounted", "createtxg", "guid",
+            "usedbysnapshots", "usedbydataset", "usedbychildren",
+            "defer_destroy", "clones", "volsize", "receive_resume_token",
+            "snapshot_count")
+
+TYPES = {"filesystem" : "filesystem", "fs" : "filesystem",
+         "volume" : "volume", "vol" : "volume",
+         "snapshot" : "snapshot", "snap" : "snapshot"}
+
+
+class VirtualClock:
+    """
+    A clock that only moves when told to, for running days of
+    snapshot schedules in seconds. Pass its time method as the
+    emulator's clock.
+    """
+    def __init__(self, start = None):
+        if start == None:
+            start = int(time.time())
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+        return self.now
+
+
+class CommandError(Exception):
+    """
+    Raised by the command handlers. Carries the message written to
+    standard error and the exit status.
+    """
+    def __init__(self, message, status = 1):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def parse_size(value):
+    """
+    Converts a size like "10G" or "512" to a number of bytes
+    """
+    if isinstance(value, int):
+        return value
+    value = value.strip().upper().rstrip("B")
+    units = "KMGTPE"
+    if len(value) > 0 and value[-1] in units:
+        return int(float(value[:-1]) * 1024 ** (units.index(value[-1]) + 1))
+    return int(value)
+
+
+def nicenum(value):
+    """
+    Formats a number of bytes the way zfs(1) does without -p
+    """
+    if value < 1024:
+        return str(value)
+    units = "KMGTPE"
+    idx = 0
+    value = float(value) / 1024
+    while value >= 1024 and idx < len(units) - 1:
+        value /= 1024
+        idx += 1
+    if value < 10:
+        return "%.2f%s" % (value, units[idx])
+    if value < 100:
+        return "%.1f%s" % (value, units[idx])
+    return "%.0f%s" % (value, units[idx])
+
+
+class Pool:
+    """
+    An emulated zpool
+    """
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.txg = 1
+        self.root = None
+
+    def get_used(self):
+        return self.root.used
+
+    def get_available(self):
+        return max(self.size - self.root.used, 0)
+
+
+class Dataset:
+    """
+    An emulated filesystem or volume
+    """
+    def __init__(self, name, dstype, parent, pool, creation, guid):
+        self.name = name
+        self.type = dstype
+        self.parent = parent
+        self.pool = pool
+        self.children = {}
+        self.props = {}
+        self.creation = creation
+        self.createtxg = pool.txg
+        self.guid = guid
+        self.volsize = 0
+        # Snapshots in creation order and their txgs, for bisection
+        self.snapshots = []
+        self.txgs = []
+        self.snaplabels = {}
+        # Bytes of live data by the txg of the latest snapshot at the
+        # time it was written, and bytes of freed data still held by
+        # snapshots by the txgs of the latest snapshots when it was
+        # written and when it was freed. Data is referenced by the
+        # snapshots whose txg is above the first and at most the second.
+        self.live = {}
+        self.dead = {}
+        self.livesize = 0
+        self.snapused = 0
+        # Total used space, including children
+        self.used = 0
+        self.origin = None
+        self.originrefd = 0
+        self.__accounting = None
+
+    def get_epoch(self):
+        if len(self.txgs) == 0:
+            return 0
+        return self.txgs[-1]
+
+    def charge(self, delta):
+        """
+        Adds delta bytes to the used space of the dataset and its
+        ancestors
+        """
+        dataset = self
+        while dataset != None:
+            dataset.used += delta
+            dataset = dataset.parent
+
+    def changed(self):
+        self.__accounting = None
+
+    def write(self, nbytes, free):
+        """
+        Writes nbytes of new data after freeing free bytes of existing
+        data, taken proportionally from all live data. Returns the
+        change in used space.
+        """
+        epoch = self.get_epoch()
+        free = min(free, self.livesize)
+        vanished = 0
+        if free > 0:
+            remaining = free
+            for born,size in list(self.live.items()):
+                share = min(size, remaining,
+                            -(-free * size // self.livesize))
+                remaining -= share
+                if share == size:
+                    del self.live[born]
+                else:
+                    self.live[born] = size - share
+                if born < epoch:
+                    key = (born, epoch)
+                    self.dead[key] = self.dead.get(key, 0) + share
+                    self.snapused += share
+                else:
+                    vanished += share
+                if remaining == 0:
+                    break
+            self.livesize -= free
+        if nbytes > 0:
+            self.live[epoch] = self.live.get(epoch, 0) + nbytes
+            self.livesize += nbytes
+        self.changed()
+        delta = nbytes - vanished
+        self.charge(delta)
+        return delta
+
+    def add_snapshot(self, snapshot):
+        self.snapshots.append(snapshot)
+        self.txgs.append(snapshot.txg)
+        self.snaplabels[snapshot.label] = snapshot
+        self.changed()
+
+    def remove_snapshots(self, doomed):
+        """
+        Removes the snapshots and frees the data no remaining snapshot
+        references. Returns the number of bytes freed.
+        """
+        for snapshot in doomed:
+            del self.snaplabels[snapshot.label]
+        doomed = set(doomed)
+        self.snapshots = [s for s in self.snapshots if s not in doomed]
+        self.txgs = [s.txg for s in self.snapshots]
+        # Only the range of remaining snapshots referencing the data
+        # matters, so move the records to the txgs of the remaining
+        # snapshots before them and merge those that end up the same.
+        # That keeps their number bounded by the number of snapshots.
+        live = {}
+        for born,size in self.live.items():
+            born = self.__floor(born)
+            live[born] = live.get(born, 0) + size
+        dead = {}
+        freed = 0
+        for (born, died),size in self.dead.items():
+            key = (self.__floor(born), self.__floor(died))
+            if key[0] == key[1]:
+                freed += size
+            else:
+                dead[key] = dead.get(key, 0) + size
+        self.live = live
+        self.dead = dead
+        self.snapused -= freed
+        self.changed()
+        self.charge(-freed)
+        return freed
+
+    def __floor(self, txg):
+        """
+        Returns the txg of the latest snapshot taken at or before txg,
+        or 0 if there is none
+        """
+        idx = bisect_right(self.txgs, txg)
+        if idx == 0:
+            return 0
+        return self.txgs[idx - 1]
+
+    def get_reclaim(self, doomed):
+        """
+        Returns the number of bytes destroying the snapshots would free
+        """
+        remaining = [s.txg for s in self.snapshots if s not in doomed]
+        result = 0
+        for key,size in self.dead.items():
+            born,died = key
+            if bisect_right(remaining, died) - bisect_right(remaining, born) \
+               == 0:
+                result += size
+        return result
+
+    def get_accounting(self):
+        """
+        Returns lists of the used, referenced and written space of
+        each snapshot, in creation order
+        """
+        if self.__accounting != None:
+            return self.__accounting
+        count = len(self.txgs)
+        used = [0] * count
+        refd = [0] * (count + 1)
+        written = [0] * count
+        records = [(born, None, size) for born,size in self.live.items()]
+        records.extend([(born, died, size) \
+                        for (born, died),size in self.dead.items()])
+        for born,died,size in records:
+            lo = bisect_right(self.txgs, born)
+            if died == None:
+                hi = count
+            else:
+                hi = bisect_right(self.txgs, died)
+            if hi <= lo:
+                continue
+            if hi - lo == 1 and died != None:
+                used[lo] += size
+            refd[lo] += size
+            refd[hi] -= size
+            written[lo] += size
+        total = self.originrefd
+        for idx in range(count):
+            total += refd[idx]
+            refd[idx] = total
+        self.__accounting = (used, refd[:count], written)
+        return self.__accounting
+
+    def get_written(self):
+        epoch = self.get_epoch()
+        return sum([size for born,size in self.live.items() if born >= epoch])
+
+    def get_written_since(self, snapshot):
+        return sum([size for born,size in self.live.items() \
+                    if born >= snapshot.txg])
+
+
+class Snapshot:
+    """
+    An emulated snapshot
+    """
+    type = "snapshot"
+    # There can be millions of these
+    __slots__ = ("name", "dataset", "label", "txg", "createtxg", "creation",
+                 "guid", "holds", "defer", "clones", "props", "parent")
+
+    def __init__(self, dataset, label, txg, creation, guid):
+        self.name = "%s@%s" % (dataset.name, label)
+        self.dataset = dataset
+        self.label = label
+        self.txg = txg
+        self.createtxg = txg
+        self.creation = creation
+        self.guid = guid
+        # Holds, clones and properties are rare. Save on empty
+        # containers until there are some.
+        self.holds = None
+        self.defer = False
+        self.clones = None
+        self.props = None
+        self.parent = dataset
+
+    def get_index(self):
+        return bisect_left(self.dataset.txgs, self.txg)
+
+
+class ZFSEmulator:
+    """
+    Emulates zfs(1) and zpool(1). Can be passed to
+    util.set_command_backend(), or better install(), to take the
+    place of the real commands.
+    """
+    def __init__(self, clock = None, passthrough = True, seed = 0):
+        """
+        Keyword arguments:
+        clock -- Function returning the current time in seconds since
+                 the epoch, eg. a VirtualClock's time method
+                 (default time.time)
+        passthrough -- Run commands other than zfs(1) and zpool(1)
+                       for real. Otherwise they fail (default True)
+        seed -- Random seed for generating guids (default 0)
+        """
+        if clock == None:
+            clock = time.time
+        self.clock = clock
+        self.passthrough = passthrough
+        self.pools = {}
+        self.datasets = {}
+        self.calls = {}
+        self._lock = threading.RLock()
+        self.__random = random.Random(seed)
+        self.__zfs = {"list" : self.__zfs_list,
+                      "get" : self.__zfs_get,
+                      "set" : self.__zfs_set,
+                      "inherit" : self.__zfs_inherit,
+                      "create" : self.__zfs_create,
+                      "clone" : self.__zfs_clone,
+                      "snapshot" : self.__zfs_snapshot,
+                      "snap" : self.__zfs_snapshot,
+                      "destroy" : self.__zfs_destroy,
+                      "hold" : self.__zfs_hold,
+                      "release" : self.__zfs_release,
+                      "holds" : self.__zfs_holds}
+        self.__zpool = {"list" : self.__zpool_list,
+                        "get" : self.__zpool_get}
+
+    #
+    # Python interface, for setting up and driving the emulation
+    #
+
+    def create_pool(self, name, size):
+        """
+        Creates a zpool of size bytes, with its root filesystem
+        """
+        self._lock.acquire()
+        try:
+            if name in self.pools:
+                raise CommandError("cannot create '%s': pool already exists" \
+                                   % (name))
+            pool = Pool(name, parse_size(size))
+            self.pools[name] = pool
+            pool.root = self.__new_dataset(name, "filesystem", None, pool)
+            return pool
+        finally:
+            self._lock.release()
+
+    def create_dataset(self, name, volume = False, props = None):
+        """
+        Creates a filesystem or volume, and any missing parents
+        """
+        self._lock.acquire()
+        try:
+            dataset = self.__create_dataset(name, volume, True)
+            for prop,value in (props or {}).items():
+                self.__set_prop(dataset, prop, value)
+            return dataset
+        finally:
+            self._lock.release()
+
+    def create_snapshots(self, names, recursive = False):
+        """
+        Creates the snapshots, all in the same transaction group
+        """
+        self._lock.acquire()
+        try:
+            self.__snapshot(names, recursive, {})
+        finally:
+            self._lock.release()
+
+    def write(self, name, nbytes, free = 0):
+        """
+        Writes nbytes of new data to a filesystem or volume, replacing
+        free bytes of the existing data. Writes are cut short when the
+        zpool runs out of space. Returns the number of bytes written.
+        """
+        self._lock.acquire()
+        try:
+            dataset = self.__lookup(name)
+            if dataset.type == "snapshot":
+                raise CommandError("cannot write to snapshot '%s'" % (name))
+            # Freed data only gives space back if no snapshot holds on
+            # to it, so free first and then see what fits.
+            dataset.write(0, free)
+            nbytes = min(nbytes, dataset.pool.get_available())
+            dataset.write(nbytes, 0)
+            return nbytes
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        """
+        Returns a dictionary of the number of emulated invocations of
+        each command, eg. {"zfs list" : 3}
+        """
+        self._lock.acquire()
+        result = dict(self.calls)
+        self._lock.release()
+        return result
+
+    def reset_stats(self):
+        self._lock.acquire()
+        self.calls = {}
+        self._lock.release()
+
+    def get_snapshot_count(self):
+        self._lock.acquire()
+        result = sum([len(d.snapshots) for d in self.datasets.values()])
+        self._lock.release()
+        return result
+
+    #
+    # Command interface, as called by util.run_command()
+    #
+
+    def run(self, command):
+        """
+        Runs command. Returns a tuple of standard out, standard error
+        and exit status.
+        """
+        program = os.path.basename(command[0])
+        if program == "zfs":
+            handlers = self.__zfs
+        elif program == "zpool":
+            handlers = self.__zpool
+        elif self.passthrough == True:
+            p = subprocess.Popen(command,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 close_fds=True)
+            outdata,errdata = (x.decode('utf-8') for x in p.communicate())
+            return outdata,errdata,p.wait()
+        else:
+            raise OSError("%s is not emulated" % (command[0]))
+
+        if len(command) < 2 or command[1] not in handlers:
+            return "", "%s: unrecognized command\n" % (program), 2
+        subcommand = "%s %s" % (program, command[1])
+        self._lock.acquire()
+        try:
+            self.calls[subcommand] = self.calls.get(subcommand, 0) + 1
+            out = []
+            err = []
+            try:
+                handlers[command[1]](command[2:], out, err)
+                status = 0
+                if len(err) > 0:
+                    status = 1
+            except getopt.GetoptError as message:
+                err.append("%s: %s" % (subcommand, str(message)))
+                status = 2
+            except CommandError as message:
+                err.append(str(message))
+                status = message.status
+        finally:
+            self._lock.release()
+        return "".join([line + "\n" for line in out]), \
+               "".join([line + "\n" for line in err]), status
+
+    #
+    # Object model
+    #
+
+    def __new_guid(self):
+        return self.__random.getrandbits(63)
+
+    def __new_dataset(self, name, dstype, parent, pool):
+        dataset = Dataset(name, dstype, parent, pool, int(self.clock()),
+                          self.__new_guid())
+        self.datasets[name] = dataset
+        if parent != None:
+            parent.children[name] = dataset
+        pool.txg += 1
+        return dataset
+
+    def __create_dataset(self, name, volume, parents):
+        if name in self.datasets:
+            if parents == True:
+                return self.datasets[name]
+            raise CommandError("cannot create '%s': dataset already exists" \
+                               % (name))
+        if name.find('@') != -1 or name.find('/') == -1:
+            raise CommandError("cannot create '%s': invalid dataset name" \
+                               % (name))
+        parentname = name.rsplit('/', 1)[0]
+        if parentname not in self.datasets:
+            if parents == False:
+                raise CommandError("cannot create '%s': parent does not " \
+                                   "exist" % (name))
+            self.__create_dataset(parentname, False, True)
+        parent = self.datasets[parentname]
+        if parent.type != "filesystem":
+            raise CommandError("cannot create '%s': parent is not a " \
+                               "filesystem" % (name))
+        dstype = "filesystem"
+        if volume == True:
+            dstype = "volume"
+        return self.__new_dataset(name, dstype, parent, parent.pool)
+
+    def __lookup(self, name):
+        """
+        Returns the dataset or snapshot called name
+        """
+        if name.find('@') != -1:
+            fsname,label = name.split('@', 1)
+            dataset = self.datasets.get(fsname)
+            if dataset != None and label in dataset.snaplabels:
+                return dataset.snaplabels[label]
+        elif name in self.datasets:
+            return self.datasets[name]
+        raise CommandError("cannot open '%s': dataset does not exist" \
+                           % (name))
+
+    def __walk(self, dataset, types, maxdepth, result, depth = 0):
+        """
+        Appends dataset, its snapshots and its descendents, down to
+        maxdepth levels, to result, in the order zfs(1) lists them
+        """
+        if dataset.type in types:
+            result.append(dataset)
+        if maxdepth != None and depth >= maxdepth:
+            return
+        if "snapshot" in types:
+            result.extend(dataset.snapshots)
+        for name in sorted(dataset.children.keys()):
+            self.__walk(dataset.children[name], types, maxdepth, result,
+                        depth + 1)
+
+    def __select(self, args, types, recursive, maxdepth, err):
+        """
+        Returns the objects named by args, or all of them if there
+        are none, in the order zfs(1) lists them. Names that don't
+        exist are reported in err.
+        """
+        result = []
+        if len(args) == 0:
+            for name in sorted(self.pools.keys()):
+                self.__walk(self.pools[name].root, types, maxdepth, result)
+            return result
+        if recursive == False and maxdepth == None:
+            maxdepth = 0
+            if "snapshot" in types and "filesystem" not in types and \
+               "volume" not in types:
+                maxdepth = 1
+        for name in args:
+            try:
+                obj = self.__lookup(name)
+            except CommandError as message:
+                err.append(str(message))
+                continue
+            if obj.type == "snapshot":
+                result.append(obj)
+            else:
+                self.__walk(obj, types, maxdepth, result)
+        return result
+
+    def __parse_types(self, value):
+        types = set()
+        for name in value.split(','):
+            if name == "all":
+                types.update(["filesystem", "volume", "snapshot"])
+            elif name == "bookmark":
+                continue
+            elif name in TYPES:
+                types.add(TYPES[name])
+            else:
+                raise CommandError("invalid type '%s'" % (name), 2)
+        return types
+
+    def __parse_props(self, value):
+        props = []
+        for prop in value.split(','):
+            prop = ALIASES.get(prop, prop)
+            if prop.find(':') == -1 and prop not in READONLY and \
+               prop not in SETTABLE and prop not in ("property", "value",
+                                                     "source") and \
+               not prop.startswith("written@"):
+                raise CommandError("bad property list: invalid property " \
+                                   "'%s'" % (prop), 2)
+            props.append(prop)
+        return props
+
+    def __get_prop(self, obj, prop, parsable = True):
+        """
+        Returns a tuple of the value of prop for obj, as a string,
+        and its source
+        """
+        value,source = self.__get_raw_prop(obj, prop)
+        if value == None:
+            return "-","-"
+        if parsable == False and isinstance(value, int):
+            if prop in SIZEPROPS:
+                value = nicenum(value)
+            elif prop == "creation":
+                value = time.strftime("%a %b %d %H:%M %Y",
+                                      time.localtime(value))
+        return str(value),source
+
+    def __get_raw_prop(self, obj, prop):
+        if prop == "name":
+            return obj.name,"-"
+        if prop == "type":
+            return obj.type,"-"
+        if prop == "creation":
+            return obj.creation,"-"
+        if prop == "createtxg":
+            return obj.createtxg,"-"
+        if prop == "guid":
+            return obj.guid,"-"
+        if prop.find(':') != -1 or prop in SETTABLE:
+            return self.__get_inherited_prop(obj, prop)
+        if prop.startswith("written@"):
+            # The snapshot can be given by its full or its short name
+            snapshot = None
+            if obj.type != "snapshot":
+                label = prop.split('@')[-1]
+                snapshot = obj.snaplabels.get(label)
+            if snapshot == None:
+                return None,"-"
+            return obj.get_written_since(snapshot),"-"
+        if obj.type == "snapshot":
+            return self.__get_snapshot_prop(obj, prop)
+        if prop == "used":
+            return obj.used,"-"
+        if prop == "referenced":
+            return obj.livesize + obj.originrefd,"-"
+        if prop == "available":
+            return obj.pool.get_available(),"-"
+        if prop == "written":
+            return obj.get_written(),"-"
+        if prop == "usedbysnapshots":
+            return obj.snapused,"-"
+        if prop == "usedbydataset":
+            return obj.livesize,"-"
+        if prop == "usedbychildren":
+            return obj.used - obj.livesize - obj.snapused,"-"
+        if prop == "origin":
+            if obj.origin == None:
+                return None,"-"
+            return obj.origin.name,"-"
+        if prop == "mounted":
+            if obj.type != "filesystem":
+                return None,"-"
+            return "yes","-"
+        if prop == "volsize" and obj.type == "volume":
+            return obj.volsize,"local"
+        if prop == "receive_resume_token":
+            return None,"-"
+        if prop == "snapshot_count":
+            # Always counted, as if a snapshot_limit was set
+            return self.__count_snapshots(obj),"-"
+        return None,"-"
+
+    def __count_snapshots(self, dataset):
+        result = 0
+        pending = [dataset]
+        while len(pending) > 0:
+            dataset = pending.pop()
+            result += len(dataset.snapshots)
+            pending.extend(dataset.children.values())
+        return result
+
+    def __get_snapshot_prop(self, obj, prop):
+        if prop in ("used", "referenced", "written"):
+            used,refd,written = obj.dataset.get_accounting()
+            idx = obj.get_index()
+            if prop == "used":
+                return used[idx],"-"
+            if prop == "referenced":
+                return refd[idx],"-"
+            return written[idx],"-"
+        if prop == "userrefs":
+            return len(obj.holds or ()),"-"
+        if prop == "defer_destroy":
+            if obj.defer == True:
+                return "on","-"
+            return "off","-"
+        if prop == "clones":
+            return ",".join(sorted([c.name for c in obj.clones or ()])),"-"
+        return None,"-"
+
+    def __get_inherited_prop(self, obj, prop):
+        if obj.props and prop in obj.props:
+            return obj.props[prop],"local"
+        # Snapshots inherit from their dataset
+        ancestor = obj.parent
+        while ancestor != None:
+            if prop in ancestor.props:
+                value = ancestor.props[prop]
+                if prop == "mountpoint" and obj.type != "snapshot":
+                    value = value.rstrip('/') + obj.name[len(ancestor.name):]
+                return value,"inherited from %s" % (ancestor.name)
+            ancestor = ancestor.parent
+        if prop == "mountpoint":
+            if obj.type != "filesystem":
+                return None,"-"
+            return "/" + obj.name,"default"
+        if prop in SETTABLE:
+            return SETTABLE[prop],"default"
+        return None,"-"
+
+    def __set_prop(self, obj, prop, value):
+        if prop.find(':') == -1 and prop not in SETTABLE:
+            if prop in READONLY:
+                raise CommandError("cannot set property for '%s': '%s' is " \
+                                   "readonly" % (obj.name, prop))
+            raise CommandError("cannot set property for '%s': invalid " \
+                               "property '%s'" % (obj.name, prop))
+        if obj.type == "snapshot" and prop.find(':') == -1:
+            raise CommandError("cannot set property for '%s': this " \
+                               "property can not be modified for " \
+                               "snapshots" % (obj.name))
+        if obj.props == None:
+            obj.props = {}
+        obj.props[prop] = value
+
+    def __snapshot(self, names, recursive, props):
+        """
+        Creates the snapshots atomically, as lzc_snapshot() does
+        """
+        doomed = []
+        seen = set()
+        pool = None
+        for name in names:
+            if name.find('@') == -1:
+                raise CommandError("cannot create snapshot '%s': invalid " \
+                                   "snapshot name" % (name))
+            fsname,label = name.split('@', 1)
+            if fsname not in self.datasets:
+                raise CommandError("cannot open '%s': dataset does not " \
+                                   "exist" % (fsname))
+            dataset = self.datasets[fsname]
+            if pool == None:
+                pool = dataset.pool
+            elif pool != dataset.pool:
+                raise CommandError("cannot create snapshots : " \
+                                   "cross-device link", 1)
+            datasets = [dataset]
+            if recursive == True:
+                datasets = []
+                self.__walk(dataset, ("filesystem", "volume"), None,
+                            datasets)
+            for dataset in datasets:
+                if dataset.name in seen:
+                    raise CommandError("cannot create snapshots : " \
+                                       "multiple snapshots of same fs " \
+                                       "not allowed")
+                if label in dataset.snaplabels:
+                    raise CommandError("cannot create snapshot '%s@%s': " \
+                                       "dataset already exists" \
+                                       % (dataset.name, label))
+                seen.add(dataset.name)
+                doomed.append((dataset, label))
+        if pool == None:
+            return
+        creation = int(self.clock())
+        for dataset,label in doomed:
+            snapshot = Snapshot(dataset, label, pool.txg, creation,
+                                self.__new_guid())
+            if len(props) > 0:
+                snapshot.props = dict(props)
+            dataset.add_snapshot(snapshot)
+        pool.txg += 1
+
+    def __destroy_snapshots(self, snapshots, deferred):
+        """
+        Destroys the snapshots, or marks them for a deferred destroy
+        if they are held or cloned
+        """
+        for snapshot in snapshots:
+            if snapshot.holds and deferred == False:
+                raise CommandError("cannot destroy snapshot %s: dataset " \
+                                   "is busy" % (snapshot.name))
+            if snapshot.clones and deferred == False:
+                raise CommandError("cannot destroy '%s': snapshot has " \
+                                   "dependent clones" % (snapshot.name))
+        groups = {}
+        for snapshot in snapshots:
+            if snapshot.holds or snapshot.clones:
+                snapshot.defer = True
+            else:
+                groups.setdefault(snapshot.dataset, []).append(snapshot)
+        for dataset,doomed in groups.items():
+            dataset.remove_snapshots(doomed)
+
+    def __destroy_dataset(self, dataset):
+        if len(dataset.children) > 0 or len(dataset.snapshots) > 0:
+            raise CommandError("cannot destroy '%s': filesystem has " \
+                               "children\nuse '-r' to destroy the " \
+                               "following datasets:" % (dataset.name))
+        if dataset.parent == None:
+            raise CommandError("cannot destroy '%s': operation does not " \
+                               "apply to pools" % (dataset.name))
+        dataset.charge(-(dataset.livesize + dataset.snapused))
+        del dataset.parent.children[dataset.name]
+        del self.datasets[dataset.name]
+        origin = dataset.origin
+        if origin != None:
+            origin.clones.discard(dataset)
+            if origin.defer == True and not origin.clones and \
+               not origin.holds:
+                origin.dataset.remove_snapshots([origin])
+
+    def __match_snapshots(self, dataset, spec):
+        """
+        Returns the snapshots of dataset matching the "snap1,snap2%snap3"
+        part of a zfs destroy argument
+        """
+        result = []
+        for item in spec.split(','):
+            if item.find('%') == -1:
+                if item in dataset.snaplabels:
+                    result.append(dataset.snaplabels[item])
+                continue
+            first,last = item.split('%', 1)
+            lo = 0
+            hi = len(dataset.snapshots)
+            if len(first) > 0:
+                if first not in dataset.snaplabels:
+                    continue
+                lo = dataset.snaplabels[first].get_index()
+            if len(last) > 0:
+                if last not in dataset.snaplabels:
+                    continue
+                hi = dataset.snaplabels[last].get_index() + 1
+            result.extend(dataset.snapshots[lo:hi])
+        return result
+
+    #
+    # zfs(1) subcommands
+    #
+
+    def __format(self, rows, headers, scripted, out):
+        if scripted == True:
+            out.extend(["\t".join(row) for row in rows])
+            return
+        widths = [len(h) for h in headers]
+        for row in rows:
+            for idx in range(len(row)):
+                widths[idx] = max(widths[idx], len(row[idx]))
+        for row in [headers] + rows:
+            out.append("  ".join([row[idx].ljust(widths[idx]) \
+                                  for idx in range(len(row))]).rstrip())
+
+    def __zfs_list(self, args, out, err):
+        opts,args = getopt.getopt(args, "Hprd:t:o:s:S:")
+        scripted = False
+        parsable = False
+        recursive = False
+        maxdepth = None
+        types = set(["filesystem", "volume"])
+        props = ["name", "used", "available", "referenced", "mountpoint"]
+        sortkeys = []
+        for opt,value in opts:
+            if opt == "-H":
+                scripted = True
+            elif opt == "-p":
+                parsable = True
+            elif opt == "-r":
+                recursive = True
+            elif opt == "-d":
+                recursive = True
+                maxdepth = int(value)
+            elif opt == "-t":
+                types = self.__parse_types(value)
+            elif opt == "-o":
+                props = self.__parse_props(value)
+            else:
+                sortkeys.append((ALIASES.get(value, value), opt == "-S"))
+
+        objs = self.__select(args, types, recursive, maxdepth, err)
+        # Sorting is stable, so apply the least significant key first
+        for prop,reverse in reversed(sortkeys):
+            def key(obj):
+                value,source = self.__get_raw_prop(obj, prop)
+                if value == None:
+                    return (1, 0, "")
+                if isinstance(value, int):
+                    return (0, value, "")
+                return (0, 0, value)
+            objs.sort(key=key, reverse=reverse)
+        rows = [[self.__get_prop(obj, prop, parsable)[0] for prop in props] \
+                for obj in objs]
+        self.__format(rows, [p.upper() for p in props], scripted, out)
+
+    def __zfs_get(self, args, out, err):
+        opts,args = getopt.getopt(args, "Hprd:t:o:s:")
+        scripted = False
+        parsable = False
+        recursive = False
+        maxdepth = None
+        types = set(["filesystem", "volume", "snapshot"])
+        fields = ["name", "property", "value", "source"]
+        sources = None
+        for opt,value in opts:
+            if opt == "-H":
+                scripted = True
+            elif opt == "-p":
+                parsable = True
+            elif opt == "-r":
+                recursive = True
+            elif opt == "-d":
+                recursive = True
+                maxdepth = int(value)
+            elif opt == "-t":
+                types = self.__parse_types(value)
+            elif opt == "-o":
+                fields = value.split(',')
+            else:
+                sources = value.split(',')
+        if len(args) == 0:
+            raise CommandError("missing property argument", 2)
+        props = self.__parse_props(args[0])
+        objs = self.__select(args[1:], types, recursive, maxdepth, err)
+        columns = ["name", "property", "value", "source"]
+        indices = [columns.index(f) if f in columns else None for f in fields]
+        rows = []
+        for obj in objs:
+            for prop in props:
+                value,source = self.__get_prop(obj, prop, parsable)
+                if sources != None:
+                    kind = source.split()[0]
+                    if kind == "-":
+                        kind = "none"
+                    if kind not in sources:
+                        continue
+                values = (obj.name, prop, value, source)
+                rows.append([values[idx] if idx != None else "-" \
+                             for idx in indices])
+        self.__format(rows, [f.upper() for f in fields], scripted, out)
+
+    def __zfs_set(self, args, out, err):
+        assignments = [arg for arg in args if arg.find('=') != -1]
+        names = args[len(assignments):]
+        if len(assignments) == 0 or len(names) == 0:
+            raise CommandError("missing property=value or dataset " \
+                               "argument", 2)
+        objs = [self.__lookup(name) for name in names]
+        for assignment in assignments:
+            prop,value = assignment.split('=', 1)
+            for obj in objs:
+                self.__set_prop(obj, ALIASES.get(prop, prop), value)
+
+    def __zfs_inherit(self, args, out, err):
+        opts,args = getopt.getopt(args, "rS")
+        recursive = ("-r", "") in opts
+        if len(args) < 2:
+            raise CommandError("missing property or dataset argument", 2)
+        prop = args[0]
+        for name in args[1:]:
+            objs = [self.__lookup(name)]
+            if recursive == True and objs[0].type != "snapshot":
+                objs = []
+                self.__walk(self.__lookup(name),
+                            ("filesystem", "volume", "snapshot"), None, objs)
+            for obj in objs:
+                if obj.props:
+                    obj.props.pop(prop, None)
+
+    def __parse_assignments(self, opts):
+        props = {}
+        for opt,value in opts:
+            if opt == "-o":
+                prop,value = value.split('=', 1)
+                props[prop] = value
+        return props
+
+    def __zfs_create(self, args, out, err):
+        opts,args = getopt.getopt(args, "psV:o:")
+        if len(args) != 1:
+            raise CommandError("missing dataset argument", 2)
+        volsize = None
+        for opt,value in opts:
+            if opt == "-V":
+                volsize = parse_size(value)
+        dataset = self.__create_dataset(args[0], volsize != None,
+                                        ("-p", "") in opts)
+        if volsize != None:
+            dataset.volsize = volsize
+        for prop,value in self.__parse_assignments(opts).items():
+            self.__set_prop(dataset, prop, value)
+
+    def __zfs_clone(self, args, out, err):
+        opts,args = getopt.getopt(args, "po:")
+        if len(args) != 2:
+            raise CommandError("missing source or target dataset", 2)
+        origin = self.__lookup(args[0])
+        if origin.type != "snapshot":
+            raise CommandError("cannot create '%s': source is not a " \
+                               "snapshot" % (args[1]))
+        if args[1].split('/', 1)[0] != origin.dataset.pool.name:
+            raise CommandError("cannot create '%s': source and target " \
+                               "pools differ" % (args[1]))
+        clone = self.__create_dataset(args[1],
+                                      origin.dataset.type == "volume",
+                                      ("-p", "") in opts)
+        used,refd,written = origin.dataset.get_accounting()
+        clone.origin = origin
+        clone.originrefd = refd[origin.get_index()]
+        if origin.clones == None:
+            origin.clones = set()
+        origin.clones.add(clone)
+        for prop,value in self.__parse_assignments(opts).items():
+            self.__set_prop(clone, prop, value)
+
+    def __zfs_snapshot(self, args, out, err):
+        opts,args = getopt.getopt(args, "ro:")
+        if len(args) == 0:
+            raise CommandError("missing snapshot argument", 2)
+        self.__snapshot(args, ("-r", "") in opts,
+                        self.__parse_assignments(opts))
+
+    def __zfs_destroy(self, args, out, err):
+        opts,args = getopt.getopt(args, "dfnpRrv")
+        flags = set([opt for opt,value in opts])
+        if len(args) != 1:
+            raise CommandError("missing dataset argument", 2)
+        arg = args[0]
+        if arg.find('@') == -1:
+            dataset = self.__lookup(arg)
+            if "-r" in flags or "-R" in flags:
+                doomed = []
+                self.__walk(dataset, ("filesystem", "volume"), None, doomed)
+            else:
+                doomed = [dataset]
+            if "-n" in flags:
+                return
+            for dataset in reversed(doomed):
+                if "-r" in flags or "-R" in flags:
+                    self.__destroy_snapshots(dataset.snapshots, True)
+                    if len(dataset.snapshots) > 0:
+                        raise CommandError("cannot destroy '%s': dataset " \
+                                           "is busy" % (dataset.name))
+                self.__destroy_dataset(dataset)
+            return
+
+        fsname,spec = arg.split('@', 1)
+        dataset = self.__lookup(fsname)
+        datasets = [dataset]
+        if "-r" in flags or "-R" in flags:
+            datasets = []
+            self.__walk(dataset, ("filesystem", "volume"), None, datasets)
+        snapshots = []
+        for dataset in datasets:
+            snapshots.extend(self.__match_snapshots(dataset, spec))
+        if len(snapshots) == 0:
+            raise CommandError("could not find any snapshots to destroy; " \
+                               "check snapshot names.")
+        if "-v" in flags:
+            for snapshot in snapshots:
+                if "-p" in flags:
+                    out.append("destroy\t%s" % (snapshot.name))
+                elif "-n" in flags:
+                    out.append("would destroy %s" % (snapshot.name))
+                else:
+                    out.append("will destroy %s" % (snapshot.name))
+        if "-n" in flags or "-v" in flags:
+            doomed = set(snapshots)
+            reclaim = 0
+            for dataset in datasets:
+                reclaim += dataset.get_reclaim(doomed)
+            if "-p" in flags:
+                out.append("reclaim\t%d" % (reclaim))
+            elif "-n" in flags:
+                out.append("would reclaim %s" % (nicenum(reclaim)))
+            else:
+                out.append("will reclaim %s" % (nicenum(reclaim)))
+        if "-n" in flags:
+            return
+        self.__destroy_snapshots(snapshots, "-d" in flags)
+
+    def __hold_targets(self, args, recursive):
+        tag = args[0]
+        snapshots = []
+        for name in args[1:]:
+            snapshot = self.__lookup(name)
+            if snapshot.type != "snapshot":
+                raise CommandError("'%s' is not a snapshot" % (name))
+            if recursive == True:
+                datasets = []
+                self.__walk(snapshot.dataset, ("filesystem", "volume"), None,
+                            datasets)
+                snapshots.extend([d.snaplabels[snapshot.label] \
+                                  for d in datasets \
+                                  if snapshot.label in d.snaplabels])
+            else:
+                snapshots.append(snapshot)
+        return tag,snapshots
+
+    def __zfs_hold(self, args, out, err):
+        opts,args = getopt.getopt(args, "r")
+        if len(args) < 2:
+            raise CommandError("missing tag or snapshot argument", 2)
+        tag,snapshots = self.__hold_targets(args, ("-r", "") in opts)
+        for snapshot in snapshots:
+            if snapshot.holds and tag in snapshot.holds:
+                raise CommandError("cannot hold snapshot '%s': tag " \
+                                   "already exists on this dataset" \
+                                   % (snapshot.name))
+        now = int(self.clock())
+        for snapshot in snapshots:
+            if snapshot.holds == None:
+                snapshot.holds = {}
+            snapshot.holds[tag] = now
+
+    def __zfs_release(self, args, out, err):
+        opts,args = getopt.getopt(args, "r")
+        if len(args) < 2:
+            raise CommandError("missing tag or snapshot argument", 2)
+        tag,snapshots = self.__hold_targets(args, ("-r", "") in opts)
+        for snapshot in snapshots:
+            if not snapshot.holds or tag not in snapshot.holds:
+                raise CommandError("cannot release hold from snapshot " \
+                                   "'%s': no such tag on this dataset" \
+                                   % (snapshot.name))
+        for snapshot in snapshots:
+            del snapshot.holds[tag]
+            if snapshot.defer == True and not snapshot.holds and \
+               not snapshot.clones:
+                snapshot.dataset.remove_snapshots([snapshot])
+
+    def __zfs_holds(self, args, out, err):
+        opts,args = getopt.getopt(args, "Hrp")
+        recursive = ("-r", "") in opts
+        rows = []
+        for name in args:
+            snapshot = self.__lookup(name)
+            tag,snapshots = self.__hold_targets(["", name], recursive)
+            for snapshot in snapshots:
+                for tag,stamp in sorted((snapshot.holds or {}).items()):
+                    if ("-p", "") in opts:
+                        stamp = str(stamp)
+                    else:
+                        stamp = time.strftime("%a %b %d %H:%M %Y",
+                                              time.localtime(stamp))
+                    rows.append([snapshot.name, tag, stamp])
+        self.__format(rows, ["NAME", "TAG", "TIMESTAMP"],
+                      ("-H", "") in opts, out)
+
+    #
+    # zpool(1) subcommands
+    #
+
+    def __get_pool_prop(self, pool, prop, parsable):
+        if prop == "name":
+            return pool.name
+        if prop == "health":
+            return "ONLINE"
+        if prop == "guid":
+            return str(pool.root.guid)
+        if prop == "capacity":
+            value = 100 * pool.get_used() // max(pool.size, 1)
+            if parsable == True:
+                return str(value)
+            return "%d%%" % (value)
+        values = {"size" : pool.size,
+                  "allocated" : pool.get_used(),
+                  "free" : pool.get_available(),
+                  "freeing" : 0}
+        if prop not in values:
+            raise CommandError("bad property list: invalid property " \
+                               "'%s'" % (prop), 2)
+        if parsable == True:
+            return str(values[prop])
+        return nicenum(values[prop])
+
+    def __select_pools(self, names):
+        pools = []
+        for name in names:
+            if name not in self.pools:
+                raise CommandError("cannot open '%s': no such pool" % (name))
+            pools.append(self.pools[name])
+        if len(names) == 0:
+            pools = [self.pools[name] for name in sorted(self.pools.keys())]
+        return pools
+
+    def __zpool_list(self, args, out, err):
+        opts,args = getopt.getopt(args, "Hpo:")
+        props = ["name", "size", "allocated", "free", "capacity", "health"]
+        for opt,value in opts:
+            if opt == "-o":
+                props = [ALIASES.get(p, p) for p in value.split(',')]
+        parsable = ("-p", "") in opts
+        rows = [[self.__get_pool_prop(pool, prop, parsable) \
+                 for prop in props] \
+                for pool in self.__select_pools(args)]
+        self.__format(rows, [p.upper() for p in props], ("-H", "") in opts,
+                      out)
+
+    def __zpool_get(self, args, out, err):
+        opts,args = getopt.getopt(args, "Hpo:")
+        fields = ["name", "property", "value", "source"]
+        for opt,value in opts:
+            if opt == "-o":
+                fields = value.split(',')
+        if len(args) == 0:
+            raise CommandError("missing property argument", 2)
+        parsable = ("-p", "") in opts
+        rows = []
+        for pool in self.__select_pools(args[1:]):
+            for prop in [ALIASES.get(p, p) for p in args[0].split(',')]:
+                values = {"name" : pool.name, "property" : prop,
+                          "value" : self.__get_pool_prop(pool, prop,
+                                                         parsable),
+                          "source" : "-"}
+                rows.append([values.get(field, "-") for field in fields])
+        self.__format(rows, [f.upper() for f in fields], ("-H", "") in opts,
+                      out)
+
+
+def install(emulator):
+    """
+    Routes the zfs(1) and zpool(1) commands run through
+    util.run_command() to emulator, or back to the real commands if
+    emulator is None. Also makes the zfs module modify snapshots by
+    running zfs(1), since libzfs_core would bypass the emulator, and
+    drops its snapshot cache. Returns the previous command backend.
+    """
+    previous = util.set_command_backend(emulator)
+    if emulator == None:
+        zfs.set_backend(None)
+    else:
+        zfs.set_backend(zfsbackend.CommandBackend(zfs.ZFSCMD))
+    zfs.Datasets.snapshots.invalidate()
+    return previous